@@ -13,13 +13,15 @@ import json
 import pyfiglet
 import copy
 from textwrap import indent
-from typing import List, Union, Any, Optional, Callable
+from typing import List, Union, Any, Optional, Callable, Generator, Tuple
 import tldextract
 from pathlib import Path, PosixPath
 import time
 import re
 import os
 import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait, Future
+import threading
 from tqdm import tqdm
 from langchain_community.llms import FakeListLLM
 from langchain_core.runnables import chain
@@ -28,27 +30,28 @@ from beartype.door import die_if_unbearable
 from .utils.misc import (
     ankiconnect, debug_chain, model_name_matcher,
     average_word_length, wpm, get_splitter,
-    check_docs_tkn_length, get_tkn_length,
+    check_docs_tkn_length, get_tkn_length, get_docs_tkn_length,
     extra_args_types, disable_internet,
     set_func_signature, query_eval_cache,
-    thinking_answer_parser
+    thinking_answer_parser, hasher
 )
+from .utils.compression import compress_text
 from .utils.prompts import prompts
-from .utils.tasks.query import refilter_docs, check_intermediate_answer, parse_eval_output, pbar_chain, pbar_closer, collate_intermediate_answers
+from .utils.tasks.query import refilter_docs, check_intermediate_answer, parse_eval_output, pbar_chain, pbar_closer, collate_intermediate_answers, evals_are_relevant, format_doc_batch, parse_eval_batch_outputs, iter_evaluations, parse_answer_batch_output, rerank_docs, choose_combine_fan_in, CombineTree
 
 from .utils.errors import NoDocumentsRetrieved
 from .utils.errors import NoDocumentsAfterLLMEvalFiltering
-from .utils.errors import ShouldIncreaseTopKAfterLLMEvalFiltering
 from .utils.tasks.summary import do_summarize
 from .utils.typechecker import optional_typecheck
 from .utils.llm import load_llm, TESTING_LLM
 from .utils.interact import ask_user
 from .utils.retrievers import create_hyde_retriever
 from .utils.retrievers import create_parent_retriever
+from .utils.retrievers import create_scored_retriever
 from .utils.embeddings import load_embeddings, fix_db
 from .utils.batch_file_loader import batch_load_doc
 from .utils.flags import is_verbose, is_debug
-from .utils.env import WDOC_OPEN_ANKI, WDOC_TYPECHECKING, WDOC_ALLOW_NO_PRICE, WDOC_DEBUGGER
+from .utils.env import WDOC_OPEN_ANKI, WDOC_TYPECHECKING, WDOC_ALLOW_NO_PRICE, WDOC_DEBUGGER, WDOC_MAX_COMBINE_TOKENS
 
 from langchain.globals import set_verbose
 from langchain.globals import set_debug
@@ -62,7 +65,6 @@ from langchain_community.retrievers import KNNRetriever, SVMRetriever
 from .utils.customs.fix_llm_caching import SQLiteCacheFixed
 from operator import itemgetter
 from langchain_core.runnables import RunnablePassthrough, RunnableLambda
-from langchain_core.runnables.base import RunnableEach
 from langchain_core.output_parsers.string import StrOutputParser
 from langchain_core.output_parsers import BaseGenerationOutputParser
 from langchain_core.outputs import Generation
@@ -116,10 +118,19 @@ class WDoc:
         # query_eval_modelname: str = "mistral/open-mixtral-8x7b",
         # query_eval_modelname: str = "mistral/open-small",
         query_eval_check_number: int = 3,
+        query_eval_batch_tkn_size: int = 0,
+        query_eval_cascade: Optional[str] = None,
+        query_eval_reranker: Optional[str] = None,
+        query_answer_batch_tkn_size: int = 0,
         query_relevancy: Union[float, int] = 0.1,
 
         summary_n_recursion: int = 0,
         summary_language: str = "the same language as the document",
+        summary_parallel_workers: int = 0,
+        summary_n_parallel_docs: int = 1,
+
+        compression_method: Optional[str] = None,
+        compression_ratio: float = 0.5,
 
         llm_verbosity: Union[bool, int] = False,
         debug: Union[bool, int] = False,
@@ -129,6 +140,7 @@ class WDoc:
         disable_llm_cache: Union[bool, int] = False,
         file_loader_parallel_backend: str = "threading",
         file_loader_n_jobs: int = 10,
+        resume: Union[bool, int] = False,
         private: Union[bool, int] = False,
         llms_api_bases: Optional[Union[dict, str]] = None,
         DIY_rolling_window_embedding: Union[bool, int] = False,
@@ -261,6 +273,14 @@ class WDoc:
         assert isinstance(
             embed_kwargs, dict), f"Not a dict but {type(embed_kwargs)}"
         assert query_eval_check_number > 0, "query_eval_check_number value"
+        assert query_eval_batch_tkn_size >= 0, "query_eval_batch_tkn_size value"
+        assert query_answer_batch_tkn_size >= 0, "query_answer_batch_tkn_size value"
+        assert summary_parallel_workers >= 0, "summary_parallel_workers value"
+        assert summary_n_parallel_docs >= 1, "summary_n_parallel_docs value"
+        assert compression_method in [None, "textrank", "embeddings"], "compression_method must be 'textrank' or 'embeddings'"
+        if compression_method == "embeddings":
+            assert embed_model.split("/", 1)[0].lower() != "openai", "compression_method 'embeddings' would send each sentence to the remote embeddings api, use 'textrank' or a local embed_model"
+        assert 0 < compression_ratio <= 1, "compression_ratio must be between 0 and 1"
 
         if llms_api_bases is None:
             llms_api_bases = {}
@@ -316,7 +336,7 @@ class WDoc:
         if isinstance(query, str):
             query = query.strip() or None
         assert file_loader_parallel_backend in [
-            "loky", "threading", "multiprocessing"], "Invalid value for file_loader_parallel_backend"
+            "loky", "threading", "multiprocessing", "hybrid"], "Invalid value for file_loader_parallel_backend"
         assert isinstance(file_loader_n_jobs, int), "file_loader_n_jobs mus be an int"
         if "{user_cache}" in save_embeds_as:
             save_embeds_as = save_embeds_as.replace(
@@ -325,6 +345,20 @@ class WDoc:
             query_relevancy = 0.0
         query_relevancy = float(query_relevancy)
 
+        # parsing the score bounds of the eval cascade
+        if query_eval_cascade is not None:
+            try:
+                low_score, high_score = [
+                    float(v) for v in str(query_eval_cascade).split("_")]
+                assert low_score <= high_score, "LOW>HIGH"
+            except Exception as err:
+                raise Exception(
+                    "Failed to parse query_eval_cascade value. The expected "
+                    "format is 'LOW_HIGH' with LOW and HIGH floats and "
+                    f"LOW<=HIGH. Received: {query_eval_cascade}"
+                )
+            query_eval_cascade = (low_score, high_score)
+
         # parsing top_k value
         if isinstance(top_k, str):
             try:
@@ -362,6 +396,10 @@ class WDoc:
         self.query_retrievers = query_retrievers if modelname != TESTING_LLM else query_retrievers.replace(
             "hyde", "")
         self.query_eval_check_number = int(query_eval_check_number)
+        self.query_eval_batch_tkn_size = int(query_eval_batch_tkn_size)
+        self.query_eval_cascade = query_eval_cascade
+        self.query_eval_reranker = query_eval_reranker
+        self.query_answer_batch_tkn_size = int(query_answer_batch_tkn_size)
         self.query_relevancy = query_relevancy
         self.debug = debug
         self.verbose = verbose
@@ -369,11 +407,16 @@ class WDoc:
         self.llm_verbosity = llm_verbosity
         self.summary_n_recursion = summary_n_recursion
         self.summary_language = summary_language
+        self.summary_parallel_workers = int(summary_parallel_workers)
+        self.summary_n_parallel_docs = int(summary_n_parallel_docs)
+        self.compression_method = compression_method
+        self.compression_ratio = float(compression_ratio)
         self.dollar_limit = dollar_limit
         self.private = bool(private)
         self.disable_llm_cache = bool(disable_llm_cache)
         self.file_loader_parallel_backend = file_loader_parallel_backend
         self.file_loader_n_jobs = file_loader_n_jobs
+        self.resume = bool(resume)
         self.llms_api_bases = llms_api_bases
         self.DIY_rolling_window_embedding = bool(DIY_rolling_window_embedding)
         self.import_mode = import_mode
@@ -512,6 +555,7 @@ class WDoc:
                 task=self.task,
                 backend=self.file_loader_parallel_backend,
                 n_jobs=self.file_loader_n_jobs if not is_debug else 1,
+                resume=self.resume,
                 **filtered_cli_kwargs,
             )
         else:
@@ -548,12 +592,12 @@ class WDoc:
     @optional_typecheck
     def summary_task(self) -> dict:
         docs_tkn_cost = {}
-        for doc in self.loaded_docs:
+        for doc, length in zip(self.loaded_docs, get_docs_tkn_length(self.loaded_docs)):
             meta = doc.metadata["path"]
             if meta not in docs_tkn_cost:
-                docs_tkn_cost[meta] = get_tkn_length(doc.page_content)
+                docs_tkn_cost[meta] = length
             else:
-                docs_tkn_cost[meta] += get_tkn_length(doc.page_content)
+                docs_tkn_cost[meta] += length
 
         full_tkn = sum(list(docs_tkn_cost.values()))
         red("Token price of each document:")
@@ -667,6 +711,25 @@ class WDoc:
             else:
                 metadata = "- Text metadata:\n    - Section number: [PROGRESS]\n"
 
+            if self.compression_method:
+                # remove the least central sentences before summarizing
+                method = self.compression_method
+                if method == "embeddings":
+                    red("No embeddings are loaded when summarizing, using textrank compression instead")
+                    method = "textrank"
+                compressed_docs = []
+                for d in relevant_docs:
+                    compressed = compress_text(
+                        text=d.page_content,
+                        ratio=self.compression_ratio,
+                        method=method,
+                        callback=self.llm.callbacks[0],
+                    )
+                    metadata_c = d.metadata.copy()
+                    metadata_c["content_hash"] = hasher(compressed)
+                    compressed_docs.append(Document(page_content=compressed, metadata=metadata_c))
+                relevant_docs = compressed_docs
+
             # summarize each chunk of the link and return one text
             summary, n_chunk, doc_total_cost, doc_total_tokens_in, doc_total_tokens_out = do_summarize(
                 docs=relevant_docs,
@@ -676,6 +739,8 @@ class WDoc:
                 llm=self.llm,
                 llm_price=self.llm_price,
                 verbose=self.llm_verbosity,
+                n_workers=self.summary_parallel_workers,
+                chunk_cache=bool(self.llm_cache),
             )
 
             # get reading length of the summary
@@ -731,6 +796,8 @@ class WDoc:
                         llm_price=self.llm_price,
                         verbose=self.llm_verbosity,
                         n_recursion=n_recur,
+                        n_workers=self.summary_parallel_workers,
+                        chunk_cache=bool(self.llm_cache),
                     )
                     doc_total_tokens_in += new_doc_total_tokens_in
                     doc_total_tokens_out += new_doc_total_tokens_out
@@ -801,25 +868,26 @@ class WDoc:
             # save to output file
             if "out_file" in self.cli_kwargs:
                 assert not self.import_mode, "Can't use import_mode with --out_file"
-                for nrecur, sum in recursive_summaries.items():
-                    outfile = Path(self.cli_kwargs["out_file"])
-                    if len(recursive_summaries) > 1 and nrecur < max(list(recursive_summaries.keys())):
-                        # also store intermediate summaries if present
-                        outfile = outfile.parent / \
-                            (outfile.stem + f".{nrecur + 1}.md")
-
-                    with open(str(outfile), "a") as f:
-                        if outfile.exists() and outfile.read_text().strip():
-                            f.write("\n\n\n")
-                        f.write(header)
-                        if len(recursive_summaries) > 1:
-                            f.write(
-                                f"\n    Recursive summary pass: {nrecur + 1}/{len(recursive_summaries)}")
-
-                        for bulletpoint in sum.split("\n"):
-                            f.write("\n")
-                            bulletpoint = bulletpoint.rstrip()
-                            f.write(f"    {bulletpoint}")
+                with out_file_lock:
+                    for nrecur, sum in recursive_summaries.items():
+                        outfile = Path(self.cli_kwargs["out_file"])
+                        if len(recursive_summaries) > 1 and nrecur < max(list(recursive_summaries.keys())):
+                            # also store intermediate summaries if present
+                            outfile = outfile.parent / \
+                                (outfile.stem + f".{nrecur + 1}.md")
+
+                        with open(str(outfile), "a") as f:
+                            if outfile.exists() and outfile.read_text().strip():
+                                f.write("\n\n\n")
+                            f.write(header)
+                            if len(recursive_summaries) > 1:
+                                f.write(
+                                    f"\n    Recursive summary pass: {nrecur + 1}/{len(recursive_summaries)}")
+
+                            for bulletpoint in sum.split("\n"):
+                                f.write("\n")
+                                bulletpoint = bulletpoint.rstrip()
+                                f.write(f"    {bulletpoint}")
 
             return {
                 "path": path,
@@ -834,10 +902,75 @@ class WDoc:
                 "n_chunk": n_chunk,
             }
 
-        results = summarize_documents(
-            path=self.cli_kwargs["path"],
-            relevant_docs=self.loaded_docs,
-        )
+        # group the chunks by document, keeping their order
+        docs_by_source = {}
+        for doc in self.loaded_docs:
+            source = (doc.metadata.get("path"), doc.metadata.get("file_hash"))
+            if source not in docs_by_source:
+                docs_by_source[source] = []
+            docs_by_source[source].append(doc)
+
+        out_file_lock = threading.Lock()
+        if len(docs_by_source) == 1:
+            results = summarize_documents(
+                path=self.cli_kwargs["path"],
+                relevant_docs=self.loaded_docs,
+            )
+            # same keys as when summarizing several documents
+            results["documents"] = [results.copy()]
+            results["skipped_documents"] = []
+        else:
+            whi(f"Summarizing {len(docs_by_source)} documents using {self.summary_n_parallel_docs} workers")
+            llmcallback = self.llm.callbacks[0]
+
+            @optional_typecheck
+            def summarize_if_affordable(path: Any, relevant_docs: List) -> Optional[dict]:
+                "stop summarizing new documents once dollar_limit is spent"
+                prompt_tokens, completion_tokens = llmcallback.get_tokens()
+                spent = self.llm_price[0] * prompt_tokens + \
+                    self.llm_price[1] * completion_tokens
+                if spent >= self.dollar_limit:
+                    red(f"Not summarizing {path} as ${spent:.5f} was already spent, dollar_limit is ${self.dollar_limit}")
+                    return None
+                return summarize_documents(
+                    path=path,
+                    relevant_docs=relevant_docs,
+                )
+
+            with ThreadPoolExecutor(max_workers=self.summary_n_parallel_docs) as pool:
+                futures = [
+                    pool.submit(
+                        summarize_if_affordable,
+                        path=source[0] if source[0] else self.cli_kwargs["path"],
+                        relevant_docs=docs,
+                    )
+                    for source, docs in docs_by_source.items()
+                ]
+                documents = [f.result() for f in futures]
+            skipped = [
+                source[0]
+                for source, d in zip(docs_by_source.keys(), documents)
+                if d is None
+            ]
+            if skipped:
+                red(self.ntfy(f"{len(skipped)} documents were not summarized because of dollar_limit"))
+            documents = [d for d in documents if d is not None]
+            # same keys as for a single document: the numbers are summed
+            # and the other values are listed by document
+            results = {
+                "path": self.cli_kwargs["path"],
+                "sum_reading_length": sum(d["sum_reading_length"] for d in documents),
+                "sum_tkn_length": sum(d["sum_tkn_length"] for d in documents),
+                "doc_reading_length": sum(d["doc_reading_length"] for d in documents),
+                "doc_total_tokens": sum(d["doc_total_tokens"] for d in documents),
+                "doc_total_cost": sum(d["doc_total_cost"] for d in documents),
+                "summary": "\n\n".join(d["summary"] for d in documents),
+                "recursive_summaries": [d["recursive_summaries"] for d in documents],
+                "author": [d["author"] for d in documents],
+                "n_chunk": sum(d["n_chunk"] for d in documents),
+                "documents": documents,
+                "skipped_documents": skipped,
+            }
 
         if not self.import_mode:
             red(self.ntfy(
@@ -856,6 +989,9 @@ class WDoc:
         if llmcallback.total_tokens != results['doc_total_tokens']:
             red(
                 f"Cost discrepancy? Tokens used according to the callback: '{llmcallback.total_tokens}' (${total_cost:.5f})")
+        if llmcallback.compression_saved_tokens:
+            yel(f"Tokens removed by the compression before calling the strong model: {llmcallback.compression_saved_tokens}")
+        results["compression_saved_tokens"] = llmcallback.compression_saved_tokens
         self.summary_results = results
         self.latest_cost = total_cost
         return results
@@ -1162,6 +1298,14 @@ class WDoc:
             retriev in ["default", "hyde", "knn", "svm", "parent"]
             for retriev in self.interaction_settings["retriever"].split("_")
         ), f"Invalid retriever value: {self.interaction_settings['retriever']}"
+        # the candidates are retrieved only once, up to max_top_k, then
+        # the eval llm goes through them by windows of increasing size
+        top_k = self.interaction_settings["top_k"]
+        if self.max_top_k is not None and self.max_top_k > top_k:
+            retrieval_top_k = self.max_top_k
+        else:
+            retrieval_top_k = top_k
+
         retrievers = []
         if "hyde" in self.interaction_settings["retriever"].lower():
             retrievers.append(
@@ -1169,7 +1313,7 @@ class WDoc:
                     query=query,
 
                     llm=self.llm,
-                    top_k=self.interaction_settings["top_k"],
+                    top_k=retrieval_top_k,
                     relevancy=self.interaction_settings["relevancy"],
 
                     embeddings=self.embeddings,
@@ -1183,7 +1327,7 @@ class WDoc:
                     self.all_texts,
                     self.embeddings,
                     relevancy_threshold=self.interaction_settings["relevancy"],
-                    k=self.interaction_settings["top_k"],
+                    k=retrieval_top_k,
                 )
             )
         if "svm" in self.interaction_settings["retriever"].lower():
@@ -1192,7 +1336,7 @@ class WDoc:
                     self.all_texts,
                     self.embeddings,
                     relevancy_threshold=self.interaction_settings["relevancy"],
-                    k=self.interaction_settings["top_k"],
+                    k=retrieval_top_k,
                 )
             )
         if "parent" in self.interaction_settings["retriever"].lower():
@@ -1201,17 +1345,26 @@ class WDoc:
                     task=self.task,
                     loaded_embeddings=self.loaded_embeddings,
                     loaded_docs=self.loaded_docs,
-                    top_k=self.interaction_settings["top_k"],
+                    top_k=retrieval_top_k,
                     relevancy=self.interaction_settings["relevancy"],
                 )
             )
 
-        if "default" in self.interaction_settings["retriever"].lower():
+        if "default" in self.interaction_settings["retriever"].lower() and self.query_eval_cascade is not None:
+            # the scores of the search are needed by the eval cascade
+            retrievers.append(
+                create_scored_retriever(
+                    loaded_embeddings=self.loaded_embeddings,
+                    top_k=retrieval_top_k,
+                    relevancy=self.interaction_settings["relevancy"],
+                )
+            )
+        elif "default" in self.interaction_settings["retriever"].lower():
             retrievers.append(
                 self.loaded_embeddings.as_retriever(
                     search_type="similarity_score_threshold",
                     search_kwargs={
-                        "k": self.interaction_settings["top_k"],
+                        "k": retrieval_top_k,
                         "score_threshold": self.interaction_settings["relevancy"],
                     })
             )
@@ -1303,35 +1456,16 @@ class WDoc:
                 f"invalidates the cache: '{self.eval_llm._get_llm_string()}'\n"
                 f"Related github issue: 'https://github.com/langchain-ai/langchain/issues/23257'")
 
-        @chain
-        @optional_typecheck
-        def autoincrease_top_k(filtered_docs: List[Document]) -> List[Document]:
-            ratio = len(filtered_docs) / self.top_k
-            if ratio >= 0.9:
-                raise ShouldIncreaseTopKAfterLLMEvalFiltering(
-                    red(
-                        f"Number of documents found: {len(filtered_docs)}, "
-                        f"top_k is {self.top_k} so ratio={ratio:.1f}, hence "
-                        f"top_k should be increased. Max_top_k is {self.max_top_k}"))
-            return filtered_docs
+        # keep track of how many calls to the eval llm were actually made
+        eval_stats = {"calls": 0, "cascade_accepted": 0, "cascade_rejected": 0}
 
-        @chain
         @optional_typecheck
-        @eval_cache_wrapper
-        def evaluate_doc_chain(
-            inputs: dict,
-            query_nb: int = self.query_eval_check_number,
-            eval_model_string: str = self.eval_llm._get_llm_string(),  # just for caching
-            eval_prompt: str = str(prompts.evaluate.to_json()),
-        ) -> List[str]:
-            if isinstance(self.eval_llm, FakeListLLM):
-                outputs = ["1" for i in range(self.query_eval_check_number)]
-                new_p = 0
-                new_c = 0
-
-            elif "n" in self.eval_llm_params or self.query_eval_check_number == 1:
-                out = self.eval_llm._generate_with_cache(
-                    prompts.evaluate.format_messages(**inputs))
+        def eval_llm_generate(messages: List) -> List[str]:
+            """call the eval llm to get query_eval_check_number generations
+            for the same messages and update the token count"""
+            if "n" in self.eval_llm_params or self.query_eval_check_number == 1:
+                out = self.eval_llm._generate_with_cache(messages)
+                eval_stats["calls"] += 1
                 reasons = [gen.generation_info["finish_reason"]
                            for gen in out.generations]
                 outputs = [gen.text for gen in out.generations]
@@ -1339,8 +1473,6 @@ class WDoc:
                 if not all(r in ["stop", "length"] for r in reasons):
                     red(
                         f"Unexpected generation finish_reason: '{reasons}' for generations: '{outputs}'")
-                assert outputs, "No generations found by query eval llm"
-                outputs = [parse_eval_output(o) for o in outputs]
                 if out.llm_output:
                     new_p = out.llm_output["token_usage"]["prompt_tokens"]
                     new_c = out.llm_output["token_usage"]["completion_tokens"]
@@ -1353,10 +1485,10 @@ class WDoc:
                 new_p = 0
                 new_c = 0
 
-                async def do_eval(inputs):
-                    return await self.eval_llm._agenerate_with_cache(prompts.evaluate.format_messages(**inputs))
+                async def do_eval(messages):
+                    return await self.eval_llm._agenerate_with_cache(messages)
                 outs = [
-                    do_eval(inputs)
+                    do_eval(messages)
                     for i in range(self.query_eval_check_number)
                 ]
                 try:
@@ -1365,6 +1497,7 @@ class WDoc:
                     loop = asyncio.new_event_loop()
                     asyncio.set_event_loop(loop)
                 outs = loop.run_until_complete(asyncio.gather(*outs))
+                eval_stats["calls"] += len(outs)
                 for out in outs:
                     assert len(
                         out.generations) == 1, f"Query eval llm produced more than 1 evaluations: '{out.generations}'"
@@ -1376,91 +1509,220 @@ class WDoc:
                     if out.llm_output:
                         new_p += out.llm_output["token_usage"]["prompt_tokens"]
                         new_c += out.llm_output["token_usage"]["completion_tokens"]
-                assert outputs, "No generations found by query eval llm"
+            assert outputs, "No generations found by query eval llm"
+
+            self.eval_llm.callbacks[0].add_tokens(new_p, new_c)
+            return outputs
+
+        @chain
+        @optional_typecheck
+        @eval_cache_wrapper
+        def evaluate_doc_chain(
+            inputs: dict,
+            query_nb: int = self.query_eval_check_number,
+            eval_model_string: str = self.eval_llm._get_llm_string(),  # just for caching
+            eval_prompt: str = str(prompts.evaluate.to_json()),
+        ) -> List[str]:
+            if isinstance(self.eval_llm, FakeListLLM):
+                outputs = ["1" for i in range(self.query_eval_check_number)]
+            else:
+                outputs = eval_llm_generate(
+                    prompts.evaluate.format_messages(**inputs))
                 outputs = [parse_eval_output(o) for o in outputs]
 
             assert len(
                 outputs) == self.query_eval_check_number, f"query eval model failed to produce {self.query_eval_check_number} outputs: '{outputs}'"
 
-            self.eval_llm.callbacks[0].prompt_tokens += new_p
-            self.eval_llm.callbacks[0].completion_tokens += new_c
-            self.eval_llm.callbacks[0].total_tokens += new_p + new_c
             if self.eval_llm.callbacks[0].pbar:
                 self.eval_llm.callbacks[0].pbar[-1].update(1)
             return outputs
 
+        @chain
+        @optional_typecheck
+        @eval_cache_wrapper
+        def evaluate_doc_batch_chain(
+            inputs: dict,
+            query_nb: int = self.query_eval_check_number,
+            eval_model_string: str = self.eval_llm._get_llm_string(),  # just for caching
+            eval_prompt: str = str(prompts.evaluate_batch.to_json()),
+        ) -> List[Optional[List[str]]]:
+            """evaluate several documents in a single call. Returns for each
+            document the list of evaluations, or None if the evaluation
+            of this document could not be parsed in all generations."""
+            n_docs = len(inputs["docs"])
+            outputs = eval_llm_generate(
+                prompts.evaluate_batch.format_messages(
+                    q=inputs["q"],
+                    n_docs=n_docs,
+                    docs=format_doc_batch(inputs["docs"]),
+                )
+            )
+            assert len(
+                outputs) == self.query_eval_check_number, f"query eval model failed to produce {self.query_eval_check_number} outputs: '{outputs}'"
+            evaluations = parse_eval_batch_outputs(outputs, n_docs)
+
+            if self.eval_llm.callbacks[0].pbar:
+                self.eval_llm.callbacks[0].pbar[-1].update(
+                    len([ev for ev in evaluations if ev is not None]))
+            return evaluations
+
         # uses in most places to increase concurrency limit
         multi = {"max_concurrency": 10 if not self.debug else 1}
 
+        @optional_typecheck
+        def evaluate_docs(inputs: List[dict]) -> Generator[Tuple[int, List[str]], None, None]:
+            "evaluate the documents, by batch if query_eval_batch_tkn_size is set"
+            return iter_evaluations(
+                inputs=inputs,
+                evaluate_doc=evaluate_doc_chain.invoke,
+                evaluate_batch=evaluate_doc_batch_chain.invoke,
+                batch_tkn_size=self.query_eval_batch_tkn_size,
+                max_workers=multi["max_concurrency"],
+            )
+
+        # for some reason I needed to have at least one chain object otherwise rag_chain is a dict
+        @chain
+        @optional_typecheck
+        def retrieve_documents(inputs):
+            output = {
+                "unfiltered_docs": retriever.get_relevant_documents(inputs["question_for_embedding"]),
+                "question_to_answer": inputs["question_to_answer"],
+            }
+            return output
+
+        @optional_typecheck
+        def filter_candidates(
+            inputs: dict,
+            on_evaluated: Optional[Callable] = None,
+            ) -> dict:
+            """evaluate the retrieved candidates by windows of increasing
+            size: if most of the documents of the window are found relevant,
+            the window is increased (up to max_top_k) and only the new
+            candidates are sent to the eval llm. on_evaluated is called
+            with the rank, the document and whether it is relevant as soon
+            as its evaluation is known, so that it can be answered without
+            waiting for the others."""
+            candidates = inputs["unfiltered_docs"]
+            if not candidates:
+                raise NoDocumentsRetrieved("No document corresponding to the query")
+
+            # documents with a clear cut embedding score are accepted or
+            # rejected without asking the eval llm
+            # (only the documents found by the default retriever have one)
+            known_evals = {}
+            if self.query_eval_cascade is not None:
+                low_score, high_score = self.query_eval_cascade
+                for d in candidates:
+                    if "relevance_score" not in d.metadata:
+                        continue
+                    score = d.metadata["relevance_score"]
+                    if score >= high_score:
+                        known_evals[d.metadata["content_hash"]] = ["1"] * self.query_eval_check_number
+                    elif score < low_score:
+                        known_evals[d.metadata["content_hash"]] = ["0"] * self.query_eval_check_number
+
+            # sort the uncertain documents using the reranker, keeping the
+            # position of the others
+            if self.query_eval_reranker:
+                reranked = iter(
+                    rerank_docs(
+                        query=inputs["question_to_answer"],
+                        docs=[d for d in candidates if d.metadata["content_hash"] not in known_evals],
+                        modelname=self.query_eval_reranker,
+                    )
+                )
+                candidates = [
+                    d if d.metadata["content_hash"] in known_evals else next(reranked)
+                    for d in candidates
+                ]
+
+            window = top_k
+            evaluations = []
+            while True:
+                new_docs = candidates[len(evaluations):window]
+                new_evals = [None] * len(new_docs)
+                uncertain = []
+                for i, d in enumerate(new_docs):
+                    if d.metadata["content_hash"] not in known_evals:
+                        uncertain.append(i)
+                        continue
+                    new_evals[i] = known_evals[d.metadata["content_hash"]]
+                    if "1" in known_evals[d.metadata["content_hash"]]:
+                        eval_stats["cascade_accepted"] += 1
+                    else:
+                        eval_stats["cascade_rejected"] += 1
+                    if on_evaluated is not None:
+                        on_evaluated(len(evaluations) + i, d, "1" in new_evals[i])
+                for iu, ev in evaluate_docs(
+                    [
+                        {"doc": new_docs[i].page_content, "q": inputs["question_to_answer"]}
+                        for i in uncertain
+                    ]
+                ):
+                    new_evals[uncertain[iu]] = ev
+                    if on_evaluated is not None:
+                        on_evaluated(
+                            len(evaluations) + uncertain[iu],
+                            new_docs[uncertain[iu]],
+                            evals_are_relevant(ev),
+                        )
+                assert not any(ev is None for ev in new_evals)
+                evaluations.extend(new_evals)
+                judged = candidates[:len(evaluations)]
+                filtered_docs = refilter_docs.invoke(
+                    {
+                        "unfiltered_docs": judged,
+                        "evaluations": evaluations,
+                    }
+                )
+                ratio = len(filtered_docs) / window
+                if ratio < 0.9 or len(judged) == len(candidates):
+                    break
+                if self.max_top_k is None or window >= self.max_top_k:
+                    red(
+                        f"Number of documents found: {len(filtered_docs)}, "
+                        f"top_k is {window} so ratio={ratio:.1f}, you should "
+                        "probably increase top_k.")
+                    break
+                new_window = min(int(window * 1.5), self.max_top_k)
+                assert new_window > window
+                red(
+                    f"Number of documents found: {len(filtered_docs)}, "
+                    f"top_k is {window} so ratio={ratio:.1f}, hence "
+                    f"increasing top_k to {new_window}. Max_top_k is {self.max_top_k}")
+                window = new_window
+
+            return {
+                "filtered_docs": filtered_docs,
+                "unfiltered_docs": judged,
+                "question_to_answer": inputs["question_to_answer"],
+            }
+
+        @chain
+        @optional_typecheck
+        def refilter_documents(inputs: dict) -> dict:
+            return filter_candidates(inputs)
+
         if self.task == "search":
             if self.query_eval_modelname:
-                # for some reason I needed to have at least one chain object otherwise rag_chain is a dict
-                @chain
-                @optional_typecheck
-                def retrieve_documents(inputs):
-                    return {
-                        "unfiltered_docs": retriever.get_relevant_documents(inputs["question_for_embedding"]),
-                        "question_to_answer": inputs["question_to_answer"],
-                    }
-                    return inputs
-
-                refilter_documents = {
-                    "filtered_docs": (
-                        RunnablePassthrough.assign(
-                            evaluations=RunnablePassthrough.assign(
-                                doc=lambda inputs: inputs["unfiltered_docs"],
-                                q=lambda inputs: [inputs["question_to_answer"] for i in range(
-                                    len(inputs["unfiltered_docs"]))],
-                            )
-                            | RunnablePassthrough.assign(
-                                inputs=lambda inputs: [
-                                    {"doc": d.page_content, "q": q}
-                                    for d, q in zip(inputs["doc"], inputs["q"])],
-                                )
-                            | itemgetter("inputs")
-                            | RunnableEach(bound=evaluate_doc_chain.with_config(multi)).with_config(multi)
-                        )
-                        | refilter_docs
-                        | autoincrease_top_k
-                    ),
-                    "unfiltered_docs": itemgetter("unfiltered_docs"),
-                    "question_to_answer": itemgetter("question_to_answer")
-                }
                 rag_chain = (
                     retrieve_documents
                     | refilter_documents
                 )
-                tried_top_k = []
-                while True:
-                    if len(tried_top_k) > 10:
-                        raise Exception(f"Tried more than 10 top_k: {tried_top_k}")
-                    try:
-                        assert self.top_k not in tried_top_k
-                        tried_top_k.append(self.top_k)
-                        output = rag_chain.invoke(
-                            {
-                                "question_for_embedding": query_fe,
-                                "question_to_answer": query_an,
-                            }
-                        )
-                        break
-                    except ShouldIncreaseTopKAfterLLMEvalFiltering as err:
-                        if self.max_top_k is None:
-                            raise
-                        elif self.max_top_k == self.top_k:
-                            break
-                        assert self.max_top_k > self.top_k
-                        new_top_k = min(int(self.top_k * 1.5), self.max_top_k)
-                        assert new_top_k > self.top_k
-                        assert new_top_k not in tried_top_k
-                        assert new_top_k <= self.max_top_k
-                        self.top_k = new_top_k
+                output = rag_chain.invoke(
+                    {
+                        "question_for_embedding": query_fe,
+                        "question_to_answer": query_an,
+                    }
+                )
 
                 docs = output["filtered_docs"]
+                output["n_eval_llm_calls"] = eval_stats["calls"]
+                output["n_eval_saved_by_cascade"] = eval_stats["cascade_accepted"] + eval_stats["cascade_rejected"]
             else:
 
-                docs = retriever.get_relevant_documents(query)
-                if len(docs) < self.interaction_settings["top_k"]:
+                docs = retriever.get_relevant_documents(query)[:top_k]
+                if len(docs) < top_k:
                     red(f"Only found {len(docs)} relevant documents")
 
             if self.import_mode:
@@ -1488,6 +1750,12 @@ class WDoc:
                     f"Number of documents using embeddings: {len(output['unfiltered_docs'])}")
                 red(
                     f"Number of documents after query eval filter: {len(output['filtered_docs'])}")
+                red(f"Number of calls to the query eval LLM: {eval_stats['calls']}")
+                if self.query_eval_cascade is not None:
+                    red(
+                        "Number of documents decided by the embedding score cascade "
+                        f"without calling the eval LLM: {output['n_eval_saved_by_cascade']} "
+                        f"(accepted: {eval_stats['cascade_accepted']}, rejected: {eval_stats['cascade_rejected']})")
 
             if WDOC_OPEN_ANKI and anki_cid:
                 open_answ = input(
@@ -1524,133 +1792,258 @@ class WDoc:
             self.latest_cost = etotal_cost
 
         else:
-            # for some reason I needed to have at least one chain object otherwise rag_chain is a dict
-            @chain
-            @optional_typecheck
-            def retrieve_documents(inputs):
-                return {
-                    "unfiltered_docs": retriever.get_relevant_documents(inputs["question_for_embedding"]),
-                    "question_to_answer": inputs["question_to_answer"],
-                }
-                return inputs
-            refilter_documents = {
-                "filtered_docs": (
-                    RunnablePassthrough.assign(
-                        evaluations=RunnablePassthrough.assign(
-                            doc=lambda inputs: inputs["unfiltered_docs"],
-                            q=lambda inputs: [inputs["question_to_answer"] for i in range(
-                                len(inputs["unfiltered_docs"]))],
-                        )
-                        | RunnablePassthrough.assign(
-                            inputs=lambda inputs: [
-                                {"doc": d.page_content, "q": q}
-                                for d, q in zip(inputs["doc"], inputs["q"])])
-                        | itemgetter("inputs")
-                        | RunnableEach(bound=evaluate_doc_chain.with_config(multi)).with_config(multi)
-                    )
-                    | refilter_docs
-                    | autoincrease_top_k
-                ),
-                "unfiltered_docs": itemgetter("unfiltered_docs"),
-                "question_to_answer": itemgetter("question_to_answer")
-            }
+            # maximum length of each intermediate answer
+            answer_max_tkn = 1000
             answer_each_doc_chain = (
                 prompts.answer
-                | self.llm.bind(max_tokens=1000)
+                | self.llm.bind(max_tokens=answer_max_tkn)
                 | StrOutputParser()
             )
 
-            answer_all_docs = RunnablePassthrough.assign(
-                inputs=lambda inputs: [
-                    {"context": d.page_content, "question_to_answer": q}
-                    for d, q in zip(
-                        inputs["filtered_docs"],
-                        [inputs["question_to_answer"]] *
-                        len(inputs["filtered_docs"])
+            # chain to combine intermediate answers into a single answer
+            final_answer_chain = RunnablePassthrough.assign(
+                final_answer=RunnablePassthrough.assign(
+                    question=lambda inputs: inputs["question_to_answer"],
+                    intermediate_answers=lambda inputs:  collate_intermediate_answers(
+                        list_ia=inputs["intermediate_answers"],
+                        embedding_engine=self.embeddings,
+                    ),
+                )
+                | prompts.combine
+                | self.llm
+                | StrOutputParser()
+            )
+
+            # budget of each combine call: the context of the model minus
+            # the combine prompt itself
+            try:
+                combine_tkn_budget = litellm.get_model_info(self.modelname)["max_input_tokens"]
+                if combine_tkn_budget is None:
+                    combine_tkn_budget = 4096
+                    red(f"litellm does not know the max_input_tokens of model {self.modelname}, using {combine_tkn_budget}")
+                if WDOC_MAX_COMBINE_TOKENS:
+                    combine_tkn_budget = min(combine_tkn_budget, WDOC_MAX_COMBINE_TOKENS)
+            except Exception as err:
+                combine_tkn_budget = 4096
+                if self.modelname != TESTING_LLM:
+                    red(f"Failed to get max_tokens limit for model {self.modelname}: '{err}'")
+            combine_tkn_budget -= get_tkn_length(
+                prompts.combine.format(
+                    question=query_an,
+                    intermediate_answers="",
+                )
+            )
+            combine_tkn_budget = max(combine_tkn_budget, 1000)
+            # the answers are not known yet so the fan-in is chosen for
+            # top_k answers of the maximum length, the same fan-in is used
+            # while streaming and for the last rounds
+            fan_in = choose_combine_fan_in(
+                lengths=[answer_max_tkn] * top_k,
+                tkn_budget=combine_tkn_budget,
+                max_fan_in=10,
+            )
+
+            # The stages overlap: each document is answered as soon as its
+            # evaluation passes (or, if query_answer_batch_tkn_size is set,
+            # as soon as the documents of its file fill an answering
+            # prompt) and the relevant intermediate answers are
+            # combined by combine_tree as soon as a full batch of them is
+            # ready. The answers are given to combine_tree in the order of
+            # the candidates, each one waiting until every better ranked
+            # candidate is rejected or answered, so that the combines do
+            # not depend on which call finishes first.
+            answer_futures = {}
+            lock = threading.Lock()
+            # rank of each relevant document, answers of each settled rank
+            # not yet released, next rank and next position in combine_tree
+            ranks = {}
+            settled = {}
+            release = {"rank": 0, "seq": 0}
+            release_lock = threading.Lock()
+
+            @optional_typecheck
+            def settle(rank: int, answers: List[str]) -> None:
+                "release the answers of all the consecutive settled ranks"
+                with release_lock:
+                    settled[rank] = answers
+                    while release["rank"] in settled:
+                        for ia in settled.pop(release["rank"]):
+                            combine_tree.put(0, release["seq"], ia)
+                            release["seq"] += 1
+                        release["rank"] += 1
+
+            @optional_typecheck
+            def combine_answers(answers: List[str]) -> str:
+                return final_answer_chain.invoke(
+                    {
+                        "question_to_answer": query_an,
+                        "intermediate_answers": answers,
+                    }
+                )["final_answer"]
+
+            @optional_typecheck
+            def submit_combine(*args) -> Future:
+                fut = pool.submit(*args)
+                answer_pbar.total += 1
+                answer_pbar.refresh()
+                return fut
+
+            @optional_typecheck
+            def get_context(doc: Document) -> str:
+                "text of the document given to the llm, compressed if asked"
+                if not self.compression_method:
+                    return doc.page_content
+                return compress_text(
+                    text=doc.page_content,
+                    ratio=self.compression_ratio,
+                    method=self.compression_method,
+                    embedding_engine=self.embeddings,
+                    callback=self.llm.callbacks[0],
+                )
+
+            @optional_typecheck
+            def answer_docs(docs: List[Document]) -> List[str]:
+                "answer the documents with a single llm call if there are several"
+                contexts = [get_context(d) for d in docs]
+                if len(docs) == 1:
+                    answers = [None]
+                else:
+                    batch_output = (
+                        prompts.answer_batch
+                        | self.llm.bind(max_tokens=min(1000 * len(docs), 4096))
+                        | StrOutputParser()
+                    ).invoke(
+                        {
+                            "question_to_answer": query_an,
+                            "n_docs": len(docs),
+                            "contexts": format_doc_batch(contexts),
+                        }
                     )
-                ]
-            ) | {
-                "intermediate_answers": itemgetter("inputs") | RunnableEach(bound=answer_each_doc_chain),
-                "question_to_answer": itemgetter("question_to_answer"),
-                "filtered_docs": itemgetter("filtered_docs"),
-                "unfiltered_docs": itemgetter("unfiltered_docs"),
-            }
+                    answers = parse_answer_batch_output(batch_output, len(docs))
+                    if None in answers:
+                        red(f"Failed to parse the batch answer of {answers.count(None)}/{len(docs)} documents, answering them individually.")
+                for i, doc in enumerate(docs):
+                    if answers[i] is None:
+                        answers[i] = answer_each_doc_chain.invoke(
+                            {
+                                "context": contexts[i],
+                                "question_to_answer": query_an,
+                            }
+                        )
+                    if check_intermediate_answer(answers[i]):
+                        # add the document hash as source to each intermediate
+                        # answer, they will then be combined together and
+                        # replaced again last minute by more legible identifiers
+                        settle(
+                            ranks[id(doc)],
+                            [f"Source identifier: [{doc.metadata['content_hash'][:5]}]\n{answers[i]}"],
+                        )
+                    else:
+                        settle(ranks[id(doc)], [])
+                return answers
+
+            # relevant documents waiting to be answered together, by file
+            answer_groups = {}
+
+            @optional_typecheck
+            def submit_answers(docs: List[Document]) -> None:
+                "must be called while holding the lock"
+                fut = pool.submit(answer_docs, docs)
+                for i, doc in enumerate(docs):
+                    answer_futures[id(doc)] = (fut, i)
+                answer_pbar.total += 1
+                answer_pbar.refresh()
 
+            @optional_typecheck
+            def on_evaluated(rank: int, doc: Document, relevant: bool) -> None:
+                if not relevant:
+                    settle(rank, [])
+                    return
+                with lock:
+                    ranks[id(doc)] = rank
+                    if not self.query_answer_batch_tkn_size:
+                        submit_answers([doc])
+                        return
+                    key = doc.metadata.get("file_hash", doc.metadata.get("path", id(doc)))
+                    length = get_tkn_length(doc.page_content)
+                    if key in answer_groups:
+                        group = answer_groups[key]
+                        if group[1] + length > self.query_answer_batch_tkn_size:
+                            submit_answers(group[0])
+                            del answer_groups[key]
+                    if key in answer_groups:
+                        answer_groups[key][0].append(doc)
+                        answer_groups[key][1] += length
+                    else:
+                        answer_groups[key] = [[doc], length]
 
-            rag_chain = (
-                retrieve_documents
-                | pbar_chain(
+            chain_time = 0
+            start_time = time.time()
+            inputs = {
+                "question_for_embedding": query_fe,
+                "question_to_answer": query_an,
+            }
+            try:
+                with ThreadPoolExecutor(max_workers=multi["max_concurrency"]) as pool:
+                    combine_tree = CombineTree(
+                        combine=combine_answers,
+                        submit=submit_combine,
+                        tkn_budget=combine_tkn_budget,
+                        fan_in=fan_in,
+                    )
+                    inputs = retrieve_documents.invoke(inputs)
+                    pbar_chain(
                         llm=self.eval_llm,
                         len_func="len(inputs['unfiltered_docs'])",
                         desc="LLM evaluation",
                         unit="doc",
-                    )
-                | refilter_documents
-                | pbar_closer(llm=self.eval_llm)
-                | pbar_chain(
-                        llm=self.llm,
-                        len_func="len(inputs['filtered_docs'])",
+                    ).invoke(inputs)
+                    answer_pbar = tqdm(
+                        total=0,
                         desc="Answering each",
                         unit="doc",
                     )
-                | answer_all_docs
-                | pbar_closer(llm=self.llm)
-            )
-
-            if is_verbose:
-                rag_chain.get_graph().print_ascii()
-
-            chain_time = 0
-            start_time = time.time()
-            tried_top_k = []
-            while True:
-                if len(tried_top_k) > 10:
-                    raise Exception(f"Tried more than 10 top_k: {tried_top_k}")
-                try:
-                    assert self.top_k not in tried_top_k
-                    tried_top_k.append(self.top_k)
-                    output = rag_chain.invoke(
-                        {
-                            "question_for_embedding": query_fe,
-                            "question_to_answer": query_an,
-                        }
-                    )
-                    break
-                except ShouldIncreaseTopKAfterLLMEvalFiltering:
-                    if self.max_top_k is None:
-                        raise
-                    elif self.max_top_k == self.top_k:
-                        break
-                    assert self.max_top_k > self.top_k
-                    new_top_k = min(int(self.top_k * 1.5), self.max_top_k)
-                    assert new_top_k > self.top_k
-                    assert new_top_k not in tried_top_k
-                    assert new_top_k <= self.max_top_k
-                    self.top_k = new_top_k
-                except NoDocumentsRetrieved as err:
-                    return {"error": md_printer(f"## No documents were retrieved with query '{query_fe}'", color="red")}
-                except NoDocumentsAfterLLMEvalFiltering as err:
-                    return {"error": md_printer(f"## No documents remained after query eval LLM filtering using question '{query_an}'", color="red")}
+                    self.llm.callbacks[0].pbar.append(answer_pbar)
+                    output = filter_candidates(inputs, on_evaluated=on_evaluated)
+                    pbar_closer(llm=self.eval_llm).invoke(output)
+                    with lock:
+                        for group in answer_groups.values():
+                            submit_answers(group[0])
+                        answer_groups.clear()
+
+                    # wait for the answers and the combines they triggered,
+                    # each job submits its followers before finishing
+                    while True:
+                        with lock, combine_tree.lock:
+                            not_done = [
+                                f for f in [af[0] for af in answer_futures.values()] + combine_tree.futures
+                                if not f.done()
+                            ]
+                        if not not_done:
+                            break
+                        wait(not_done)
+                    pbar_closer(llm=self.llm).invoke(output)
+            except NoDocumentsRetrieved as err:
+                return {"error": md_printer(f"## No documents were retrieved with query '{query_fe}'", color="red")}
+            except NoDocumentsAfterLLMEvalFiltering as err:
+                return {"error": md_printer(f"## No documents remained after query eval LLM filtering using question '{query_an}'", color="red")}
+            output["intermediate_answers"] = [
+                answer_futures[id(d)][0].result()[answer_futures[id(d)][1]]
+                for d in output["filtered_docs"]
+            ]
+            for f in combine_tree.futures:
+                f.result()
+            assert not settled, f"Some answers were never given to combine: {list(settled)}"
             chain_time = time.time() - start_time
+            output["n_eval_llm_calls"] = eval_stats["calls"]
+            output["n_eval_saved_by_cascade"] = eval_stats["cascade_accepted"] + eval_stats["cascade_rejected"]
+            output["streamed_combines"] = combine_tree.streamed
 
             assert len(output["intermediate_answers"]) == len(output["filtered_docs"])
 
             if len(output["intermediate_answers"]) > 1:
-                # next step is to combine the intermediate answers into a single answer
-                final_answer_chain = RunnablePassthrough.assign(
-                    final_answer=RunnablePassthrough.assign(
-                        question=lambda inputs: inputs["question_to_answer"],
-                        intermediate_answers=lambda inputs:  collate_intermediate_answers(
-                            list_ia=inputs["intermediate_answers"],
-                            embedding_engine=self.embeddings,
-                        ),
-                    )
-                    | prompts.combine
-                    | self.llm
-                    | StrOutputParser()
-                )
-
-                # add the document hash as source to each intermediate answer, they will then be combined together and replaced again last minute by more legible identifiers
+                # next step is to combine what remains of the intermediate
+                # answers into a single answer
                 for ifd, fd in enumerate(output["filtered_docs"]):
                     ia = output["intermediate_answers"][ifd]
                     doc_hash = fd.metadata["content_hash"][:5]
@@ -1669,61 +2062,48 @@ class WDoc:
                 cost_before_combine = self.llm_price[0] * llmcallback.prompt_tokens + \
                 self.llm_price[1] * llmcallback.completion_tokens
 
-                # group the intermediate answers by batch, then do a batch reduce mapping
-                # each batch is at least 2 intermediate answers and maxes at
-                # batch_tkn_size tokens to avoid losing anything because of
-                # the context
-                all_intermediate_answers = [output["intermediate_answers"]]
-                batch_tkn_size = 1000
-                max_batch_size = 10
+                # combine what remains of each level of the tree, each
+                # batch being at least 2 intermediate answers and at most
+                # combine_tkn_budget tokens
                 pbar = tqdm(
                     desc="Combining answers",
-                    unit="answer",
-                    total=len(output["intermediate_answers"]),
+                    unit="batch",
+                    total=0,
                     # disable=not is_verbose,
                 )
-                temp_interm_answ = output["intermediate_answers"]
-                while True:
-                    batches = [[]]
-                    for ia in temp_interm_answ:
-                        if not check_intermediate_answer(ia):
-                            # disregard IRRELEVANT answers
-                            continue
-                        if len(batches[-1]) < 2:
-                            # make sure there's at least 2 per batch
-                            batches[-1].append(ia)
-                        elif len(batches[-1]) > max_batch_size:
-                            # make sure there's not too many intermediate answers
-                            batches.append([ia])
-                        elif sum([get_tkn_length(b) for b in batches[-1]]) >= batch_tkn_size:
-                            # cap batch size to the max tkn size
-                            batches.append([ia])
-                        else:
-                            batches[-1].append(ia)
-                    batch_args = [
-                        {
-                            "question_to_answer": query_an,
-                            "intermediate_answers": b
-                        } for b in batches
-                    ]
-                    temp_interm_answ = [
+
+                @optional_typecheck
+                def combine_batches(batches: List[List[str]]) -> List[str]:
+                    pbar.total += len(batches)
+                    pbar.refresh()
+                    combined = [
                         a["final_answer"]
-                        for a in final_answer_chain.batch(batch_args)
+                        for a in final_answer_chain.batch(
+                            [
+                                {
+                                    "question_to_answer": query_an,
+                                    "intermediate_answers": b,
+                                } for b in batches
+                            ],
+                            config=multi,
+                        )
                     ]
-                    all_intermediate_answers.append(temp_interm_answ)
-                    pbar.n = pbar.total - len(temp_interm_answ) + 1
-                    if len(temp_interm_answ) == 1:
-                        break
+                    pbar.update(len(batches))
+                    return combined
 
-                assert pbar.n == pbar.total
+                final_answer = combine_tree.finish(combine_batches)
                 pbar.close()
-                assert len(all_intermediate_answers[-1]) == 1
+                output["combine_rounds"] = combine_tree.combine_rounds
+                output["combine_fan_in"] = fan_in
+                all_intermediate_answers = [output["intermediate_answers"]] + combine_tree.combined_answers
+                assert all_intermediate_answers[-1] == [final_answer]
 
-                final_answer = all_intermediate_answers[-1][0]
                 output["all_intermediate_answers"] = all_intermediate_answers
             else:
                 final_answer = output["intermediate_answers"][0]
                 output["all_intermediate_answers"] = [final_answer]
+                output["combine_rounds"] = []
+                output["combine_fan_in"] = None
                 source_replace = lambda input: input
                 all_intermediate_answers = [final_answer]
 
@@ -1768,6 +2148,12 @@ class WDoc:
                 f"Number of documents after query eval filter: {len(output['filtered_docs'])}")
             red(
                 f"Number of documents found relevant by eval llm: {len(output['relevant_filtered_docs'])}")
+            red(f"Number of calls to the query eval LLM: {eval_stats['calls']}")
+            if self.query_eval_cascade is not None:
+                red(
+                    "Number of documents decided by the embedding score cascade "
+                    f"without calling the eval LLM: {output['n_eval_saved_by_cascade']} "
+                    f"(accepted: {eval_stats['cascade_accepted']}, rejected: {eval_stats['cascade_rejected']})")
             if len(all_intermediate_answers) > 1:
                 extra = '->'.join(
                     [str(len(ia)) for ia in all_intermediate_answers]
@@ -1783,6 +2169,9 @@ class WDoc:
                 self.llm_price[1] * llmcallback.completion_tokens
             yel(
                 f"Tokens used by strong model: '{llmcallback.total_tokens}' (${total_cost:.5f})")
+            if llmcallback.compression_saved_tokens:
+                yel(f"Tokens removed by the compression before calling the strong model: {llmcallback.compression_saved_tokens}")
+            output["compression_saved_tokens"] = llmcallback.compression_saved_tokens
             if "cost_before_combine" in locals():
                 combine_cost = total_cost - cost_before_combine
                 yel(f"Tokens used by strong model to combine the intermediate answers: ${combine_cost:.5f}")
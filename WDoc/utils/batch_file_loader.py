@@ -6,28 +6,39 @@ This list is then processed in loaders.py, multithreading or multiprocessing
 is used.
 """
 
-from collections import Counter
+from collections import Counter, deque
+import multiprocessing
+import multiprocessing.connection
+import pickle
+import queue
+import threading
 import shutil
+import signal
 import uuid
+import zlib
 import re
 import sys
 from tqdm import tqdm
 from functools import cache as memoizer
 import time
-from typing import List, Tuple, Union, Optional
+from typing import List, Tuple, Union, Optional, Generator, Any
+import os
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import random
 
 from langchain.docstore.document import Document
 from joblib import Parallel, delayed
+from joblib import hash as jhash
 from pathlib import Path, PosixPath
 import json
 import rtoml
 import dill
 
-from .misc import doc_loaders_cache, file_hasher, min_token, get_tkn_length, unlazyload_modules, cache_dir, DocDict
+from .misc import doc_loaders_cache, batch_file_hasher, min_token, get_docs_tkn_length, unlazyload_modules, cache_dir, DocDict, file_stats_cache
 from .typechecker import optional_typecheck
 from .logger import red, whi, logger
-from .loaders import load_one_doc_wrapped, yt_link_regex, load_youtube_playlist, markdownlink_regex, loaders_temp_dir_file
+from .loaders import load_one_doc_wrapped, get_process_context, yt_link_regex, load_youtube_playlist, markdownlink_regex, loaders_temp_dir_file, uncached_filetypes
 from .flags import is_debug, is_verbose
 from .env import WDOC_MAX_LOADER_TIMEOUT
 
@@ -56,6 +67,30 @@ inference_rules = {
     "toml_entries": [".*.toml"],
 }
 
+# pool used for each filetype when the backend is "hybrid": processes for
+# the filetypes whose loading is CPU bound parsing, threads for those
+# that mostly wait on the network or on the disk
+hybrid_backends = {
+    "pdf": "loky",
+    "epub": "loky",
+    "word": "loky",
+    "powerpoint": "loky",
+    "local_html": "loky",
+    "logseq_markdown": "loky",
+
+    "url": "threading",
+    "online_pdf": "threading",
+    "youtube": "threading",
+    "online_media": "threading",
+    "local_audio": "threading",
+    "local_video": "threading",
+    "anki": "threading",
+    "txt": "threading",
+    "text": "threading",
+    "string": "threading",
+    "json_dict": "threading",
+}
+
 recursive_types = [
     "recursive_paths",
     "json_entries",
@@ -78,6 +113,7 @@ def batch_load_doc(
     task: str,
     backend: str,
     n_jobs: int,
+    resume: bool = False,
     **cli_kwargs) -> List[Document]:
     """load the input"""
 
@@ -87,19 +123,56 @@ def batch_load_doc(
     if "path" in cli_kwargs and isinstance(cli_kwargs["path"], str):
         cli_kwargs["path"] = cli_kwargs["path"].strip()
 
-    # expand the list of document to load as long as there are recursive types
-    to_load = [cli_kwargs.copy()]
-    to_load[-1]["filetype"] = filetype.lower()
-    new_doc_to_load = []
-    while any(d["filetype"] in recursive_types for d in to_load):
-        for ild, load_kwargs in enumerate(to_load):
-            to_load[ild]["filetype"] = to_load[ild]["filetype"].lower()
-            if not ("path" in load_kwargs and load_kwargs["path"]):
-                continue
+    # expand the recursive types breadth first: the items of each level are
+    # expanded in parallel threads and the documents are deduplicated as
+    # they come
+    to_load = []
+    seen = set()
+    all_unexp_keys = set()
+    level = [cli_kwargs.copy()]
+    level[-1]["filetype"] = filetype.lower()
+
+    def expand(items: List[Tuple[str, dict]]) -> Generator[Union[DocDict, dict], None, None]:
+        "yield the children of the recursive items as the parsers produce them"
+        if len(items) == 1:
+            load_filetype, load_kwargs = items[0]
+            yield from recursive_parsers[load_filetype](cli_kwargs=cli_kwargs, **load_kwargs)
+            return
+
+        children = queue.Queue()
+        done = object()
+
+        def produce(item: Tuple[str, dict]) -> None:
+            load_filetype, load_kwargs = item
+            try:
+                for child in recursive_parsers[load_filetype](cli_kwargs=cli_kwargs, **load_kwargs):
+                    children.put(child)
+            except Exception as err:
+                children.put((done, err))
+            else:
+                children.put((done, None))
+
+        with ThreadPoolExecutor(max_workers=min(len(items), 8)) as executor:
+            for item in items:
+                executor.submit(produce, item)
+            n_done = 0
+            while n_done < len(items):
+                child = children.get()
+                if isinstance(child, tuple) and child and child[0] is done:
+                    n_done += 1
+                    if child[1] is not None:
+                        raise child[1]
+                    continue
+                yield child
+
+    while level:
+        to_expand = []
+        for load_kwargs in level:
+            load_kwargs["filetype"] = load_kwargs["filetype"].lower()
             load_filetype = load_kwargs["filetype"]
 
             # auto parse filetype if infer
-            if load_filetype == "auto":
+            if load_filetype == "auto" and "path" in load_kwargs and load_kwargs["path"]:
                 for k, v in inference_rules.items():
                     for vv in inference_rules[k]:
                         if vv.search(load_kwargs["path"]):
@@ -111,105 +184,44 @@ def batch_load_doc(
                     load_filetype != "auto"
                 ), f"Could not infer load_filetype of {load_kwargs['path']}. Use the 'load_filetype' argument."
                 if load_filetype not in recursive_types:
-                    to_load[ild]["filetype"] = load_filetype
+                    load_kwargs["filetype"] = load_filetype
 
-            if load_filetype not in recursive_types:
+            if load_filetype in recursive_types and "path" in load_kwargs and load_kwargs["path"]:
+                del load_kwargs["filetype"]
+                to_expand.append((load_filetype, load_kwargs))
                 continue
-            del load_kwargs["filetype"]
-
-            if load_filetype == "recursive_paths":
-                new_doc_to_load.extend(
-                    parse_recursive_paths(
-                        cli_kwargs=cli_kwargs,
-                        **load_kwargs
-                    )
-                )
-                break
 
-            elif load_filetype == "json_entries":
-                new_doc_to_load.extend(
-                    parse_json_entries(cli_kwargs=cli_kwargs, **load_kwargs)
-                )
-                break
+            try:
+                doc = load_kwargs if isinstance(load_kwargs, DocDict) else DocDict(load_kwargs)
+            except Exception as err:
+                raise Exception(f"Expected to have only DocDict at this point: {err}'")
 
-            elif load_filetype == "toml_entries":
-                new_doc_to_load.extend(
-                    parse_toml_entries(cli_kwargs=cli_kwargs, **load_kwargs)
-                )
-                break
+            # remove the keys that are not relevant to doc loading, because
+            # they would skip the cache and hide duplicates
+            for k in [k for k in doc if k not in DocDict.allowed_keys]:
+                all_unexp_keys.add(k)
+                del doc[k]
+                assert k not in ["include", "exclude"], "Include or exclude arguments should be reomved at this point"
 
-            elif load_filetype == "link_file":
-                new_doc_to_load.extend(
-                    parse_link_file(
-                        cli_kwargs=cli_kwargs,
-                        **load_kwargs,
-                    )
-                )
-                break
-
-            elif load_filetype == "youtube_playlist":
-                new_doc_to_load.extend(
-                    parse_youtube_playlist(
-                        cli_kwargs=cli_kwargs,
-                        **load_kwargs
-                    )
-                )
-                break
-
-        if new_doc_to_load:
-            assert load_filetype in recursive_types
-            to_load.remove(to_load[ild])
-            to_load.extend(new_doc_to_load)
-            new_doc_to_load = []
-            continue
-
-    try:
-        to_load = [
-            d if isinstance(d, DocDict) else DocDict(d)
-            for d in to_load
-        ]
-    except Exception as err:
-        raise Exception(f"Expected to have only DocDict at this point: {err}'")
+            if doc in seen:
+                red(f"Removed document {doc} (duplicate)")
+                continue
+            seen.add(doc)
+            to_load.append(doc)
 
-    # remove duplicate documents
-    temp = []
-    for d in to_load:
-        if d in temp:
-            red(f"Removed document {d} (duplicate)")
-        else:
-            temp.append(d)
-    to_load = temp
+        level = expand(to_expand) if to_expand else []
+    del seen
 
     assert to_load, f"empty list of documents to load from filetype '{filetype}'"
 
-    # look for unexpected keys that are not relevant to doc loading, because that would
-    # skip the cache
-    all_unexp_keys = set()
-    for doc in to_load:
-        to_del = [k for k in doc if k not in DocDict.allowed_keys]
-        for k in to_del:
-            all_unexp_keys.add(k)
-            del doc[k]
-            assert k not in ["include", "exclude"], "Include or exclude arguments should be reomved at this point"
-
     if "summar" not in task:
         # shuffle the list of files to load to make
         # the hashing progress bar more representative
-        to_load = sorted(to_load, key=lambda x: random.random())
-
-    # store the file hash in the doc kwarg
-    doc_hashes = Parallel(
-        n_jobs=-1,
-        backend=backend,
-        verbose=0 if not is_verbose else 51,
-    )(delayed(file_hasher)(doc=doc) for doc in tqdm(
-      to_load,
-      desc="Hashing files",
-      unit="doc",
-      colour="magenta",
-      disable=len(to_load) <= 10_000,
-      )
-    )
+        random.shuffle(to_load)
+
+    # store the file hash in the doc kwarg, only the new or modified
+    # files are actually hashed
+    doc_hashes = batch_file_hasher(to_load)
     for i, h in enumerate(doc_hashes):
         to_load[i]["file_hash"] = doc_hashes[i]
 
@@ -220,20 +232,17 @@ def batch_load_doc(
         # sorted by increasing order of filetype frequency, so if there's
         # an error with the code of this filetype of its args the user knows
         # it quickly instead of after waiting a super long time
-        bins = {}
-        for d in to_load:
-            if d["filetype"] not in bins:
-                bins[d["filetype"]] = 1
-            else:
-                bins[d["filetype"]] += 1
-        sorted_filetypes = sorted(bins.keys(), key=lambda x: bins[x])
+        bins = Counter(d["filetype"] for d in to_load)
+        filetype_rank = {
+            ft: i for i, ft in enumerate(sorted(bins.keys(), key=lambda x: bins[x]))
+        }
 
         @optional_typecheck
         def deterministic_sorter(doc_dict: DocDict) -> int:
             h = doc_dict["file_hash"]
             h2 = ''.join(filter(str.isdigit, h))
             h_ints = int(h2) if h2.isdigit() else int(random.random() * 1000)
-            h_ordered = h_ints * (10 ** (sorted_filetypes.index(doc_dict["filetype"]) + 1))
+            h_ordered = h_ints * (10 ** (filetype_rank[doc_dict["filetype"]] + 1))
             return h_ordered
 
         to_load = sorted(
@@ -252,61 +261,181 @@ def batch_load_doc(
                     to_load[idoc]["load_functions"] = parse_load_functions(
                         tuple(doc["load_functions"]))
 
-    to_load = list(set(to_load))  # remove duplicates docdicts
-
     if len(to_load) > 1:
         for tl in to_load:
             assert tl["filetype"] != "string", "You shouldn't not be using filetype 'string' with other kind of documents normally. Please open an issue on github and explain me your usecase to see how I can fix that for you!"
 
     # dir name where to store temporary files
     load_temp_name = "file_load_" + str(uuid.uuid4())
-    # delete previous temp dir if it's several days old
-    for f in cache_dir.iterdir():
+    # delete previous temp dir and journals if they're several days old
+    journals_dir = cache_dir / "load_journals"
+    journals_dir.mkdir(exist_ok=True)
+    for f in list(cache_dir.iterdir()) + list(journals_dir.iterdir()):
         f = f.resolve()
-        if f.is_dir() and f.name.startswith("file_load_") and (abs(time.time() - f.stat().st_mtime) > 2 * 86400):
+        if not f.is_dir():
+            continue
+        if f.name.startswith("file_load_"):
+            max_age = 2 * 86400
+        elif f.parent == journals_dir.resolve():
+            max_age = 7 * 86400
+        else:
+            continue
+        if abs(time.time() - f.stat().st_mtime) > max_age:
             assert str(cache_dir.absolute()) in str(f.absolute())
             shutil.rmtree(f)
+
+    # the documents of uncached_filetypes are spooled to a journal on disk
+    # as soon as they are loaded, so that a crashed or interrupted run can be
+    # resumed. The other documents are kept in memory: the loader cache
+    # already stores them, so resuming gets them from it. Each run writes to
+    # its own journal, so that identical runs at the same time don't
+    # overwrite or delete each other's
+    doc_keys = [jhash(dict(d)) for d in to_load]
+    run_id = jhash([llm_name, task, sorted(doc_keys)])
+    journal_dir = journals_dir / f"{run_id}_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+    if resume:
+        # take over the most recent journal of the same run. The rename is
+        # atomic so a journal can't be taken over by two runs
+        previous = sorted(
+            journals_dir.glob(f"{run_id}_*"),
+            key=lambda x: x.stat().st_mtime,
+            reverse=True,
+        )
+        for prev in previous:
+            try:
+                prev.rename(journal_dir)
+                break
+            except OSError:
+                continue
+        else:
+            red("Resuming: no journal found for those documents")
+    journal_paths = [journal_dir / f"{k}.pkl" for k in doc_keys]
+    to_run = [i for i, jp in enumerate(journal_paths) if not jp.exists()]
+    if any(to_load[i]["filetype"] in uncached_filetypes for i in to_run):
+        journal_dir.mkdir(exist_ok=True)
+    if resume:
+        red(f"Resuming: {len(to_load) - len(to_run)}/{len(to_load)} documents were already loaded")
+
     temp_dir = cache_dir / load_temp_name
     temp_dir.mkdir(exist_ok=False)
     loaders_temp_dir_file.write_text(str(temp_dir.absolute().resolve()))
 
     loader_max_timeout = WDOC_MAX_LOADER_TIMEOUT
 
-    docs = []
     t_load = time.time()
-    if len(to_load) == 1:
+    if len(to_run) <= 1:
         n_jobs = 1
-    doc_lists = Parallel(
-        n_jobs=n_jobs,
-        backend=backend,
-        verbose=0 if not is_verbose else 51,
-        timeout=loader_max_timeout,
-    )(delayed(load_one_doc_wrapped)(
-        llm_name=llm_name,
-        task=task,
-        temp_dir=temp_dir,
-        **d,
-    ) for d in tqdm(
-        to_load,
-        desc="Loading",
-        unit="doc",
-        colour="magenta",
-    )
-    )
 
-    # erases content that links to the loaders temporary files at startup
-    loaders_temp_dir_file.write_text("")
+    @optional_typecheck
+    def run_loaders(indices: List[int], n_jobs: int, backend: str, desc: str = "Loading") -> Generator[Tuple[int, Union[List[Document], str]], None, None]:
+        if backend in ["loky", "multiprocessing", "threading"] and n_jobs != 1:
+            # each document gets its own deadline, in its own process or
+            # thread
+            imap = watchdog_imap if backend != "threading" else thread_imap
+            for j, out in imap(
+                tasks=[
+                    dict(llm_name=llm_name, task=task, temp_dir=temp_dir, **to_load[i])
+                    for i in indices
+                ],
+                n_jobs=n_jobs,
+                timeout=loader_max_timeout,
+                desc=desc,
+            ):
+                yield indices[j], out
+            return
+        # loaded one at a time in the main thread, where the signal based
+        # timeouts of the pdf loaders work, and without loader timeout
+        outputs = Parallel(
+            n_jobs=n_jobs,
+            backend=backend,
+            verbose=0 if not is_verbose else 51,
+            return_as="generator",
+        )(delayed(load_one_doc_wrapped)(
+            llm_name=llm_name,
+            task=task,
+            temp_dir=temp_dir,
+            **to_load[i],
+        ) for i in tqdm(
+            indices,
+            desc=desc,
+            unit="doc",
+            colour="magenta",
+        )
+        )
+        yield from zip(indices, outputs)
+
+    errors = {}
+    loaded = {}
+
+    def spool(i: int, out: Union[List[Document], str]) -> None:
+        if isinstance(out, list):
+            if to_load[i]["filetype"] in uncached_filetypes:
+                write_journal_entry(journal_paths[i], out)
+            else:
+                loaded[i] = out
+        else:
+            assert isinstance(out, str)
+            errors[i] = out
+
+    try:
+        if backend == "hybrid" and len(to_run) > 1:
+            # CPU bound filetypes are loaded in processes, at most one per
+            # core, while the others are loaded at the same time in threads
+            groups = {"loky": [], "threading": []}
+            for i in to_run:
+                groups[hybrid_backends.get(to_load[i]["filetype"], "threading")].append(i)
+            groups_n_jobs = {
+                "loky": min(n_jobs, os.cpu_count() or 1) if n_jobs > 0 else n_jobs,
+                "threading": n_jobs,
+            }
+
+            def run_group(b: str) -> None:
+                for i, out in run_loaders(
+                    groups[b],
+                    groups_n_jobs[b],
+                    b,
+                    f"Loading ({'processes' if b == 'loky' else 'threads'})",
+                ):
+                    spool(i, out)
+
+            with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+                futures = [
+                    executor.submit(run_group, b)
+                    for b, indices in groups.items() if indices
+                ]
+                for future in futures:
+                    future.result()
+        elif to_run:
+            for i, out in run_loaders(
+                to_run,
+                n_jobs,
+                backend if backend != "hybrid" else "threading",
+            ):
+                spool(i, out)
+    except (Exception, KeyboardInterrupt):
+        n_done = len(loaded) + sum(jp.exists() for jp in journal_paths)
+        red(
+            f"Loading stopped with {n_done}/{len(to_load)} documents "
+            "loaded. Run again with --resume to only load the remaining ones."
+        )
+        raise
+    finally:
+        # erases content that links to the loaders temporary files at startup
+        loaders_temp_dir_file.write_text("")
+        # delete temp dir
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
     red(f"Done loading all {len(to_load)} documents in {time.time()-t_load:.2f}s")
+    docs = []
     missing_docargs = []
-    for idoc, d in tqdm(enumerate(doc_lists), total=len(doc_lists), desc="Concatenating results", disable=not is_verbose):
-        if isinstance(d, list):
-            docs.extend(d)
-        else:
-            assert isinstance(d, str)
+    for idoc, jp in tqdm(enumerate(journal_paths), total=len(journal_paths), desc="Reading the loaded documents", disable=not is_verbose):
+        if idoc in errors:
             missing_docargs.append(dict(to_load[idoc]))  # must be cast as dict to set error message
-            missing_docargs[-1]["error_message"] = d
-    assert not any(isinstance(d, str) for d in docs)
+            missing_docargs[-1]["error_message"] = errors[idoc]
+        elif idoc in loaded:
+            docs.extend(loaded.pop(idoc))
+        else:
+            docs.extend(read_journal_entry(jp))
 
     if missing_docargs:
         missing_docargs = sorted(missing_docargs, key=lambda x: json.dumps(x))
@@ -332,24 +461,331 @@ def batch_load_doc(
 
     assert docs, "No documents were succesfully loaded!"
 
-    size = sum(
-        [
-            get_tkn_length(d.page_content)
-            for d in docs
-        ]
-    )
+    size = sum(get_docs_tkn_length(docs))
     if size <= min_token:
         raise Exception(
             f"The number of token is {size} <= {min_token} tokens, probably something went wrong?"
         )
 
-    # delete temp dir
-    shutil.rmtree(temp_dir)
-    assert not temp_dir.exists()
+    # the run is complete, its journal is not needed anymore
+    shutil.rmtree(journal_dir, ignore_errors=True)
 
     return docs
 
 
+@optional_typecheck
+def write_journal_entry(path: PosixPath, docs: List[Document]) -> None:
+    "spool the documents loaded from one document to the run journal"
+    data = zlib.compress(
+        pickle.dumps(
+            [(d.page_content, d.metadata) for d in docs],
+            protocol=pickle.HIGHEST_PROTOCOL,
+        ),
+        level=1,
+    )
+    # written to a temporary file first so that an interrupted
+    # write can't be mistaken for a loaded document when resuming
+    tmp = path.with_suffix(f".tmp{uuid.uuid4().hex[:8]}")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+@optional_typecheck
+def read_journal_entry(path: PosixPath) -> List[Document]:
+    "read back the documents spooled by write_journal_entry"
+    return [
+        Document(page_content=content, metadata=metadata)
+        for content, metadata in pickle.loads(zlib.decompress(path.read_bytes()))
+    ]
+
+
+def _terminate_children(signum: int, frame: Any) -> None:
+    """SIGTERM handler of the watchdog workers: the processes they started,
+    like the pdf parser race or the page range pool, are terminated too
+    instead of being orphaned"""
+    children = multiprocessing.active_children()
+    for child in children:
+        child.terminate()
+    for child in children:
+        child.join(1)
+        if child.is_alive():
+            child.kill()
+    # os._exit skips the atexit handler of multiprocessing, which would
+    # wait for the non daemonic children
+    os._exit(1)
+
+
+def _watchdog_worker(conn: Any) -> None:
+    "loop of a worker process of watchdog_imap, loading one document at a time"
+    signal.signal(signal.SIGTERM, _terminate_children)
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        try:
+            conn.send(("ok", load_one_doc_wrapped(**task)))
+        except Exception as err:
+            # loading_failure is 'crash'
+            conn.send(("crash", str(err)))
+
+
+@optional_typecheck
+def watchdog_imap(
+    tasks: List[dict],
+    n_jobs: int,
+    timeout: Optional[int],
+    desc: str = "Loading",
+) -> Generator[Tuple[int, Union[List[Document], str]], None, None]:
+    """call load_one_doc_wrapped on each task in a pool of n_jobs worker
+    processes and yield (task index, output) as soon as each one is done.
+    A worker still loading a document after timeout seconds is killed and
+    replaced: only this document fails, according to its loading_failure
+    policy, while the other workers keep going. A timeout of None means no
+    limit."""
+    ctx = get_process_context()
+    if n_jobs < 0:
+        n_jobs = os.cpu_count() or 1
+    n_jobs = min(n_jobs, len(tasks))
+    pending = deque(range(len(tasks)))
+    idle = []  # (process, connection)
+    busy = {}  # connection -> (process, task index, start time)
+
+    def start_worker() -> Tuple[Any, Any]:
+        conn, child_conn = ctx.Pipe()
+        proc = ctx.Process(target=_watchdog_worker, args=(child_conn,))
+        proc.start()
+        child_conn.close()
+        return proc, conn
+
+    def stop_worker(proc: Any, conn: Any) -> None:
+        conn.close()
+        proc.terminate()
+        proc.join(5)
+        if proc.is_alive():
+            proc.kill()
+            proc.join()
+
+    def fail(i: int, message: str) -> str:
+        red(f"Error when loading doc with filetype {tasks[i]['filetype']}: '{message}'. Arguments: {tasks[i]}")
+        if tasks[i].get("loading_failure", "warn") == "crash":
+            raise Exception(message)
+        return message
+
+    pbar = tqdm(total=len(tasks), desc=desc, unit="doc", colour="magenta")
+    try:
+        idle = [start_worker() for _ in range(n_jobs)]
+        while pending or busy:
+            while pending and idle:
+                proc, conn = idle.pop()
+                i = pending.popleft()
+                conn.send(tasks[i])
+                busy[conn] = (proc, i, time.time())
+
+            if timeout is None:
+                wait_timeout = None
+            else:
+                deadline = min(t for _, _, t in busy.values()) + timeout
+                wait_timeout = max(0, deadline - time.time())
+            ready = multiprocessing.connection.wait(
+                list(busy.keys()),
+                timeout=wait_timeout,
+            )
+            for conn in ready:
+                proc, i, _ = busy.pop(conn)
+                pbar.update(1)
+                try:
+                    status, out = conn.recv()
+                except EOFError:
+                    # the worker died, for example a segfault in a parser
+                    stop_worker(proc, conn)
+                    idle.append(start_worker())
+                    yield i, fail(i, f"The loading process died with exit code {proc.exitcode}")
+                    continue
+                idle.append((proc, conn))
+                if status == "crash":
+                    raise Exception(out)
+                yield i, out
+
+            if timeout is None:
+                continue
+            now = time.time()
+            for conn, (proc, i, t) in list(busy.items()):
+                if now - t >= timeout:
+                    del busy[conn]
+                    pbar.update(1)
+                    stop_worker(proc, conn)
+                    idle.append(start_worker())
+                    yield i, fail(i, f"Loading took more than {timeout}s so its process was killed")
+    finally:
+        pbar.close()
+        for proc, conn in idle + [(proc, conn) for conn, (proc, _, _) in busy.items()]:
+            stop_worker(proc, conn)
+
+
+@optional_typecheck
+def thread_imap(
+    tasks: List[dict],
+    n_jobs: int,
+    timeout: Optional[int],
+    desc: str = "Loading",
+) -> Generator[Tuple[int, Union[List[Document], str]], None, None]:
+    """same as watchdog_imap but each document is loaded in its own thread,
+    at most n_jobs at a time. A thread can't be killed: a document still
+    loading after timeout seconds fails, according to its loading_failure
+    policy, and its thread is left running in the background while
+    another document takes its place. The threads are daemonic so that
+    a stuck one can't prevent exiting."""
+    if n_jobs < 0:
+        n_jobs = os.cpu_count() or 1
+    pending = deque(range(len(tasks)))
+    running = {}  # task index -> start time
+    results = queue.Queue()
+
+    def run(i: int) -> None:
+        try:
+            results.put((i, "ok", load_one_doc_wrapped(**tasks[i])))
+        except Exception as err:
+            # loading_failure is 'crash'
+            results.put((i, "crash", err))
+
+    def fail(i: int, message: str) -> str:
+        red(f"Error when loading doc with filetype {tasks[i]['filetype']}: '{message}'. Arguments: {tasks[i]}")
+        if tasks[i].get("loading_failure", "warn") == "crash":
+            raise Exception(message)
+        return message
+
+    pbar = tqdm(total=len(tasks), desc=desc, unit="doc", colour="magenta")
+    try:
+        while pending or running:
+            while pending and len(running) < n_jobs:
+                i = pending.popleft()
+                running[i] = time.time()
+                threading.Thread(target=run, args=(i,), daemon=True).start()
+
+            wait_timeout = None
+            if timeout is not None:
+                wait_timeout = max(0, min(running.values()) + timeout - time.time())
+            try:
+                i, status, out = results.get(timeout=wait_timeout)
+            except queue.Empty:
+                pass
+            else:
+                # a late result of a document that already timed out is dropped
+                if i in running:
+                    del running[i]
+                    pbar.update(1)
+                    if status == "crash":
+                        raise out
+                    yield i, out
+
+            if timeout is None:
+                continue
+            now = time.time()
+            for i, t in list(running.items()):
+                if now - t >= timeout:
+                    del running[i]
+                    pbar.update(1)
+                    yield i, fail(i, f"Loading took more than {timeout}s, its thread was abandoned")
+    finally:
+        pbar.close()
+
+
+@optional_typecheck
+def compile_path_regex(pattern: Union[str, re.Pattern]) -> re.Pattern:
+    "case insensitive if the pattern is all lowercase"
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    if pattern == pattern.lower():
+        return re.compile(pattern, flags=re.IGNORECASE)
+    return re.compile(pattern)
+
+
+@optional_typecheck
+def walk_files(
+    root: str,
+    pattern: str,
+    prune: List[re.Pattern],
+    n_threads: int = 8,
+) -> Generator[os.DirEntry, None, None]:
+    """yield the files below root whose name (or relative path if the pattern
+    contains a '/') match the glob pattern, like Path.rglob. Each directory is
+    read by os.scandir in a thread pool and the directories matching a regex
+    of prune are not descended into. Symlinks to directories are not
+    followed."""
+    match_path = "/" in pattern
+    # rglob(pattern) is glob("**/" + pattern)
+    pattern_parts = ["**"]
+    for part in pattern.split("/"):
+        if part and not (part == "**" and pattern_parts[-1] == "**"):
+            pattern_parts.append(part)
+
+    def scan(dirpath: str) -> Tuple[List[os.DirEntry], List[str]]:
+        files, subdirs = [], []
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not any(r.search(entry.path + os.sep) for r in prune):
+                                subdirs.append(entry.path)
+                        elif entry.is_file():
+                            if match_path:
+                                if match_glob_parts(
+                                        os.path.relpath(entry.path, root).split(os.sep),
+                                        pattern_parts):
+                                    files.append(entry)
+                            elif fnmatch.fnmatchcase(entry.name, pattern):
+                                files.append(entry)
+                    except OSError:
+                        continue
+        except OSError as err:
+            red(f"Could not read directory '{dirpath}': {err}")
+        return files, subdirs
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        pending = {executor.submit(scan, root)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                for d in subdirs:
+                    pending.add(executor.submit(scan, d))
+                yield from files
+
+
+def match_glob_parts(parts: List[str], pattern_parts: List[str]) -> bool:
+    """True if the path parts match the glob pattern parts, where '**'
+    matches any number of directories, including none"""
+    # matched[j] is True if the parts seen so far match pattern_parts[:j]
+    matched = [True] + [False] * len(pattern_parts)
+    for j, pp in enumerate(pattern_parts):
+        if pp == "**":
+            matched[j + 1] = matched[j]
+    for part in parts:
+        new = [False] * (len(pattern_parts) + 1)
+        for j, pp in enumerate(pattern_parts):
+            if pp == "**":
+                new[j + 1] = new[j] or matched[j + 1] or matched[j]
+            else:
+                new[j + 1] = matched[j] and fnmatch.fnmatchcase(part, pp)
+        matched = new
+    return matched[-1]
+
+
+@optional_typecheck
+def is_prunable(regex: re.Pattern) -> bool:
+    """True if a regex matching a directory path followed by a separator is
+    sure to also match all the paths inside this directory, i.e. if it has
+    no anchor or lookahead on what comes after the match"""
+    return not any(
+        token in regex.pattern
+        for token in ["$", r"\Z", "(?=", "(?!"]
+    )
+
+
 @optional_typecheck
 def parse_recursive_paths(
     cli_kwargs: dict,
@@ -359,7 +795,7 @@ def parse_recursive_paths(
     include: Optional[List[str]] = None,
     exclude: Optional[List[str]] = None,
     **extra_args,
-) -> List[Union[DocDict, dict]]:
+) -> Generator[Union[DocDict, dict], None, None]:
     whi(f"Parsing recursive load_filetype: '{path}'")
     assert (
         recursed_filetype
@@ -371,56 +807,66 @@ def parse_recursive_paths(
         ]
     ), "'recursed_filetype' cannot be 'recursive_paths', 'json_entries', 'anki' or 'youtube'"
 
+    path = str(path)
     if not Path(path).exists() and Path(path.replace(r"\ ", " ")).exists():
         logger.info(r"File was not found so replaced '\ ' by ' '")
         path = path.replace(r"\ ", " ")
-    assert Path(path).exists, f"not found: {path}"
-    doclist = [p for p in Path(path).rglob(pattern)]
-    assert doclist, f"No document found by pattern {pattern}"
-    doclist = [str(p).strip() for p in doclist if p.is_file()]
-    assert doclist, "No document after filtering by file"
-    doclist = [p for p in doclist if p]
-    assert doclist, "No document after removing nonemtpy"
-    doclist = [
-        p[1:].strip() if p.startswith("-") else p.strip() for p in doclist
-    ]
+    assert Path(path).exists(), f"not found: {path}"
+
+    include = [compile_path_regex(inc) for inc in include] if include else []
+    exclude = [compile_path_regex(exc) for exc in exclude] if exclude else []
+    # the excluded directories are not walked at all
+    prune = [exc for exc in exclude if is_prunable(exc)]
+    resolved_root = str(Path(path).resolve().absolute())
+
+    n_found = 0
+    n_yielded = 0
+    for entry in walk_files(path, pattern, prune):
+        n_found += 1
+        d = entry.path.strip()
+        if d.startswith("-"):
+            d = d[1:].strip()
+        if not d:
+            continue
+        if not all(inc.search(d) for inc in include):
+            continue
+        if any(exc.search(d) for exc in exclude):
+            continue
 
-    if include:
-        for i, d in enumerate(doclist):
-            keep = True
-            for iinc, inc in enumerate(include):
-                if isinstance(inc, str):
-                    if inc == inc.lower():
-                        inc = re.compile(inc, flags=re.IGNORECASE)
-                    else:
-                        inc = re.compile(inc)
-                    include[iinc] = inc
-                if not inc.search(d):
-                    keep = False
-            if not keep:
-                doclist[i] = None
-        doclist = [d for d in doclist if d]
-
-    if exclude:
-        for iexc, exc in enumerate(exclude):
-            if isinstance(exc, str):
-                if exc == exc.lower():
-                    exc = re.compile(exc, flags=re.IGNORECASE)
-                else:
-                    exc = re.compile(exc)
-                exclude[iexc] = exc
-            doclist = [d for d in doclist if not exc.search(d)]
+        # reuse the stat of the DirEntry when hashing the file
+        try:
+            if entry.is_symlink():
+                abs_path = str(Path(entry.path).resolve().absolute())
+            else:
+                abs_path = os.path.join(resolved_root, os.path.relpath(entry.path, path))
+            file_stats_cache[d] = (abs_path, entry.stat())
+        except OSError:
+            pass
 
-    for i, d in enumerate(doclist):
         doc_kwargs = cli_kwargs.copy()
         doc_kwargs["path"] = d
         doc_kwargs["filetype"] = recursed_filetype
         doc_kwargs.update(extra_args)
+        n_yielded += 1
         if doc_kwargs["filetype"] not in recursive_types:
-            doclist[i] = DocDict(doc_kwargs)
+            yield DocDict(doc_kwargs)
         else:
-            doclist[i] = doc_kwargs
-    return doclist
+            yield doc_kwargs
+
+    assert n_found, f"No document found by pattern {pattern}"
+    assert n_yielded, f"No document left after filtering the {n_found} files found by pattern {pattern}"
+
+
+@optional_typecheck
+def iter_manifest_lines(path: Union[str, PosixPath]) -> Generator[str, None, None]:
+    "read a manifest file line by line, skipping empty and commented lines"
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("-"):
+                line = line[1:].strip()
+            if line and not line.startswith("#"):
+                yield line
 
 
 @optional_typecheck
@@ -428,33 +874,22 @@ def parse_json_entries(
     cli_kwargs: dict,
     path: Union[str, PosixPath],
     **extra_args,
-    ) -> List[Union[DocDict, dict]]:
+    ) -> Generator[Union[DocDict, dict], None, None]:
     whi(f"Loading json_entries: '{path}'")
-    doclist = str(Path(path).read_text()).splitlines()
-    doclist = [
-        p[1:].strip() if p.startswith("-") else p.strip() for p in doclist
-    ]
-    doclist = [
-        p.strip()
-        for p in doclist
-        if p.strip() and not p.strip().startswith("#")
-    ]
-
-    for i, d in enumerate(doclist):
+    for line in iter_manifest_lines(path):
         meta = cli_kwargs.copy()
         meta["filetype"] = "auto"
-        meta.update(json.loads(d.strip()))
-        for k, v in cli_kwargs.copy().items():
+        meta.update(json.loads(line))
+        for k, v in cli_kwargs.items():
             if k not in meta:
                 meta[k] = v
         if meta["path"] == path:
             del meta["path"]
         meta.update(extra_args)
         if meta["filetype"] not in recursive_types:
-            doclist[i] = DocDict(meta)
+            yield DocDict(meta)
         else:
-            doclist[i] = meta
-    return doclist
+            yield meta
 
 
 @optional_typecheck
@@ -493,32 +928,21 @@ def parse_link_file(
     cli_kwargs: dict,
     path: Union[str, PosixPath],
     **extra_args,
-    ) -> List[DocDict]:
+    ) -> Generator[DocDict, None, None]:
     whi(f"Loading link_file: '{path}'")
-    doclist = str(Path(path).read_text()).splitlines()
-    doclist = [
-        p[1:].strip() if p.startswith("-") else p.strip() for p in doclist
-    ]
-    doclist = [
-        p.strip()
-        for p in doclist
-        if p.strip() and not p.strip().startswith("#") and "http" in p
-    ]
-    doclist = [
-        matched.group(0)
-        for d in doclist
-        if (matched := markdownlink_regex.search(d).strip())
-    ]
-
-    for i, d in enumerate(doclist):
+    for line in iter_manifest_lines(path):
+        if "http" not in line:
+            continue
+        # extract the url of markdown links
+        matched = markdownlink_regex.search(line)
+        d = matched.group(1).strip() if matched else line
         assert "http" in d, f"Link does not appear to be a link: '{d}'"
         doc_kwargs = cli_kwargs.copy()
         doc_kwargs["path"] = d
         doc_kwargs["subitem_link"] = d
         doc_kwargs["filetype"] = "auto"
         doc_kwargs.update(extra_args)
-        doclist[i] = DocDict(doc_kwargs)
-    return doclist
+        yield DocDict(doc_kwargs)
 
 
 @optional_typecheck
@@ -553,6 +977,16 @@ def parse_youtube_playlist(
     return doclist
 
 
+# functions used to expand each recursive filetype
+recursive_parsers = {
+    "recursive_paths": parse_recursive_paths,
+    "json_entries": parse_json_entries,
+    "toml_entries": parse_toml_entries,
+    "link_file": parse_link_file,
+    "youtube_playlist": parse_youtube_playlist,
+}
+
+
 @optional_typecheck
 @memoizer
 def parse_load_functions(load_functions: Tuple[str, ...]) -> bytes:
@@ -0,0 +1,135 @@
+"""
+Extractive compression of the text of documents, used to remove
+boilerplate and filler before sending a text to an LLM.
+"""
+
+import re
+from typing import Optional, Any, List
+
+import numpy as np
+
+from .misc import get_tkn_length
+from .embeddings import uncached_embeddings
+from .typechecker import optional_typecheck
+
+# a sentence ends with punctuation followed by a space, or with a newline
+sentence_regex = re.compile(r"(?:[^\n.!?]|[.!?](?![\s\"')\]]|$))+(?:[.!?]+[\"')\]]*|\n+|$)")
+word_regex = re.compile(r"\w+")
+
+# texts with fewer sentences are not compressed
+min_sentences = 5
+
+
+@optional_typecheck
+def split_sentences(text: str) -> List[str]:
+    "split the text in sentences, each keeping the whitespace that follows it"
+    starts = [m.start() for m in sentence_regex.finditer(text) if m.group().strip()]
+    if not starts:
+        return []
+    starts[0] = 0
+    return [text[s:e] for s, e in zip(starts, starts[1:] + [len(text)])]
+
+
+@optional_typecheck
+def textrank_scores(sentences: List[str], damping: float = 0.85, n_iter: int = 50) -> np.ndarray:
+    """score each sentence using TextRank, the similarity between two
+    sentences being their word overlap"""
+    words = [set(word_regex.findall(s.lower())) for s in sentences]
+    n = len(sentences)
+    sim = np.zeros((n, n), dtype=np.float32)
+    for i in range(n):
+        if len(words[i]) < 2:
+            continue
+        for j in range(i + 1, n):
+            if len(words[j]) < 2:
+                continue
+            overlap = len(words[i] & words[j])
+            if overlap:
+                sim[i, j] = sim[j, i] = overlap / (np.log(len(words[i])) + np.log(len(words[j])))
+    return pagerank(sim, damping=damping, n_iter=n_iter)
+
+
+@optional_typecheck
+def centrality_scores(sentences: List[str], embedding_engine: Any) -> np.ndarray:
+    """score each sentence by its summed cosine similarity to all the
+    other sentences, using the embeddings. The sentences are not added to
+    the embeddings cache."""
+    embeds = np.asarray(uncached_embeddings(embedding_engine).embed_documents(sentences), dtype=np.float32)
+    embeds /= np.maximum(np.linalg.norm(embeds, axis=1, keepdims=True), 1e-8)
+    sim = embeds @ embeds.T
+    np.fill_diagonal(sim, 0)
+    return sim.sum(axis=1)
+
+
+@optional_typecheck
+def pagerank(sim: np.ndarray, damping: float = 0.85, n_iter: int = 50) -> np.ndarray:
+    "power iteration over a weighted similarity matrix"
+    n = sim.shape[0]
+    out_weights = sim.sum(axis=1, keepdims=True)
+    # sentences similar to none of the others link to all of them
+    transition = np.where(out_weights > 0, sim / np.maximum(out_weights, 1e-8), 1 / n)
+    scores = np.full(n, 1 / n, dtype=np.float32)
+    for _ in range(n_iter):
+        new_scores = (1 - damping) / n + damping * (transition.T @ scores)
+        if np.abs(new_scores - scores).sum() < 1e-6:
+            return new_scores
+        scores = new_scores
+    return scores
+
+
+@optional_typecheck
+def compress_text(
+    text: str,
+    ratio: float,
+    method: str = "textrank",
+    embedding_engine: Optional[Any] = None,
+    callback: Optional[Any] = None,
+) -> str:
+    """
+    Keep only the most central sentences of the text, in their original
+    order, until reaching ratio times the original number of tokens.
+    Repeated sentences (e.g. page headers) are only kept once.
+    method can be 'textrank' (word overlap, needs no model) or
+    'embeddings' (centrality according to the embedding_engine).
+    If callback is a PriceCountingCallback, the number of tokens removed
+    is added to its compression_saved_tokens.
+    """
+    assert 0 < ratio <= 1, f"Invalid compression ratio: {ratio}"
+    assert method in ["textrank", "embeddings"], f"Invalid compression method: {method}"
+    if ratio == 1:
+        return text
+
+    sentences = split_sentences(text)
+    if len(sentences) < min_sentences:
+        return text
+
+    # deduplicate sentences, keeping the first occurence
+    seen = set()
+    unique = []
+    for i, s in enumerate(sentences):
+        key = s.strip()
+        if key not in seen:
+            seen.add(key)
+            unique.append(i)
+    unique_sentences = [sentences[i] for i in unique]
+
+    if method == "embeddings":
+        assert embedding_engine is not None, "The embeddings compression needs an embedding_engine"
+        scores = centrality_scores(unique_sentences, embedding_engine)
+    else:
+        scores = textrank_scores(unique_sentences)
+
+    lengths = [get_tkn_length(s) for s in unique_sentences]
+    budget = ratio * sum(get_tkn_length(s) for s in sentences)
+    kept = []
+    total = 0
+    for i in np.argsort(-scores, kind="stable"):
+        if kept and total + lengths[i] > budget:
+            continue
+        kept.append(int(i))
+        total += lengths[i]
+    compressed = "".join(unique_sentences[i] for i in sorted(kept))
+
+    if callback is not None:
+        callback.add_compression_saved_tokens(get_tkn_length(text) - get_tkn_length(compressed))
+    return compressed
@@ -0,0 +1,199 @@
+"""
+source : https://api.python.langchain.com/en/latest/_modules/langchain_text_splitters/character.html#RecursiveCharacterTextSplitter
+
+Same splitting logic as RecursiveCharacterTextSplitter (with its default
+keep_separator and strip_whitespace) but the text is tokenized only once:
+the token length of any piece of the text is then found by binary search
+over the character offsets of the tokens instead of encoding the piece
+again at each level of the separator hierarchy. Only the pieces whose
+boundaries fall inside a token are encoded again, so that the lengths, and
+the chunks, are the same as the ones of RecursiveCharacterTextSplitter.
+"""
+
+from bisect import bisect_left
+from collections import deque
+from functools import partial
+from functools import cache as memoize
+from typing import Any, Callable, List, Tuple
+
+import numpy as np
+import tiktoken
+from langchain.text_splitter import TextSplitter
+
+
+def encoded_length(text: str, encoding_name: str) -> int:
+    return len(tiktoken.get_encoding(encoding_name).encode_ordinary(text))
+
+
+@memoize
+def token_byte_lengths(encoding_name: str) -> np.ndarray:
+    "number of utf-8 bytes of each token of the encoding"
+    encoding = tiktoken.get_encoding(encoding_name)
+    lengths = np.zeros(encoding.max_token_value + 1, dtype=np.int64)
+    for token in range(encoding.max_token_value + 1):
+        try:
+            lengths[token] = len(encoding.decode_single_token_bytes(token))
+        except KeyError:
+            pass
+    return lengths
+
+
+class FastRecursiveTextSplitter(TextSplitter):
+    """Recursive text splitter measuring chunks in tokens of a tiktoken
+    encoding, tokenizing each text a single time.
+    The encoding is stored by name so that the splitter stays picklable,
+    and hashable by joblib."""
+
+    def __init__(
+        self,
+        separators: List[str],
+        encoding_name: str,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(
+            length_function=partial(encoded_length, encoding_name=encoding_name),
+            **kwargs,
+        )
+        self._separators = separators
+        self._encoding_name = encoding_name
+
+    def _token_counter(self, text: str) -> Callable[[int, int], int]:
+        "returns a function giving the number of tokens between two character offsets"
+        # a piece is counted once to decide whether to split it, and again
+        # when merging it
+        piece_lengths = {}
+
+        def count_piece(start: int, end: int) -> int:
+            if (start, end) not in piece_lengths:
+                piece_lengths[(start, end)] = self._length_function(text[start:end])
+            return piece_lengths[(start, end)]
+
+        try:
+            raw = np.frombuffer(text.encode("utf-8"), dtype=np.uint8)
+        except UnicodeEncodeError:
+            # lone surrogates: offsets can't be trusted
+            return count_piece
+        encoding = tiktoken.get_encoding(self._encoding_name)
+        tokens = np.array(encoding.encode_ordinary(text), dtype=np.int64)
+        token_bytes = token_byte_lengths(self._encoding_name)[tokens]
+        if token_bytes.sum() != len(raw):
+            return count_piece
+        # the character containing the first byte of each token, like
+        # tiktoken's decode_with_offsets but vectorized
+        is_char_start = (raw & 0xC0) != 0x80
+        char_of_byte = np.cumsum(is_char_start) - 1
+        byte_starts = np.cumsum(token_bytes) - token_bytes
+        offsets = char_of_byte[byte_starts].tolist()
+        # the characters where a token starts, and not in their middle
+        starts = set(char_of_byte[byte_starts[is_char_start[byte_starts]]].tolist())
+        starts.add(len(text))
+
+        def n_tokens(start: int, end: int) -> int:
+            if start in starts and end in starts:
+                return bisect_left(offsets, end) - bisect_left(offsets, start)
+            # a token straddles a boundary of the piece
+            return count_piece(start, end)
+        return n_tokens
+
+    def split_text(self, text: str) -> List[str]:
+        n_tokens = self._token_counter(text)
+        return self._split_spans(text, 0, len(text), self._separators, n_tokens)
+
+    def _split_on(
+        self,
+        text: str,
+        start: int,
+        end: int,
+        separator: str,
+    ) -> List[Tuple[int, int]]:
+        "split the span, each separator being kept at the start of the next piece"
+        if separator == "":
+            return [(i, i + 1) for i in range(start, end)]
+        spans = []
+        prev = start
+        pos = text.find(separator, start, end)
+        while pos != -1:
+            if pos > prev:
+                spans.append((prev, pos))
+            prev = pos
+            pos = text.find(separator, pos + len(separator), end)
+        if end > prev:
+            spans.append((prev, end))
+        return spans
+
+    def _split_spans(
+        self,
+        text: str,
+        start: int,
+        end: int,
+        separators: List[str],
+        n_tokens: Callable[[int, int], int],
+    ) -> List[str]:
+        # find the first separator present in the span
+        separator = separators[-1]
+        new_separators = []
+        for i, sep in enumerate(separators):
+            if sep == "":
+                separator = sep
+                break
+            if text.find(sep, start, end) != -1:
+                separator = sep
+                new_separators = separators[i + 1:]
+                break
+
+        final_chunks = []
+        good_spans = []
+        for span in self._split_on(text, start, end, separator):
+            if n_tokens(*span) < self._chunk_size:
+                good_spans.append(span)
+            else:
+                if good_spans:
+                    final_chunks.extend(self._merge_spans(text, good_spans, n_tokens))
+                    good_spans = []
+                if not new_separators:
+                    final_chunks.append(text[span[0]:span[1]])
+                else:
+                    final_chunks.extend(
+                        self._split_spans(text, span[0], span[1], new_separators, n_tokens)
+                    )
+        if good_spans:
+            final_chunks.extend(self._merge_spans(text, good_spans, n_tokens))
+        return final_chunks
+
+    def _join_spans(self, text: str, spans: deque) -> str:
+        "the spans are consecutive so joining them is a slice"
+        chunk = text[spans[0][0]:spans[-1][1]]
+        if self._strip_whitespace:
+            chunk = chunk.strip()
+        return chunk
+
+    def _merge_spans(
+        self,
+        text: str,
+        spans: List[Tuple[int, int]],
+        n_tokens: Callable[[int, int], int],
+    ) -> List[str]:
+        "merge consecutive small spans into chunks of chunk_size with chunk_overlap"
+        chunks = []
+        current = deque()
+        lengths = deque()
+        total = 0
+        for span in spans:
+            length = n_tokens(*span)
+            if total + length > self._chunk_size and current:
+                chunk = self._join_spans(text, current)
+                if chunk:
+                    chunks.append(chunk)
+                while total > self._chunk_overlap or (
+                    total + length > self._chunk_size and total > 0
+                ):
+                    total -= lengths.popleft()
+                    current.popleft()
+            current.append(span)
+            lengths.append(length)
+            total += length
+        if current:
+            chunk = self._join_spans(text, current)
+            if chunk:
+                chunks.append(chunk)
+        return chunks
@@ -28,7 +28,7 @@ from langchain_community.embeddings import SentenceTransformerEmbeddings
 from langchain_openai import OpenAIEmbeddings
 from langchain.docstore.document import Document
 
-from .misc import cache_dir, get_tkn_length
+from .misc import cache_dir, get_docs_tkn_length
 from .logger import whi, red
 from .typechecker import optional_typecheck
 from .flags import is_verbose
@@ -75,6 +75,15 @@ def iter_merge(db1: FAISS, db2: FAISS) -> List[Document]:
             failed.append(docu)
     return failed
 
+@optional_typecheck
+def uncached_embeddings(embedding_engine: Any) -> Any:
+    """the embeddings model behind the cache, to embed texts that are not
+    worth keeping in the persistent embeddings cache"""
+    if isinstance(embedding_engine, CacheBackedEmbeddings):
+        return embedding_engine.underlying_embeddings
+    return embedding_engine
+
+
 def score_function(distance: float) -> float:
     """
     Scoring function for faiss to make sure it's positive.
@@ -377,7 +386,7 @@ def load_embeddings(
                 file.unlink(missing_ok=False)
 
     # check price of embedding
-    full_tkn = sum([get_tkn_length(doc.page_content) for doc in to_embed])
+    full_tkn = sum(get_docs_tkn_length(to_embed))
     whi(
         f"Total number of tokens in documents (not checking if already present in cache): '{full_tkn}'")
     if private:
@@ -19,6 +19,12 @@ WDOC_OPEN_ANKI = False
 WDOC_STRICT_DOCDICT = None
 WDOC_MAX_LOADER_TIMEOUT = 30 * 60
 WDOC_MAX_PDF_LOADER_TIMEOUT = 5 * 60
+WDOC_PDF_PARSER_RACE = 0
+WDOC_PDF_PAGE_RANGE_SIZE = 100
+WDOC_LANG_SAMPLE_SIZE = 20
+WDOC_HASH_ALGORITHM = "sha256"
+WDOC_FAST_HASH_MIN_MB = 0
+WDOC_MAX_COMBINE_TOKENS = 16000
 WDOC_PRIVATE_MODE = False
 WDOC_DEBUGGER = False
 WDOC_EXPIRE_CACHE_DAYS = 0
@@ -3,8 +3,9 @@ Code related to loading the LLM instance, with an appropriate price
 counting callback.
 """
 
-from typing import Union, List, Any, Optional
+from typing import Union, List, Any, Optional, Tuple
 import os
+import threading
 from typing import Dict
 
 import lazy_import
@@ -134,6 +135,8 @@ class PriceCountingCallback(BaseCallbackHandler):
         self.total_tokens = 0
         self.prompt_tokens = 0
         self.completion_tokens = 0
+        # tokens removed by the extractive compression before calling the llm
+        self.compression_saved_tokens = 0
         self.methods_called = []
         self.authorized_methods = [
             "on_llm_start",
@@ -145,6 +148,27 @@ class PriceCountingCallback(BaseCallbackHandler):
             "on_chain_error",
         ]
         self.pbar = []
+        # the counters are updated from several threads when summarizing
+        # or answering in parallel
+        self.lock = threading.Lock()
+
+    def add_tokens(self, prompt_tokens: int, completion_tokens: int) -> None:
+        "add to the token counters, safe to call from several threads"
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.total_tokens += prompt_tokens + completion_tokens
+            assert self.total_tokens == self.prompt_tokens + self.completion_tokens
+
+    def add_compression_saved_tokens(self, n_tokens: int) -> None:
+        "add to the count of tokens removed by the compression, thread safe"
+        with self.lock:
+            self.compression_saved_tokens += n_tokens
+
+    def get_tokens(self) -> Tuple[int, int]:
+        "consistent snapshot of the prompt and completion token counters"
+        with self.lock:
+            return self.prompt_tokens, self.completion_tokens
 
     def __repr__(self) -> str:
         # setting __repr__ and __str__ is important because it can
@@ -207,10 +231,7 @@ class PriceCountingCallback(BaseCallbackHandler):
 
         new_p = response.llm_output["token_usage"]["prompt_tokens"]
         new_c = response.llm_output["token_usage"]["completion_tokens"]
-        self.prompt_tokens += new_p
-        self.completion_tokens += new_c
-        self.total_tokens += new_p + new_c
-        assert self.total_tokens == self.prompt_tokens + self.completion_tokens
+        self.add_tokens(new_p, new_c)
         self._check_methods_called()
 
     def on_llm_error(
@@ -9,11 +9,15 @@ import copy
 import sys
 import os
 import time
-from typing import List, Union, Any, Optional, Callable, Dict, Tuple
+from typing import List, Union, Any, Optional, Callable, Dict, Tuple, Generator
 import signal
-from contextlib import contextmanager
+from contextlib import contextmanager, closing
+import multiprocessing
+import multiprocessing.connection
+from concurrent.futures import ProcessPoolExecutor
 import traceback
 from functools import partial
+from functools import cache as memoize
 import uuid
 import tempfile
 import requests
@@ -22,6 +26,7 @@ from pathlib import Path, PosixPath
 import re
 from tqdm import tqdm
 import json
+import sqlite3
 import dill
 import httpx
 
@@ -53,10 +58,10 @@ from .misc import (doc_loaders_cache, html_to_text, hasher,
                    optional_strip_unexp_args,
                    )
 from .typechecker import optional_typecheck
-from .logger import whi, yel, red, logger
+from .logger import whi, yel, red, logger, cache_dir
 from .flags import is_verbose, is_linux, is_debug
 from .errors import TimeoutPdfLoaderError
-from .env import WDOC_MAX_PDF_LOADER_TIMEOUT
+from .env import WDOC_MAX_PDF_LOADER_TIMEOUT, WDOC_PDF_PARSER_RACE, WDOC_PDF_PAGE_RANGE_SIZE
 
 # lazy loading of modules
 Document = lazy_import.lazy_class('langchain.docstore.document.Document')
@@ -80,6 +85,7 @@ ffmpeg = lazy_import.lazy_module("ffmpeg")
 torchaudio = lazy_import.lazy_module("torchaudio")
 sync_playwright = lazy_import.lazy_class("playwright.sync_api.sync_playwright")
 openparse = lazy_import.lazy_module("openparse")
+pymupdf = lazy_import.lazy_module("pymupdf")
 
 
 try:
@@ -127,6 +133,10 @@ linebreak_before_letter = re.compile(
 )  # match any linebreak that is followed by a lowercase letter
 anki_replacements_regex = re.compile(r'\{([^}]*)\}')
 
+# filetypes whose content can change without their file_hash changing
+# (the anki collection) or that ask the user: their output is not cached
+uncached_filetypes = ["anki", "string"]
+
 @optional_typecheck
 class OpenparseDocumentParser:
     def __init__(
@@ -265,6 +275,10 @@ sox_effects = [
 ]
 
 pdf_loader_max_timeout = WDOC_MAX_PDF_LOADER_TIMEOUT
+pdf_page_range_size = WDOC_PDF_PAGE_RANGE_SIZE
+pdf_parser_stats_path = cache_dir / "pdf_parser_stats.sqlite"
+# number of similar pdfs parsed in the past needed to trust their statistics
+min_pdf_stats_runs = 3
 
 @contextmanager
 def signal_timeout(timeout: int, exception: Exception):
@@ -333,8 +347,9 @@ def load_one_doc(
 ) -> List[Document]:
     """choose the appropriate loader for a file, then load it,
     split into documents, add some metadata then return.
-    The loader is cached"""
-    debug = is_debug
+    The loader is cached, and so is the final output unless the filetype
+    is in uncached_filetypes: unchanged files are then not split, checked
+    and post processed again."""
     text_splitter = get_splitter(task, modelname=llm_name)
 
     expected_global_dir = loaders_temp_dir_file.read_text().strip()
@@ -344,6 +359,88 @@ def load_one_doc(
     ), f"File loaders_temp_dir_file not found in {loaders_temp_dir_file} pointing at '{expected_global_dir}'"
     assert expected_global_dir == temp_dir, f"Error handling temp dir: temp_dir is {temp_dir} but loaders_temp_dir is {expected_global_dir}"
 
+    doc_args = dict(
+        task=task,
+        temp_dir=temp_dir,
+        text_splitter=text_splitter,
+        filetype=filetype,
+        file_hash=file_hash,
+        source_tag=source_tag,
+        doccheck_min_lang_prob=doccheck_min_lang_prob,
+        doccheck_min_token=doccheck_min_token,
+        doccheck_max_token=doccheck_max_token,
+        doccheck_max_lines=doccheck_max_lines,
+    )
+    if filetype in uncached_filetypes:
+        return _load_one_doc(**doc_args, **kwargs)
+
+    # imported here to avoid a circular import
+    from .. import __VERSION__
+    return cached_load_one_doc(
+        splitter_config={
+            "class": text_splitter.__class__.__name__,
+            "chunk_size": text_splitter._chunk_size,
+            "chunk_overlap": text_splitter._chunk_overlap,
+            "separators": getattr(text_splitter, "_separators", None),
+            "encoding_name": getattr(text_splitter, "_encoding_name", None),
+        },
+        wdoc_version=__VERSION__,
+        loader_kwargs=kwargs,
+        **doc_args,
+    )
+
+
+@doc_loaders_cache.cache(ignore=["temp_dir", "text_splitter"])
+def cached_load_one_doc(
+    splitter_config: dict,
+    wdoc_version: str,
+    loader_kwargs: dict,
+    task: str,
+    temp_dir: PosixPath,
+    text_splitter: TextSplitter,
+    filetype: str,
+    file_hash: str,
+    source_tag: Optional[str],
+    doccheck_min_lang_prob: float,
+    doccheck_min_token: int,
+    doccheck_max_token: int,
+    doccheck_max_lines: int,
+) -> List[Document]:
+    """cache the output of _load_one_doc. The splitter is identified by
+    splitter_config and the wdoc_version makes sure the cache is not
+    reused after an update."""
+    return _load_one_doc(
+        task=task,
+        temp_dir=temp_dir,
+        text_splitter=text_splitter,
+        filetype=filetype,
+        file_hash=file_hash,
+        source_tag=source_tag,
+        doccheck_min_lang_prob=doccheck_min_lang_prob,
+        doccheck_min_token=doccheck_min_token,
+        doccheck_max_token=doccheck_max_token,
+        doccheck_max_lines=doccheck_max_lines,
+        **loader_kwargs,
+    )
+
+
+@optional_typecheck
+def _load_one_doc(
+    task: str,
+    temp_dir: PosixPath,
+    text_splitter: TextSplitter,
+    filetype: str,
+    file_hash: str,
+    source_tag: Optional[str],
+    doccheck_min_lang_prob: float,
+    doccheck_min_token: int,
+    doccheck_max_token: int,
+    doccheck_max_lines: int,
+    **kwargs,
+) -> List[Document]:
+    "actually load the document, see load_one_doc"
+    debug = is_debug
+
     if filetype == "url":
         docs = load_url(**kwargs)
 
@@ -2083,6 +2180,367 @@ def _pdf_loader(loader_name: str, path: str, file_hash: str) -> List[Document]:
     return content
 
 
+@doc_loaders_cache.cache(ignore=["range_path", "path"])
+def _pdf_range_loader(
+    loader_name: str,
+    range_path: str,
+    path: str,
+    file_hash: str,
+    first_page: int,
+    last_page: int,
+    n_pages: int,
+) -> List[Document]:
+    """parse the pages first_page to last_page (excluded) of a pdf, written
+    beforehand to range_path, as if the whole pdf had been parsed"""
+    # range_path is empty when the range was expected to be in the cache,
+    # raising avoids caching the parsing of an empty path if it wasn't
+    assert range_path, f"Page range {first_page}-{last_page} of '{path}' is not in the cache anymore"
+    content = pdf_loaders[loader_name](range_path).load()
+    assert isinstance(
+        content, list), f"Output of {loader_name} is of type {type(content)}"
+    assert all(isinstance(d, Document)
+               for d in content), f"Output of {loader_name} contains elements that are not Documents: {[type(c) for c in content]}"
+    for d in content:
+        for k in ["page", "page_number"]:
+            if isinstance(d.metadata.get(k), int):
+                d.metadata[k] += first_page
+        if "total_pages" in d.metadata:
+            d.metadata["total_pages"] = n_pages
+        for k in ["source", "file_path"]:
+            if d.metadata.get(k) == range_path:
+                d.metadata[k] = path
+    return content
+
+
+def parse_pdf_range(**kwargs) -> List[Document]:
+    "module level function calling _pdf_range_loader, as the joblib cached function can't be pickled"
+    return _pdf_range_loader(**kwargs)
+
+
+@optional_typecheck
+def split_pdf(
+    path: str,
+    file_hash: str,
+    ranges: List[Tuple[int, int]],
+) -> Dict[Tuple[int, int], str]:
+    """write each page range of the pdf to its own file in the loaders temp
+    dir, shared by all the pdf loaders"""
+    temp_dir = Path(loaders_temp_dir_file.read_text().strip()) / f"pdf_ranges_{file_hash}"
+    temp_dir.mkdir(exist_ok=True)
+    range_paths = {}
+    with pymupdf.open(path) as pdf:
+        for first, last in ranges:
+            range_path = temp_dir / f"{first}_{last}.pdf"
+            if not range_path.exists():
+                with pymupdf.open() as pages:
+                    pages.insert_pdf(pdf, from_page=first, to_page=last - 1)
+                    # written then moved as several processes can split the same pdf
+                    partial_path = temp_dir / f"{first}_{last}_{uuid.uuid4()}.pdf"
+                    pages.save(str(partial_path))
+                os.replace(partial_path, range_path)
+            range_paths[(first, last)] = str(range_path)
+    return range_paths
+
+
+@optional_typecheck
+def parse_pdf(loader_name: str, path: str, file_hash: str) -> List[Document]:
+    """parse a pdf with a given loader. A pdf of more than
+    pdf_page_range_size pages is split in page ranges that are parsed in
+    parallel then stitched back in page order. Each range is cached so
+    that parsing again after a crash only parses the missing ranges."""
+    if not pdf_page_range_size:
+        return _pdf_loader(loader_name, path, file_hash)
+    try:
+        with pymupdf.open(path) as pdf:
+            n_pages = pdf.page_count
+    except Exception as err:
+        yel(f"Couldn't count the pages of '{path}', parsing it whole: {err}")
+        return _pdf_loader(loader_name, path, file_hash)
+    if n_pages <= pdf_page_range_size:
+        return _pdf_loader(loader_name, path, file_hash)
+
+    ranges = [
+        (first, min(first + pdf_page_range_size, n_pages))
+        for first in range(0, n_pages, pdf_page_range_size)
+    ]
+    range_kwargs = {
+        r: dict(
+            loader_name=loader_name,
+            range_path="",
+            path=path,
+            file_hash=file_hash,
+            first_page=r[0],
+            last_page=r[1],
+            n_pages=n_pages,
+        )
+        for r in ranges
+    }
+    # the cached ranges are loaded first, a range evicted from the cache
+    # in the meantime is parsed again like the others
+    outputs = {}
+    todo = []
+    for r in ranges:
+        if _pdf_range_loader.check_call_in_cache(**range_kwargs[r]):
+            try:
+                outputs[r] = _pdf_range_loader(**range_kwargs[r])
+                continue
+            except Exception as err:
+                yel(f"Parsing again page range {r} of '{path}': {err}")
+        todo.append(r)
+    if todo:
+        for r, range_path in split_pdf(path, file_hash, todo).items():
+            range_kwargs[r]["range_path"] = range_path
+    whi(f"Parsing {len(todo)}/{len(ranges)} page ranges of '{path}' with {loader_name}")
+
+    n_jobs = min(len(todo), os.cpu_count() or 1)
+    # daemonic processes like the parser race ones can't have children
+    if n_jobs > 1 and not multiprocessing.current_process().daemon:
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=get_process_context()) as executor:
+            futures = {
+                r: executor.submit(parse_pdf_range, **range_kwargs[r])
+                for r in todo
+            }
+            for r in todo:
+                outputs[r] = futures[r].result()
+    else:
+        for r in todo:
+            outputs[r] = _pdf_range_loader(**range_kwargs[r])
+
+    return [d for r in ranges for d in outputs[r]]
+
+
+@optional_typecheck
+def _race_pdf_loader(loader_name: str, path: str, file_hash: str, conn: Any) -> None:
+    "run in a child process by race_pdf_loaders, sends the output to conn"
+    try:
+        conn.send(("ok", parse_pdf(loader_name, path, file_hash)))
+    except Exception as err:
+        conn.send(("error", str(err)))
+    finally:
+        conn.close()
+
+
+@memoize
+def get_process_context() -> Any:
+    """multiprocessing context used for the processes started by WDoc: the
+    forkserver imports the loaders only once instead of at each process
+    start, and unlike fork it is safe to use from threads"""
+    if is_linux:
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload([__name__])
+    else:
+        ctx = multiprocessing.get_context("spawn")
+    return ctx
+
+
+@optional_typecheck
+def race_pdf_loaders(
+    path: str,
+    file_hash: str,
+    n_jobs: int,
+    loader_names: List[str],
+) -> Generator[Tuple[str, Optional[List[Document]], Optional[str], float], None, None]:
+    """run the pdf loaders concurrently, n_jobs at a time starting in the
+    order of loader_names, each in its own process and yield
+    (loader_name, docs, error, duration) as soon as each one finishes. A loader running for more than pdf_loader_max_timeout
+    seconds is killed and so are all the remaining ones when the
+    generator is closed."""
+    ctx = get_process_context()
+    pending = list(loader_names)
+    running = {}  # connection -> (loader_name, process, start time)
+
+    def stop(proc) -> None:
+        proc.terminate()
+        proc.join(5)
+        if proc.is_alive():
+            proc.kill()
+            proc.join()
+
+    try:
+        while pending or running:
+            while pending and len(running) < n_jobs:
+                loader_name = pending.pop(0)
+                recv_conn, send_conn = ctx.Pipe(duplex=False)
+                proc = ctx.Process(
+                    target=_race_pdf_loader,
+                    args=(loader_name, path, file_hash, send_conn),
+                    daemon=True,
+                )
+                proc.start()
+                send_conn.close()
+                running[recv_conn] = (loader_name, proc, time.time())
+
+            deadline = min(t for _, _, t in running.values()) + pdf_loader_max_timeout
+            ready = multiprocessing.connection.wait(
+                list(running.keys()),
+                timeout=max(0, deadline - time.time()),
+            )
+            for conn in ready:
+                loader_name, proc, t = running.pop(conn)
+                try:
+                    status, out = conn.recv()
+                except EOFError:
+                    status, out = "error", f"parser process died with exit code {proc.exitcode}"
+                duration = time.time() - t
+                conn.close()
+                stop(proc)
+                if status == "ok":
+                    yield loader_name, out, None, duration
+                else:
+                    yield loader_name, None, out, duration
+
+            now = time.time()
+            for conn, (loader_name, proc, t) in list(running.items()):
+                if now - t >= pdf_loader_max_timeout:
+                    del running[conn]
+                    conn.close()
+                    stop(proc)
+                    yield loader_name, None, f"killed after {pdf_loader_max_timeout}s", now - t
+    finally:
+        for conn, (_, proc, _) in running.items():
+            conn.close()
+            stop(proc)
+
+
+@optional_typecheck
+def get_pdf_features(path: str) -> Dict[str, Union[str, int]]:
+    """features of a pdf that predict which parser works best: the
+    producer and creator (without version numbers), the order of magnitude
+    of the page count and whether the first pages have a text layer"""
+    try:
+        with pymupdf.open(path) as pdf:
+            metadata = pdf.metadata or {}
+            n_pages = pdf.page_count
+            text_layer = any(
+                pdf[i].get_text().strip() for i in range(min(3, n_pages))
+            )
+    except Exception as err:
+        yel(f"Couldn't read the metadata of '{path}': {err}")
+        return {"producer": "unknown", "creator": "unknown", "pages": 0, "text_layer": 0}
+
+    def clean(val: Optional[str]) -> str:
+        val = re.sub(r"[\d.]+", "", val or "").strip().lower()
+        return val[:50] if val else "unknown"
+
+    return {
+        "producer": clean(metadata.get("producer")),
+        "creator": clean(metadata.get("creator")),
+        "pages": len(str(n_pages)),
+        "text_layer": int(text_layer),
+    }
+
+
+@optional_typecheck
+def get_pdf_parser_stats_db() -> sqlite3.Connection:
+    "connection to the statistics of the pdf parsers, shared by all processes"
+    conn = sqlite3.connect(pdf_parser_stats_path, timeout=60)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS pdf_parser_stats "
+        "(producer TEXT, creator TEXT, pages INTEGER, text_layer INTEGER, "
+        "loader_name TEXT, n_runs INTEGER, n_wins INTEGER, n_failures INTEGER, "
+        "total_duration REAL, "
+        "PRIMARY KEY (producer, creator, pages, text_layer, loader_name))"
+    )
+    return conn
+
+
+@optional_typecheck
+def record_pdf_parser_stats(
+    features: Dict[str, Union[str, int]],
+    outcomes: Dict[str, Tuple[bool, float]],
+    winner: Optional[str],
+) -> None:
+    """add the outcome of each pdf loader that ran: whether it failed (error,
+    timeout or poor quality) and its duration, and which one was kept"""
+    try:
+        conn = get_pdf_parser_stats_db()
+        with conn:
+            conn.executemany(
+                "INSERT INTO pdf_parser_stats VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?) "
+                "ON CONFLICT (producer, creator, pages, text_layer, loader_name) "
+                "DO UPDATE SET n_runs = n_runs + 1, "
+                "n_wins = n_wins + excluded.n_wins, "
+                "n_failures = n_failures + excluded.n_failures, "
+                "total_duration = total_duration + excluded.total_duration",
+                [
+                    (
+                        features["producer"], features["creator"],
+                        features["pages"], features["text_layer"],
+                        loader_name, int(loader_name == winner), int(failed), duration,
+                    )
+                    for loader_name, (failed, duration) in outcomes.items()
+                ],
+            )
+        conn.close()
+    except Exception as err:
+        yel(f"Failed to update the pdf parser statistics: '{err}'")
+
+
+@optional_typecheck
+def get_pdf_parser_stats(
+    features: Optional[Dict[str, Union[str, int]]] = None,
+) -> List[dict]:
+    """statistics of each pdf loader, for all the pdfs or only for those
+    sharing the given features (any subset of the keys of get_pdf_features).
+    Meant for inspecting which parser wins on what kind of pdf."""
+    features = features or {}
+    where = " AND ".join(f"{k} = ?" for k in features) or "1"
+    conn = get_pdf_parser_stats_db()
+    rows = conn.execute(
+        "SELECT loader_name, SUM(n_runs), SUM(n_wins), SUM(n_failures), "
+        "SUM(total_duration) FROM pdf_parser_stats "
+        f"WHERE {where} GROUP BY loader_name",
+        list(features.values()),
+    ).fetchall()
+    conn.close()
+    stats = [
+        {
+            "loader_name": loader_name,
+            "n_runs": n_runs,
+            "n_wins": n_wins,
+            "n_failures": n_failures,
+            "win_rate": n_wins / n_runs,
+            "mean_duration": duration / n_runs,
+        }
+        for loader_name, n_runs, n_wins, n_failures, duration in rows
+    ]
+    return sorted(stats, key=lambda st: st["win_rate"], reverse=True)
+
+
+@optional_typecheck
+def rank_pdf_loaders(features: Dict[str, Union[str, int]]) -> List[str]:
+    """order the pdf loaders by their past win rate on pdfs sharing the most
+    features with this one, the faster first in case of ties. Loaders never
+    tried get a neutral prior so that they are still tried before the
+    loaders that keep losing."""
+    loader_names = list(pdf_loaders.keys())
+    stats = []
+    try:
+        for keys in [
+            ["producer", "creator", "pages", "text_layer"],
+            ["producer", "creator"],
+            ["producer"],
+        ]:
+            stats = get_pdf_parser_stats({k: features[k] for k in keys})
+            if sum(st["n_wins"] for st in stats) >= min_pdf_stats_runs:
+                break
+            stats = []
+    except Exception as err:
+        yel(f"Failed to read the pdf parser statistics: '{err}'")
+    if not stats:
+        return loader_names
+
+    stats = {st["loader_name"]: st for st in stats}
+
+    def score(loader_name: str) -> Tuple[float, float]:
+        if loader_name not in stats:
+            return (-0.5, float("inf"))
+        st = stats[loader_name]
+        return (-(st["n_wins"] + 1) / (st["n_runs"] + 2), st["mean_duration"])
+
+    return sorted(loader_names, key=score)
+
+
 @optional_strip_unexp_args
 def load_pdf(
     path: str,
@@ -2105,75 +2563,116 @@ def load_pdf(
     # probability
     probs = {}
 
-    pbar = tqdm(total=len(pdf_loaders),
-                desc=f"Parsing PDF {name}", unit="loader")
-    for loader_name in pdf_loaders:
-        pbar.desc = f"Parsing PDF {name} with {loader_name}"
-        try:
-            if debug:
-                red(f"Trying to parse {path} using {loader_name}")
+    def score_parsing(loader_name: str, docs: List[Document]) -> bool:
+        "store the parsing if it's of decent quality, return True if we can stop parsing"
+        for i, d in enumerate(docs):
+            docs[i].page_content = ftfy.fix_text(d.page_content)
+            if "pdf_loader_name" not in docs[i].metadata:
+                docs[i].metadata["pdf_loader_name"] = loader_name
 
-            with signal_timeout(
-                timeout=pdf_loader_max_timeout,
-                exception=TimeoutPdfLoaderError(),
-                ):
-                docs = _pdf_loader(loader_name, path, file_hash)
-
-            pbar.update(1)
-
-            for i, d in enumerate(docs):
-                docs[i].page_content = ftfy.fix_text(d.page_content)
-                if "pdf_loader_name" not in docs[i].metadata:
-                    docs[i].metadata["pdf_loader_name"] = loader_name
-
-            prob = check_docs_tkn_length(
-                docs=docs,
-                identifier=path,
-                check_language=True,
-                min_lang_prob=doccheck_min_lang_prob,
-                min_token=doccheck_min_token,
-                max_token=doccheck_max_token,
-                max_lines=doccheck_max_lines,
+        prob = check_docs_tkn_length(
+            docs=docs,
+            identifier=path,
+            check_language=True,
+            min_lang_prob=doccheck_min_lang_prob,
+            min_token=doccheck_min_token,
+            max_token=doccheck_max_token,
+            max_lines=doccheck_max_lines,
+        )
+
+        if prob < 0.5:
+            whi(
+                f"Ignore parsing by {loader_name} of '{path}' as it seems of poor quality: prob={prob}"
             )
+            return False
 
-            if prob >= 0.5:
-                # only consider it okay if decent quality
-                probs[loader_name] = prob
-                loaded_docs[loader_name] = docs
-                if prob > 0.95:
-                    # select this one as its bound to be okay
-                    whi(
-                        f"Early stopping of PDF parsing because {loader_name} has prob {prob} for {path}"
-                    )
-                    break
-            else:
-                whi(
-                    f"Ignore parsing by {loader_name} of '{path}' as it seems of poor quality: prob={prob}"
-                )
-                continue
+        # only consider it okay if decent quality
+        probs[loader_name] = prob
+        loaded_docs[loader_name] = docs
+        if prob > 0.95:
+            # select this one as its bound to be okay
+            whi(
+                f"Early stopping of PDF parsing because {loader_name} has prob {prob} for {path}"
+            )
+            return True
+
+        # if more than 3 worked, take the best among them to save
+        # time on running all the others
+        return len(probs.keys()) >= 3
+
+    # try first the loaders that worked best on similar pdfs
+    features = get_pdf_features(path)
+    loader_names = rank_pdf_loaders(features)
+    if debug:
+        yel(f"PDF features of {path}: {features}, loader order: {loader_names}")
+    # loader name -> (failed, duration)
+    outcomes = {}
+
+    race = WDOC_PDF_PARSER_RACE
+    if race and multiprocessing.current_process().daemon:
+        yel("Can't race the pdf parsers from a daemonic process, parsing sequentially")
+        race = 0
+
+    pbar = tqdm(total=len(pdf_loaders),
+                desc=f"Parsing PDF {name}", unit="loader")
+    if race:
+        pbar.desc = f"Parsing PDF {name} with {race} parsers at a time"
+        with closing(race_pdf_loaders(path, file_hash, race, loader_names)) as results:
+            for loader_name, docs, error, duration in results:
+                pbar.update(1)
+                outcomes[loader_name] = (True, duration)
+                if error is not None:
+                    yel(f"Error when parsing '{path}' with {loader_name}: {error}")
+                    continue
+                try:
+                    stop = score_parsing(loader_name, docs)
+                    outcomes[loader_name] = (loader_name not in probs, duration)
+                    if stop:
+                        break
+                except Exception as err:
+                    yel(f"Error when parsing '{path}' with {loader_name}: {err}")
+    else:
+        for loader_name in loader_names:
+            pbar.desc = f"Parsing PDF {name} with {loader_name}"
+            t = time.time()
+            try:
+                if debug:
+                    red(f"Trying to parse {path} using {loader_name}")
+
+                with signal_timeout(
+                    timeout=pdf_loader_max_timeout,
+                    exception=TimeoutPdfLoaderError(),
+                    ):
+                    docs = parse_pdf(loader_name, path, file_hash)
 
-            if len(probs.keys()) >= 3:
-                # if more than 3 worked, take the best among them to save
-                # time on running all the others
-                break
-        except Exception as err:
-            yel(f"Error when parsing '{path}' with {loader_name}: {err}")
-            if "content" not in locals():
                 pbar.update(1)
 
+                stop = score_parsing(loader_name, docs)
+                outcomes[loader_name] = (loader_name not in probs, time.time() - t)
+                if stop:
+                    break
+            except Exception as err:
+                outcomes[loader_name] = (True, time.time() - t)
+                yel(f"Error when parsing '{path}' with {loader_name}: {err}")
+                if "content" not in locals():
+                    pbar.update(1)
+
     pbar.close()
+    winner = None
+    if probs:
+        max_prob = max(probs.values())
+        winner = [name for name in probs if probs[name] == max_prob][0]
+    record_pdf_parser_stats(features, outcomes, winner)
     assert probs.keys(), f"No pdf parser succedded to parse {path}"
 
     # no loader worked, exiting
     if not loaded_docs:
         raise Exception(f"No pdf parser worked for {path}")
 
-    max_prob = max([v for v in probs.values()])
-
     if debug:
         yel(f"Language probability after parsing {path}: {probs}")
 
-    return loaded_docs[[name for name in probs if probs[name] == max_prob][0]]
+    return loaded_docs[winner]
 
 
 @optional_typecheck
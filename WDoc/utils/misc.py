@@ -4,7 +4,7 @@ Miscellanous functions etc.
 
 import sys
 from typing import List, Union, Callable, Any, get_type_hints, Optional, Tuple
-from joblib import Memory
+from joblib import Memory, Parallel, delayed
 from joblib import hash as jhash
 import socket
 import os
@@ -20,19 +20,24 @@ import lazy_import
 import tiktoken
 from functools import partial
 from functools import cache as memoize
+import sqlite3
+import threading
 from py_ankiconnect import PyAnkiconnect
 import inspect
+from tqdm import tqdm
 from functools import wraps
 
 from langchain.docstore.document import Document
 from langchain_core.runnables import chain
-from langchain.text_splitter import TextSplitter, RecursiveCharacterTextSplitter
+from langchain.text_splitter import TextSplitter
 
 from .logger import whi, red, yel, cache_dir
+from .customs.fast_text_splitter import FastRecursiveTextSplitter
 from .typechecker import optional_typecheck
 from .flags import is_verbose
 from .errors import UnexpectedDocDictArgument
-from .env import WDOC_NO_MODELNAME_MATCHING, WDOC_STRICT_DOCDICT, WDOC_EXPIRE_CACHE_DAYS
+from .env import (WDOC_NO_MODELNAME_MATCHING, WDOC_STRICT_DOCDICT, WDOC_EXPIRE_CACHE_DAYS,
+                  WDOC_LANG_SAMPLE_SIZE, WDOC_HASH_ALGORITHM, WDOC_FAST_HASH_MIN_MB)
 
 litellm = lazy_import.lazy_module("litellm")
 
@@ -69,17 +74,16 @@ else:
 doc_loaders_cache_dir = (cache_dir / "doc_loaders")
 doc_loaders_cache_dir.mkdir(exist_ok=True)
 doc_loaders_cache = Memory(doc_loaders_cache_dir, verbose=0)
-hashdoc_cache_dir = (cache_dir / "doc_hashing")
-hashdoc_cache_dir.mkdir(exist_ok=True)
-hashdoc_cache = Memory(hashdoc_cache_dir, verbose=0)
 (cache_dir / "query_eval_llm").mkdir(exist_ok=True)
 query_eval_cache = Memory(cache_dir / "query_eval_llm", verbose=0)
+(cache_dir / "summary_chunks").mkdir(exist_ok=True)
+summary_chunks_cache = Memory(cache_dir / "summary_chunks", verbose=0)
 
 # remove cache files older than X days
 if WDOC_EXPIRE_CACHE_DAYS:
     doc_loaders_cache.reduce_size(age_limit=timedelta(WDOC_EXPIRE_CACHE_DAYS))
-    hashdoc_cache.reduce_size(age_limit=timedelta(WDOC_EXPIRE_CACHE_DAYS))
     query_eval_cache.reduce_size(age_limit=timedelta(WDOC_EXPIRE_CACHE_DAYS))
+    summary_chunks_cache.reduce_size(age_limit=timedelta(WDOC_EXPIRE_CACHE_DAYS))
 
 # for reading length estimation
 wpm = 250
@@ -90,13 +94,35 @@ recur_separator = ["\n\n\n\n", "\n\n\n", "\n\n", "\n", "...", ".", " ", ""]
 
 # used to get token length estimation
 tokenizers = {
-    "gpt-3.5-turbo": tiktoken.encoding_for_model("gpt-3.5-turbo").encode,
+    "gpt-3.5-turbo": tiktoken.encoding_for_model("gpt-3.5-turbo"),
 }
 
+# token length of texts already counted, by (content_hash, modelname)
+tkn_length_cache = {}
+# persistent version of tkn_length_cache
+tkn_length_db_path = cache_dir / "token_counts.sqlite"
+tkn_length_db_lock = threading.Lock()
+
 min_token = 20
 max_token = 1_000_000
 max_lines = 100_000
 min_lang_prob = 0.50
+# number of pages whose language is checked, 0 to check all of them
+lang_sample_size = WDOC_LANG_SAMPLE_SIZE
+# number of documents tokenized at a time when checking their length
+tkn_check_batch_size = 64
+
+# file hashing
+file_hash_algorithm = WDOC_HASH_ALGORITHM
+assert file_hash_algorithm in ["sha256", "blake2b"], f"Invalid WDOC_HASH_ALGORITHM: {file_hash_algorithm}"
+hash_block_size = 1024 * 1024
+# files larger than this are hashed in fast mode, 0 to disable
+fast_hash_min_size = WDOC_FAST_HASH_MIN_MB * 1024 * 1024 if WDOC_FAST_HASH_MIN_MB else 0
+fast_hash_n_blocks = 16
+file_manifest_path = cache_dir / "file_manifest.sqlite"
+# path -> (absolute path, os.stat_result) of the files found when walking
+# directories, to avoid stating them again when hashing
+file_stats_cache = {}
 
 printed_unexpected_api_keys = [False]  # to print it only once
 
@@ -259,30 +285,142 @@ def hasher(text: str) -> str:
     return hashlib.sha256(text.encode()).hexdigest()[:20]
 
 
+@optional_typecheck
+def file_manifest_key(doc: dict) -> Optional[Tuple[str, float, float, int, int, str]]:
+    """key of a file in the file manifest: its absolute path, its stats
+    and the hashing settings. None if the doc dict does not point to a file."""
+    if "path" not in doc:
+        return None
+    if doc["path"] in file_stats_cache:
+        # already stat'ed when walking a directory
+        abs_path, stats = file_stats_cache.pop(doc["path"])
+    else:
+        if not Path(doc["path"]).exists():
+            return None
+        file = Path(doc["path"])
+        stats = file.stat()
+        abs_path = str(file.resolve().absolute())
+    settings = file_hash_algorithm
+    if fast_hash_min_size and stats.st_size >= fast_hash_min_size:
+        settings += "_fast"
+    return (
+        abs_path,
+        stats.st_mtime,
+        stats.st_ctime,
+        stats.st_ino,
+        stats.st_size,
+        settings,
+    )
+
+
+@optional_typecheck
+def get_file_manifest() -> sqlite3.Connection:
+    "connection to the manifest storing the hash of each file along with its stats"
+    conn = sqlite3.connect(file_manifest_path, timeout=60)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS file_manifest "
+        "(abs_path TEXT PRIMARY KEY, mtime REAL, ctime REAL, inode INTEGER, "
+        "size INTEGER, settings TEXT, file_hash TEXT)"
+    )
+    return conn
+
+
+@optional_typecheck
+def batch_file_hasher(docs: List[dict], n_jobs: int = -1) -> List[str]:
+    """used to hash the content of the files described by many doc dicts.
+    The manifest is queried once for all of them and only the files that
+    are new or whose path and stats changed are hashed, in parallel processes,
+    then stored in the manifest.
+    If a doc dict does not contain a path, the hash of the dict is used.
+    """
+    keys = [file_manifest_key(doc) for doc in docs]
+    hashes = [
+        hasher(json.dumps(doc)) if key is None else None
+        for doc, key in zip(docs, keys)
+    ]
+
+    paths = list(dict.fromkeys(key[0] for key in keys if key is not None))
+    known = {}
+    conn = get_file_manifest()
+    for i in range(0, len(paths), 500):
+        part = paths[i:i + 500]
+        for row in conn.execute(
+            "SELECT abs_path, mtime, ctime, inode, size, settings, file_hash "
+            f"FROM file_manifest WHERE abs_path IN ({','.join('?' * len(part))})",
+            part,
+        ):
+            known[tuple(row[:6])] = row[6]
+
+    todo = list(dict.fromkeys(
+        key for key in keys
+        if key is not None and key not in known
+    ))
+    if todo:
+        new_hashes = Parallel(
+            n_jobs=n_jobs if len(todo) > 1 else 1,
+            backend="loky",
+            verbose=0 if not is_verbose else 51,
+        )(delayed(_file_hasher)(
+            abs_path=key[0],
+            size=key[4],
+            algorithm=file_hash_algorithm,
+            fast=key[5].endswith("_fast"),
+        ) for key in tqdm(
+            todo,
+            desc="Hashing files",
+            unit="file",
+            colour="magenta",
+            disable=len(todo) <= 10_000,
+        )
+        )
+        known.update(zip(todo, new_hashes))
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO file_manifest VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [key + (h,) for key, h in zip(todo, new_hashes)],
+            )
+    conn.close()
+
+    return [
+        h if h is not None else known[key]
+        for h, key in zip(hashes, keys)
+    ]
+
+
 @optional_typecheck
 def file_hasher(doc: dict) -> str:
     """used to hash a file's content, as describe by a dict
-    A caching mechanism is used to avoid recomputing hash of file that
-    have the same path and metadata.
+    The file manifest is used to avoid recomputing hash of file that
+    have the same path and stats.
     If the doc dict does not contain a path, the hash of the dict will be
     returned.
     """
-    if "path" in doc and Path(doc["path"]).exists():
-        file = Path(doc["path"])
-        stats = file.stat()
-        return _file_hasher(
-            abs_path=str(file.resolve().absolute()),
-            stats=[stats.st_mtime, stats.st_ctime, stats.st_ino, stats.st_size]
-        )
-    else:
-        return hasher(json.dumps(doc))
+    return batch_file_hasher([doc], n_jobs=1)[0]
 
 
 @optional_typecheck
-@hashdoc_cache.cache
-def _file_hasher(abs_path: str, stats: List[Union[int, float]]) -> str:
+def _file_hasher(
+    abs_path: str,
+    size: int,
+    algorithm: str = "sha256",
+    fast: bool = False,
+) -> str:
+    """hash the content of a file block by block to keep the memory bounded.
+    In fast mode, meant for huge media files, only the size and
+    fast_hash_n_blocks blocks spread over the file are hashed."""
+    digest = hashlib.new(algorithm)
     with open(abs_path, "rb") as f:
-        return hashlib.sha256(f.read()).hexdigest()[:20]
+        if fast:
+            digest.update(str(size).encode())
+            for i in range(fast_hash_n_blocks):
+                f.seek(int(i * max(0, size - hash_block_size) / (fast_hash_n_blocks - 1)))
+                digest.update(f.read(hash_block_size))
+        else:
+            buffer = bytearray(hash_block_size)
+            view = memoryview(buffer)
+            while n := f.readinto(buffer):
+                digest.update(view[:n])
+    return digest.hexdigest()[:20]
 
 
 @optional_typecheck
@@ -380,25 +518,109 @@ def model_name_matcher(model: str) -> str:
     return out
 
 
-@optional_typecheck
-def get_tkn_length(tosplit: str, modelname: str = "gpt-3.5-turbo") -> int:
-    if modelname in tokenizers:
-        return len(tokenizers[modelname](tosplit))
-    else:
+def get_tokenizer(modelname: str) -> tiktoken.Encoding:
+    "tiktoken encoding of the model, defaulting to the one of gpt-3.5-turbo"
+    if modelname not in tokenizers:
         try:
             tokenizers[modelname] = tiktoken.encoding_for_model(
-                modelname.split("/")[-1]).encode
+                modelname.split("/")[-1])
         except Exception:
-            modelname = "gpt-3.5-turbo"
-        return get_tkn_length(tosplit=tosplit, modelname=modelname)
+            tokenizers[modelname] = tokenizers["gpt-3.5-turbo"]
+    return tokenizers[modelname]
+
+
+# not typechecked as it's called for each prompt and answer. The lengths
+# are memoized by content hash in tkn_length_cache, shared with
+# get_docs_tkn_length, so that the texts themselves are not kept in memory
+def get_tkn_length(tosplit: str, modelname: str = "gpt-3.5-turbo") -> int:
+    key = (hasher(tosplit), modelname)
+    if key not in tkn_length_cache:
+        tkn_length_cache[key] = len(get_tokenizer(modelname).encode_ordinary(tosplit))
+    return tkn_length_cache[key]
+
+
+@memoize
+def get_tkn_length_db() -> sqlite3.Connection:
+    "connection to the persistent cache of token lengths"
+    conn = sqlite3.connect(tkn_length_db_path, check_same_thread=False)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tkn_length "
+        "(content_hash TEXT, modelname TEXT, length INTEGER, "
+        "PRIMARY KEY (content_hash, modelname))"
+    )
+    conn.commit()
+    return conn
 
 
+@optional_typecheck
+def get_docs_tkn_length(
+    docs: List[Document],
+    modelname: str = "gpt-3.5-turbo",
+    ) -> List[int]:
+    """token length of each document. The lengths are cached by
+    content_hash in memory and on disk, and the documents never seen
+    before are tokenized together using multiple threads."""
+    keys = [
+        d.metadata["content_hash"] if "content_hash" in d.metadata else hasher(d.page_content)
+        for d in docs
+    ]
+    missing = list(dict.fromkeys(
+        k for k in keys if (k, modelname) not in tkn_length_cache
+    ))
+
+    if missing:
+        try:
+            with tkn_length_db_lock:
+                conn = get_tkn_length_db()
+                for i in range(0, len(missing), 500):
+                    part = missing[i:i + 500]
+                    rows = conn.execute(
+                        "SELECT content_hash, length FROM tkn_length WHERE modelname = ? "
+                        f"AND content_hash IN ({','.join('?' * len(part))})",
+                        [modelname] + part,
+                    ).fetchall()
+                    for k, length in rows:
+                        tkn_length_cache[(k, modelname)] = length
+        except Exception as err:
+            red(f"Failed to read the token length cache: '{err}'")
+
+    texts = {}
+    for k, d in zip(keys, docs):
+        if (k, modelname) not in tkn_length_cache and k not in texts:
+            texts[k] = d.page_content
+    if texts:
+        lengths = [
+            len(tkns)
+            for tkns in get_tokenizer(modelname).encode_ordinary_batch(
+                list(texts.values()),
+                num_threads=os.cpu_count() or 8,
+            )
+        ]
+        for k, length in zip(texts.keys(), lengths):
+            tkn_length_cache[(k, modelname)] = length
+        try:
+            with tkn_length_db_lock:
+                conn = get_tkn_length_db()
+                conn.executemany(
+                    "INSERT OR REPLACE INTO tkn_length VALUES (?, ?, ?)",
+                    [(k, modelname, length) for k, length in zip(texts.keys(), lengths)],
+                )
+                conn.commit()
+        except Exception as err:
+            red(f"Failed to update the token length cache: '{err}'")
+
+    return [tkn_length_cache[(k, modelname)] for k in keys]
+
+
+@memoize
 @optional_typecheck
 def get_splitter(
     task: str,
     modelname="gpt-3.5-turbo",
 ) -> TextSplitter:
-    "we don't use the same text splitter depending on the task"
+    """we don't use the same text splitter depending on the task.
+    The splitters are memoized as they are stateless and asking litellm
+    for the context size of the model is slow."""
     try:
         max_tokens = litellm.get_model_info(modelname)["max_input_tokens"]
 
@@ -409,28 +631,28 @@ def get_splitter(
         if modelname != "testing/testing":
             red(f"Failed to get max_tokens limit for model {modelname}: '{err}'")
 
-    model_tkn_length = partial(get_tkn_length, modelname=modelname)
+    encoding_name = get_tokenizer(modelname).name
 
     if task in ["query", "search"]:
-        text_splitter = RecursiveCharacterTextSplitter(
+        text_splitter = FastRecursiveTextSplitter(
             separators=recur_separator,
             chunk_size=int(3 / 4 * max_tokens),  # default 4000
             chunk_overlap=500,  # default 200
-            length_function=model_tkn_length,
+            encoding_name=encoding_name,
         )
     elif task in ["summarize_then_query", "summarize"]:
-        text_splitter = RecursiveCharacterTextSplitter(
+        text_splitter = FastRecursiveTextSplitter(
             separators=recur_separator,
             chunk_size=int(1 / 2 * max_tokens),
             chunk_overlap=500,
-            length_function=model_tkn_length,
+            encoding_name=encoding_name,
         )
     elif task == "recursive_summary":
-        text_splitter = RecursiveCharacterTextSplitter(
+        text_splitter = FastRecursiveTextSplitter(
             separators=recur_separator,
             chunk_size=int(1 / 4 * max_tokens),
             chunk_overlap=300,
-            length_function=model_tkn_length,
+            encoding_name=encoding_name,
         )
     else:
         raise Exception(task)
@@ -446,19 +668,36 @@ def check_docs_tkn_length(
     max_token: int = max_token,
     min_lang_prob: float = min_lang_prob,
     check_language: bool = False,
+    lang_sample_size: int = lang_sample_size,
 ) -> float:
     """checks that the number of tokens in the document is high enough,
     not too low, and has a high enough language probability,
-    otherwise something probably went wrong."""
-    size = sum([get_tkn_length(d.page_content) for d in docs])
-    nline = len("\n".join([d.page_content for d in docs]).splitlines())
-    if nline > max_lines:
-        red(
-            f"Example of page from document with too many lines : {docs[len(docs)//2].page_content}"
-        )
-        raise Exception(
-            f"The number of lines from '{identifier}' is {nline} > {max_lines}, probably something went wrong?"
-        )
+    otherwise something probably went wrong.
+    The language probability is the average over lang_sample_size pages
+    evenly spread over the document, or over all pages if 0."""
+    assert docs, f"No documents to check for '{identifier}'"
+    # count lines and tokens in a single pass, stopping as soon as a limit
+    # is crossed
+    size = 0
+    nline = 0
+    for i in range(0, len(docs), tkn_check_batch_size):
+        batch = docs[i:i + tkn_check_batch_size]
+        nline += sum(d.page_content.count("\n") + 1 for d in batch)
+        if nline > max_lines:
+            red(
+                f"Example of page from document with too many lines : {docs[len(docs)//2].page_content}"
+            )
+            raise Exception(
+                f"The number of lines from '{identifier}' is {nline} > {max_lines}, probably something went wrong?"
+            )
+        size += sum(get_docs_tkn_length(batch))
+        if size >= max_token:
+            red(
+                f"Example of page from document with too many tokens : {docs[len(docs)//2].page_content}"
+            )
+            raise Exception(
+                f"The number of token from '{identifier}' is {size} >= {max_token}, probably something went wrong?"
+            )
     if size <= min_token:
         red(
             f"Example of page from document with too few tokens : {docs[len(docs)//2].page_content}"
@@ -466,22 +705,23 @@ def check_docs_tkn_length(
         raise Exception(
             f"The number of token from '{identifier}' is {size} <= {min_token}, probably something went wrong?"
         )
-    if size >= max_token:
-        red(
-            f"Example of page from document with too many tokens : {docs[len(docs)//2].page_content}"
-        )
-        raise Exception(
-            f"The number of token from '{identifier}' is {size} >= {max_token}, probably something went wrong?"
-        )
     if check_language is False:
         return 1.0
 
-    # check if language check is above a threshold
+    # check if language check is above a threshold, on one page per
+    # stratum of the document
+    if lang_sample_size and len(docs) > lang_sample_size:
+        sampled = [
+            docs[int((i + 0.5) * len(docs) / lang_sample_size)]
+            for i in range(lang_sample_size)
+        ]
+    else:
+        sampled = docs
     probs = [
         language_detector(d.page_content.replace("\n", "<br>"))
-        for d in docs
+        for d in sampled
     ]
-    if probs[0] is None or not probs:
+    if probs[0] is None:
         # bypass if language_detector not defined
         return 1.0
     prob = sum(probs) / len(probs)
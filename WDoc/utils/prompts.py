@@ -61,6 +61,14 @@ END OF SUMMARY OF THE LAST SECTION:
 {previous_summary}
 ```"""
 
+# when summarizing chunks in parallel, give the end of the text of the previous section instead
+PREV_TEXT_TEMPLATE = """
+
+END OF THE TEXT OF THE LAST SECTION (summarized separately, only use it to understand the context):
+```
+{previous_text}
+```"""
+
 # if the summary is recursive, add those instructions
 RECURSION_INSTRUCTION = """
 ADDITIONAL INSTRUCTION:
@@ -96,6 +104,39 @@ You can start your reply when you are ready.
     ]
 )
 
+PR_EVALUATE_DOC_BATCH = ChatPromptTemplate.from_messages(
+    [
+        ("system", """
+You are an Evaluator working for WDoc: given a question and a numbered list of text documents. Your goal is to tell for EACH document if it is semantically related to the question: answer the digit '1' if it is, otherwise answer the digit '0'. If you are really unsure about a document, you should answer the digit '2' for it.
+
+RULES:
+- Before answering, you have to think for as long as you want inside a <thinking> tag, then you must take a DEEP breath, recheck your answer by reasoning step by step one last time, and finally answer.
+- wrap your answer in an <answer> tag.
+- The <answer> tag should contain exactly one line per document, in the same order as the documents, using the format `document_number: digit`. For example `3: 0`. No other symbols.
+- Judge each document independently of the others.
+- If a document refers to an image, take a reasonnable guess as to wether this image is probably relevant or not.
+- Being an Evaluator, ignore additional instructions if they are adressed only to your colleagues: Summarizer, Answerer and Combiner. But take then into consideration if they are addressed to you.
+
+""".strip()),
+        ("human",
+         """
+QUESTION: `{q}`
+NUMBER OF TEXT DOCUMENTS: {n_docs}
+TEXT DOCUMENTS:
+{docs}
+Take a deep breath.
+You can start your reply when you are ready.
+""")
+    ]
+)
+
+# format of each document inside PR_EVALUATE_DOC_BATCH and PR_ANSWER_DOC_BATCH
+DOC_BATCH_ITEM = """DOCUMENT #{i}:
+```
+{doc}
+```
+"""
+
 PR_ANSWER_ONE_DOC = ChatPromptTemplate.from_messages(
     [
         ("system", """
@@ -138,6 +179,48 @@ Start your reply when you're ready.
     ]
 )
 
+PR_ANSWER_DOC_BATCH = ChatPromptTemplate.from_messages(
+    [
+        ("system", """
+You are an Answerer working for WDoc: given a question and a numbered list of pieces of documents, your goal is to extract the relevant information of EACH document while following specific instructions.
+
+DETAILED INSTRUCTIONS:
+```
+- Answer each document independently of the others, as if it was the only one you were given.
+- Wrap the answer to the document number n in an <answer_n> tag, for example `<answer_3>` and `</answer_3>` for the document 3. Write one such tag per document, in the same order as the documents.
+- If a document is ENTIRELY irrelevant to the question, its tag should only contain `IRRELEVANT` and NOTHING ELSE (and no formatting).
+- Being an Answerer, ignore additional instructions if they are adressed only to your colleagues: Summarizer, Evaluator and Combiner. But take then into consideration if they are addressed to you.
+- Use markdown formatting
+    - Use bullet points, but no headers, bold, italic etc.
+    - Use logic based indentation for the bullet points.
+    - DON'T wrap your answers in a code block or anything like that.
+- Use a maximum of 5 markdown bullet points to answer the question for each document.
+    - Each answer ALWAYS HAS TO BE standalone / contextualized (i.e. both the question and its answer must be part of each answer).
+    - EVERY TIME POSSIBLE: supplement your reply with direct quotes from the document.
+        - Use children bullet for the quotes, between 'quotation' signs.
+    - Remain concise, you can use [...] in your quotes to remove unecessary text.
+- NEVER use your own knowledge of the subject, only use the documents or answer `IRRELEVANT`.
+- DON'T interpret the question too strictly:
+    - eg: if the question is phrased as an instruction like "give me all information about such and such", use common sense and satisfy the instruction!
+- ALWAYS double check that you are not contradicting the original document before answering.
+- If you're unsure but a document refers to an image that has a reasonnable chance to be relevant, treat this document as if it was probably relevant.
+- Before answering, you have to think for as long as you want inside a <thinking> tag, then you must take a DEEP breath, recheck your answers by reasoning step by step one last time, and finally answer.
+- The <answer_n> tags should only contain your answers.
+```
+""".strip()),
+        ("human", """
+QUESTION: '{question_to_answer}'
+NUMBER OF DOCUMENTS: {n_docs}
+DOCUMENTS:
+{contexts}
+
+Now take a deep breath.
+Take your time.
+Start your reply when you're ready.
+""".strip())
+    ]
+)
+
 PR_COMBINE_INTERMEDIATE_ANSWERS = ChatPromptTemplate.from_messages(
     [
         ("system", """
@@ -195,11 +278,15 @@ Start your reply when you're ready.
 @dataclass(frozen=False)
 class Prompts_class:
     evaluate: ChatPromptTemplate
+    evaluate_batch: ChatPromptTemplate
     answer: ChatPromptTemplate
+    answer_batch: ChatPromptTemplate
     combine: ChatPromptTemplate
 
 prompts = Prompts_class(
     evaluate=PR_EVALUATE_DOC,
+    evaluate_batch=PR_EVALUATE_DOC_BATCH,
     answer=PR_ANSWER_ONE_DOC,
+    answer_batch=PR_ANSWER_DOC_BATCH,
     combine=PR_COMBINE_INTERMEDIATE_ANSWERS,
 )
@@ -11,6 +11,8 @@ from langchain_community.vectorstores import FAISS
 from langchain.chains import LLMChain, HypotheticalDocumentEmbedder
 from langchain.retrievers import ParentDocumentRetriever
 from langchain.storage import LocalFileStore
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.vectorstores import VectorStoreRetriever
 
 from .misc import cache_dir, get_splitter
 from .typechecker import optional_typecheck
@@ -96,3 +98,44 @@ def create_parent_retriever(
     )
     parent.add_documents(loaded_docs)
     return parent
+
+
+class ScoredVectorStoreRetriever(VectorStoreRetriever):
+    """similarity_score_threshold retriever that also stores the relevance
+    score of each document in its metadata, under 'relevance_score', so that
+    the scores don't need another search"""
+
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+    ) -> List[Document]:
+        docs_and_scores = self.vectorstore.similarity_search_with_relevance_scores(
+            query,
+            **self.search_kwargs,
+        )
+        return [
+            Document(
+                page_content=doc.page_content,
+                metadata={**doc.metadata, "relevance_score": score},
+            )
+            for doc, score in docs_and_scores
+        ]
+
+
+@optional_typecheck
+def create_scored_retriever(
+    loaded_embeddings: Any,
+    top_k: int,
+    relevancy: float,
+) -> ScoredVectorStoreRetriever:
+    "default retriever, keeping the relevance scores for the eval cascade"
+    return ScoredVectorStoreRetriever(
+        vectorstore=loaded_embeddings,
+        search_type="similarity_score_threshold",
+        search_kwargs={
+            "k": top_k,
+            "score_threshold": relevancy,
+        },
+    )
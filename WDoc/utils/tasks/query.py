@@ -3,7 +3,11 @@ Chain (logic) used to query a document.
 """
 
 import re
-from typing import Tuple, List, Any, Union
+import threading
+from collections import defaultdict
+from functools import cache as memoize
+from typing import Tuple, List, Any, Union, Optional, Callable, Generator
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from langchain.docstore.document import Document
 from langchain_core.runnables import chain
 from langchain_core.runnables.base import RunnableLambda
@@ -19,16 +23,25 @@ from langchain_openai import ChatOpenAI
 from ..typechecker import optional_typecheck
 from ..errors import NoDocumentsRetrieved, NoDocumentsAfterLLMEvalFiltering, InvalidDocEvaluationByLLMEval
 from ..logger import red
-from ..misc import thinking_answer_parser
+from ..misc import thinking_answer_parser, get_tkn_length
+from ..prompts import DOC_BATCH_ITEM
+from ..embeddings import uncached_embeddings
 
 import lazy_import
-pd = lazy_import.lazy_module('pandas')
-metrics = lazy_import.lazy_module("sklearn.metrics")
-PCA = lazy_import.lazy_class("sklearn.decomposition.PCA")
-StandardScaler = lazy_import.lazy_class("sklearn.preprocessing.StandardScaler")
 scipy = lazy_import.lazy_module("scipy")
+CrossEncoder = lazy_import.lazy_class("sentence_transformers.CrossEncoder")
 
 irrelevant_regex = re.compile(r"\bIRRELEVANT\b")
+# semantic_sorting uses the optimal leaf ordering of the clustering up to
+# that many texts, and a greedy nearest neighbour ordering above the second
+semantic_sorting_max_optimal_ordering = 200
+semantic_sorting_max_linkage = 2000
+# rough latency of a combine round, expressed as a number of prompt tokens
+combine_round_overhead_tkn = 2000
+# matches the answer to the document n in the output of the batch answer llm
+answer_batch_regex = re.compile(r"<answer_(\d+)>(.*?)</answer_\1>", flags=re.DOTALL)
+# matches a line like '3: 1' in the output of the batch eval llm
+eval_batch_line_regex = re.compile(r"^\W*(?:document\s*)?#?\s*(\d+)[\s*]*[:=]\s*(\d+)\W*$", flags=re.IGNORECASE)
 
 
 @optional_typecheck
@@ -45,6 +58,22 @@ def check_intermediate_answer(ans: str) -> bool:
     return False
 
 
+@optional_typecheck
+def evals_are_relevant(evals: Union[List[str], str]) -> bool:
+    "true if the eval llm answers of a single document deem it relevant"
+    if not isinstance(evals, list):
+        evals = [evals]
+    answers = [thinking_answer_parser(ev)["answer"] for ev in evals]
+    if all(list(map(str.isdigit, answers))):
+        answers = list(map(int, answers))
+        return sum(answers) != 0
+    red(
+        "Evals contained strings so keeping the doc:\n* "
+        '\n * '.join(answers) + "\n"
+    )
+    return True
+
+
 @chain
 @optional_typecheck
 def refilter_docs(inputs: dict) -> List[Document]:
@@ -60,21 +89,11 @@ def refilter_docs(inputs: dict) -> List[Document]:
     if not unfiltered_docs:
         raise NoDocumentsRetrieved("No document corresponding to the query")
 
-    filtered_docs = []
-    for ie, evals in enumerate(evaluations):  # iterating over each document
-        if not isinstance(evals, list):
-            evals = [evals]
-        answers = [thinking_answer_parser(ev)["answer"] for ev in evals]
-        if all(list(map(str.isdigit, answers))):
-            answers = list(map(int, answers))
-            if sum(answers) != 0:
-                filtered_docs.append(unfiltered_docs[ie])
-        else:
-            red(
-                "Evals contained strings so keeping the doc:\n* "
-                '\n * '.join(answers) + "\n"
-            )
-            filtered_docs.append(unfiltered_docs[ie])
+    filtered_docs = [
+        unfiltered_docs[ie]
+        for ie, evals in enumerate(evaluations)  # iterating over each document
+        if evals_are_relevant(evals)
+    ]
 
     if not filtered_docs:
         raise NoDocumentsAfterLLMEvalFiltering(
@@ -114,6 +133,377 @@ def parse_eval_output(output: str) -> str:
 
 
 
+@optional_typecheck
+def batch_docs_by_tkn(
+    texts: List[str],
+    batch_tkn_size: int,
+    ) -> List[List[int]]:
+    """group the indexes of texts into consecutive batches whose token
+    length stays below batch_tkn_size. A text longer than batch_tkn_size
+    gets its own batch. Each text is only tokenized once."""
+    assert batch_tkn_size > 0, "batch_tkn_size must be positive"
+    batches = []
+    current_size = 0
+    for it, t in enumerate(texts):
+        length = get_tkn_length(t)
+        if batches and current_size + length <= batch_tkn_size:
+            batches[-1].append(it)
+            current_size += length
+        else:
+            batches.append([it])
+            current_size = length
+    return batches
+
+
+@optional_typecheck
+def format_doc_batch(texts: List[str]) -> str:
+    "format the documents to put in a batch eval or answer prompt"
+    return "\n".join(
+        DOC_BATCH_ITEM.format(i=it + 1, doc=t)
+        for it, t in enumerate(texts)
+    )
+
+
+@optional_typecheck
+def parse_eval_batch_output(output: str, n_docs: int) -> List[Optional[str]]:
+    """parse the output of the batch eval llm into one verdict per
+    document. A verdict is None if it could not be parsed, in which case
+    the document has to be evaluated again individually."""
+    verdicts = [None] * n_docs
+    try:
+        parsed = thinking_answer_parser(output)["answer"]
+    except Exception as err:
+        red(f"Failed to parse the output of the batch eval LLM: '{err}'")
+        return verdicts
+
+    found = {}
+    for line in parsed.splitlines():
+        match = eval_batch_line_regex.match(line.strip())
+        if not match:
+            continue
+        idoc, digit = int(match.group(1)), match.group(2)
+        if not 1 <= idoc <= n_docs:
+            continue
+        if idoc in found and found[idoc] != digit:
+            # ambiguous
+            found[idoc] = None
+        elif idoc not in found:
+            found[idoc] = digit
+
+    for idoc, digit in found.items():
+        if digit == "0":
+            verdicts[idoc - 1] = "0"
+        elif digit in ["1", "2"]:
+            verdicts[idoc - 1] = "1"
+    return verdicts
+
+
+@optional_typecheck
+def parse_eval_batch_outputs(outputs: List[str], n_docs: int) -> List[Optional[List[str]]]:
+    """parse each generation of the batch eval llm and return for each
+    document its list of verdicts, or None if it could not be parsed in
+    all the generations"""
+    parsed = [parse_eval_batch_output(o, n_docs) for o in outputs]
+    evaluations = []
+    for idoc in range(n_docs):
+        evals = [p[idoc] for p in parsed]
+        if any(ev is None for ev in evals):
+            evaluations.append(None)
+        else:
+            evaluations.append(evals)
+    return evaluations
+
+
+@optional_typecheck
+def iter_evaluations(
+    inputs: List[dict],
+    evaluate_doc: Callable,
+    evaluate_batch: Callable,
+    batch_tkn_size: int,
+    max_workers: int,
+    ) -> Generator[Tuple[int, List[str]], None, None]:
+    """evaluate the documents concurrently and yield each
+    (index, evaluation) as soon as it is available. evaluate_doc takes one
+    input dict, evaluate_batch takes {"docs": [...], "q": q} and returns
+    one evaluation (or None) per document. If batch_tkn_size is not 0, the
+    documents are packed into batches of that many tokens to evaluate them
+    with a single call per batch. The documents whose batch evaluation could
+    not be parsed are then evaluated individually."""
+    if not inputs:
+        return
+    q = inputs[0]["q"]
+    assert all(inp["q"] == q for inp in inputs), "Expected the same question for all documents"
+    if batch_tkn_size:
+        batches = batch_docs_by_tkn(
+            texts=[inp["doc"] for inp in inputs],
+            batch_tkn_size=batch_tkn_size,
+        )
+    else:
+        batches = [[i] for i in range(len(inputs))]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # maps each future to the document indexes it evaluates, None
+        # meaning a single document evaluation
+        futures = {}
+        for b in batches:
+            if batch_tkn_size:
+                fut = pool.submit(
+                    evaluate_batch,
+                    {"docs": [inputs[i]["doc"] for i in b], "q": q},
+                )
+                futures[fut] = b
+            else:
+                futures[pool.submit(evaluate_doc, inputs[b[0]])] = [b[0], None]
+        n_redo = 0
+        while futures:
+            fut = next(as_completed(futures))
+            b = futures.pop(fut)
+            if b[-1] is None:
+                yield b[0], fut.result()
+                continue
+            bevals = fut.result()
+            assert len(b) == len(bevals), f"Expected {len(b)} evaluations but got {len(bevals)}"
+            for i, ev in zip(b, bevals):
+                if ev is not None:
+                    yield i, ev
+                else:
+                    n_redo += 1
+                    futures[pool.submit(evaluate_doc, inputs[i])] = [i, None]
+        if n_redo:
+            red(f"Failed to parse the batch evaluation of {n_redo}/{len(inputs)} documents, they were evaluated individually.")
+
+
+@optional_typecheck
+def parse_answer_batch_output(output: str, n_docs: int) -> List[Optional[str]]:
+    """parse the output of the batch answer llm into one intermediate
+    answer per document, formatted like the output of the single document
+    answer llm. An answer is None if it is missing or ambiguous, in which
+    case the document has to be answered again individually."""
+    found = {}
+    for match in answer_batch_regex.finditer(output):
+        idoc, answer = int(match.group(1)), match.group(2).strip()
+        if not 1 <= idoc <= n_docs:
+            continue
+        if idoc in found:
+            # ambiguous
+            found[idoc] = None
+        else:
+            found[idoc] = answer
+    return [
+        f"<answer>{found[idoc]}</answer>" if found.get(idoc) else None
+        for idoc in range(1, n_docs + 1)
+    ]
+
+
+@optional_typecheck
+def pack_by_tkn(
+    lengths: List[int],
+    tkn_budget: int,
+    fan_in: int,
+    ) -> List[List[int]]:
+    """group the indexes of consecutive items into batches of at most
+    fan_in items and tkn_budget tokens. A batch always receives at least
+    2 items (if available) otherwise combining would not progress."""
+    assert fan_in >= 2, "fan_in must be at least 2"
+    batches = []
+    current_size = 0
+    for i, length in enumerate(lengths):
+        if batches and (
+            len(batches[-1]) < 2
+            or (
+                len(batches[-1]) < fan_in
+                and current_size + length <= tkn_budget
+            )
+        ):
+            batches[-1].append(i)
+            current_size += length
+        else:
+            batches.append([i])
+            current_size = length
+    return batches
+
+
+@optional_typecheck
+def choose_combine_fan_in(
+    lengths: List[int],
+    tkn_budget: int,
+    max_fan_in: int = 10,
+    ) -> int:
+    """simulate the reduction tree of the intermediate answers for each
+    possible fan-in and return the one minimizing the sum of the latency
+    of each round. The latency of a round is estimated from its largest
+    batch, the length of a combined answer from the longest input."""
+    if len(lengths) <= 2:
+        return max_fan_in
+    answer_tkn = max(lengths)
+    best_fan_in = max_fan_in
+    best_cost = None
+    for fan_in in range(max_fan_in, 1, -1):
+        current = list(lengths)
+        cost = 0
+        while len(current) > 1:
+            batches = pack_by_tkn(current, tkn_budget, fan_in)
+            sizes = [sum(current[i] for i in b) for b in batches]
+            cost += combine_round_overhead_tkn + max(sizes)
+            current = [
+                min(size, answer_tkn) if len(b) > 1 else size
+                for b, size in zip(batches, sizes)
+            ]
+        if best_cost is None or cost < best_cost:
+            best_cost = cost
+            best_fan_in = fan_in
+    return best_fan_in
+
+
+class CombineTree:
+    """reduction tree of the intermediate answers, built while they arrive.
+    The answers are added with put(0, seq, answer), seq being their
+    position, and level n + 1 holds the combinations of the batches of
+    level n. A batch is combined as soon as it is full and the combined
+    answer takes the position of its batch in the next level, so the tree
+    does not depend on the order in which the calls finish. Once every
+    call is done, finish combines what remains level by level."""
+
+    def __init__(
+        self,
+        combine: Callable[[List[str]], str],
+        submit: Callable,
+        tkn_budget: int,
+        fan_in: int,
+        ) -> None:
+        self.combine = combine
+        self.submit = submit
+        self.tkn_budget = tkn_budget
+        self.fan_in = fan_in
+        self.lock = threading.Lock()
+        # for each level: the answers received before an earlier position,
+        # the next position to release, the (answer, tkn_length) released
+        # but not yet combined and the number of batches combined
+        self.waiting = defaultdict(dict)
+        self.next_seq = defaultdict(int)
+        self.pending = defaultdict(list)
+        self.n_batches = defaultdict(int)
+        # combined answers of each level by position, and the size of the
+        # batches combined from each level
+        self.outputs = defaultdict(dict)
+        self.rounds = defaultdict(list)
+        self.streamed = []
+        self.futures = []
+
+    def put(self, level: int, seq: int, answer: str) -> None:
+        length = get_tkn_length(answer)
+        with self.lock:
+            if level:
+                self.outputs[level][seq] = answer
+            self.waiting[level][seq] = (answer, length)
+            while self.next_seq[level] in self.waiting[level]:
+                self.pending[level].append(self.waiting[level].pop(self.next_seq[level]))
+                self.next_seq[level] += 1
+            pending = self.pending[level]
+            while len(pending) >= 2:
+                batch = pack_by_tkn(
+                    lengths=[p[1] for p in pending],
+                    tkn_budget=self.tkn_budget,
+                    fan_in=self.fan_in,
+                )[0]
+                if len(batch) == len(pending) and len(batch) < self.fan_in:
+                    # the batch could still grow
+                    break
+                answers = [p[0] for p in pending[:len(batch)]]
+                del pending[:len(batch)]
+                self.rounds[level].append(len(answers))
+                self.streamed.append(len(answers))
+                self.futures.append(
+                    self.submit(self._combine_into, level + 1, self.n_batches[level], answers)
+                )
+                self.n_batches[level] += 1
+
+    def _combine_into(self, level: int, seq: int, answers: List[str]) -> str:
+        combined = self.combine(answers)
+        self.put(level, seq, combined)
+        return combined
+
+    def finish(self, combine_batches: Callable[[List[List[str]]], List[str]]) -> str:
+        """combine the remaining answers, each level being packed like
+        while streaming, and return the final answer. A lone answer is
+        passed as is to the next level unless it's the last one.
+        combine_batches combines each list of answers it receives."""
+        with self.lock:
+            assert all(f.done() for f in self.futures), "Some combines are still running"
+            assert not any(self.waiting.values()), "Some positions were never received"
+        level = 0
+        while True:
+            levels = [lvl for lvl, p in self.pending.items() if p]
+            if not levels:
+                # no answer at all
+                self.rounds[0].append(0)
+                self.outputs[1][0] = combine_batches([[]])[0]
+                return self.outputs[1][0]
+            top = max(levels)
+            pending = self.pending[level]
+            if level == top and len(pending) == 1 and level > 0:
+                return pending[0][0]
+            if len(pending) <= 1 and level < top:
+                self.pending[level + 1].extend(pending)
+                pending.clear()
+                level += 1
+                continue
+            batches = pack_by_tkn(
+                lengths=[p[1] for p in pending],
+                tkn_budget=self.tkn_budget,
+                fan_in=self.fan_in,
+            ) if len(pending) > 1 else [[0]]
+            to_combine = [b for b in batches if len(b) > 1 or len(batches) == 1]
+            combined = iter(combine_batches([[pending[i][0] for i in b] for b in to_combine]))
+            for b in batches:
+                if len(b) > 1 or len(batches) == 1:
+                    ia = next(combined)
+                    self.outputs[level + 1][self.n_batches[level]] = ia
+                    self.n_batches[level] += 1
+                    self.rounds[level].append(len(b))
+                    self.pending[level + 1].append((ia, get_tkn_length(ia)))
+                else:
+                    self.pending[level + 1].append(pending[b[0]])
+            pending.clear()
+            level += 1
+
+    @property
+    def combine_rounds(self) -> List[List[int]]:
+        "size of the batches combined from each level"
+        return [self.rounds[lvl] for lvl in sorted(self.rounds)]
+
+    @property
+    def combined_answers(self) -> List[List[str]]:
+        "combined answers of each level, in order"
+        return [
+            [self.outputs[lvl][seq] for seq in sorted(self.outputs[lvl])]
+            for lvl in sorted(self.outputs)
+        ]
+
+
+@memoize
+def load_reranker(modelname: str) -> Any:
+    "load a local cross-encoder only once"
+    return CrossEncoder(modelname)
+
+
+@optional_typecheck
+def rerank_docs(
+    query: str,
+    docs: List[Document],
+    modelname: str,
+    ) -> List[Document]:
+    """sort the documents by decreasing relevance to the query according
+    to a local sentence-transformers cross-encoder"""
+    if len(docs) < 2:
+        return docs
+    scores = load_reranker(modelname).predict(
+        [(query, d.page_content) for d in docs]
+    )
+    order = np.argsort(-np.array(scores), kind="stable")
+    return [docs[i] for i in order]
+
+
 @optional_typecheck
 def collate_intermediate_answers(
     list_ia: List[str],
@@ -147,75 +537,68 @@ def semantic_sorting(
     sort the list according to the leaf order. This probably helps the LLM
     to combine the intermediate answers into one.
     Return the text directly if less than 5 texts.
+    As the clustering gets slow with many texts, the optimal leaf ordering
+    is only used for small lists and a greedy nearest neighbour ordering
+    replaces the clustering for very large lists.
     """
     assert texts, "No input text received"
 
-    # deduplicate texts
-    temp = []
-    [temp.append(t) for t in texts if t not in temp]
-    texts = temp
+    # deduplicate texts, keeping the order
+    texts = list(dict.fromkeys(texts))
 
     if len(texts) < 5:
         return texts
 
-    # get embeddings
-    embeds = np.array([embedding_engine.embed_query(t) for t in texts]).squeeze()
-    n_dim = [d for d in embeds.shape if d != len(texts)][0]
+    # get embeddings, in a single batch but without adding the texts to
+    # the embeddings cache as they are only used once
+    embeds = np.asarray(uncached_embeddings(embedding_engine).embed_documents(texts), dtype=np.float32)
+    assert embeds.ndim == 2 and embeds.shape[0] == len(texts), f"Unexpected embeddings shape: {embeds.shape}"
+    n_dim = embeds.shape[1]
     assert n_dim > 2, f"Unexpected number of dimension: {n_dim}, shape was {embeds.shape}"
 
-    if n_dim > 100:
-        scaler = StandardScaler()
-        embed_scaled = scaler.fit_transform(embeds)
-        pca = PCA(n_components=100)
-        embeds_reduced = pca.fit_transform(embed_scaled)
-        assert embeds_reduced.shape[0] == embeds.shape[0]
-        vr = np.cumsum(pca.explained_variance_ratio_)
-        if vr <= 0.95:
-            red(f"Found lower than exepcted PCA explained variance ratio: {vr:.4f}")
-        embeddings = pd.DataFrame(
-            columns=[f"v_{i}" for i in range(n_dim)],
-            index=[i for i in range(len(texts))],
-            data=embeds_reduced,
-        )
+    # get the pairwise euclidean distance matrix
+    sq_norms = np.einsum("ij,ij->i", embeds, embeds)
+    dist = sq_norms[:, None] + sq_norms[None, :] - 2 * (embeds @ embeds.T)
+    np.maximum(dist, 0, out=dist)
+    np.sqrt(dist, out=dist)
+    # make sure it's symetric and the intersection is 0 and not a very small float
+    dist = (dist + dist.T) / 2
+    np.fill_diagonal(dist, 0)
+
+    if len(texts) > semantic_sorting_max_linkage:
+        order = greedy_nearest_neighbour_order(dist)
     else:
-        embeddings = pd.DataFrame(
-            columns=[f"v_{i}" for i in range(n_dim)],
-            index=[i for i in range(len(texts))],
-            data=embeds,
+        # get the hierarchichal semantic sorting order
+        condensed = scipy.spatial.distance.squareform(dist, checks=False)
+        Z = scipy.cluster.hierarchy.linkage(
+            condensed,
+            method='ward',
+            optimal_ordering=len(texts) <= semantic_sorting_max_optimal_ordering,
         )
-
-    # get the pairwise distance matrix
-    pairwise_distances = metrics.pairwise_distances
-    dist = pd.DataFrame(
-        columns=embeddings.index,
-        index=embeddings.index,
-        data=pairwise_distances(
-            embeddings.values,
-            n_jobs=-1,
-            metric="euclidean",
-            )
-        )
-    # make sure the intersection is 0 and not a very small float
-    for ind in dist.index:
-        dist.at[ind, ind] = 0
-    # make sure it's symetric
-    dist = dist.add(dist.T).div(2)
-
-    # get the hierarchichal semantic sorting order
-    dist = scipy.spatial.distance.squareform(dist.values)  # convert to condensed format
-    Z = scipy.cluster.hierarchy.linkage(dist, method='ward', optimal_ordering=True)
-    order = scipy.cluster.hierarchy.leaves_list(Z)
+        order = scipy.cluster.hierarchy.leaves_list(Z)
     out_texts = [texts[o] for o in order]
-    assert len(set(out_texts)) == len(out_texts), "duplicates"
     assert len(out_texts) == len(texts), "extra out_texts"
-    assert not any(o for o in out_texts if o not in texts)
-    assert not any(t for t in texts if t not in out_texts)
-    # whi(f"Done in {int(time.time()-start)}s")
-    assert len(texts) == len(out_texts)
+    assert set(out_texts) == set(texts), "texts differ after sorting"
 
     return out_texts
 
 
+@optional_typecheck
+def greedy_nearest_neighbour_order(dist: np.ndarray) -> List[int]:
+    """order the items by starting from the first one and always jumping
+    to the closest item not yet visited"""
+    n = dist.shape[0]
+    visited = np.zeros(n, dtype=bool)
+    order = [0]
+    visited[0] = True
+    for _ in range(n - 1):
+        row = np.where(visited, np.inf, dist[order[-1]])
+        nxt = int(np.argmin(row))
+        order.append(nxt)
+        visited[nxt] = True
+    return order
+
+
 @optional_typecheck
 def pbar_chain(
     llm: Union[ChatLiteLLM, ChatOpenAI, FakeListChatModel],
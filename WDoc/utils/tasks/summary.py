@@ -3,15 +3,146 @@ Chain (logic) used to summarize a document.
 """
 
 from textwrap import indent
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from typing import List, Any, Union, Tuple
 
 from langchain.docstore.document import Document
 
-from ..prompts import BASE_SUMMARY_PROMPT, RECURSION_INSTRUCTION, PREV_SUMMARY_TEMPLATE
+from ..prompts import BASE_SUMMARY_PROMPT, RECURSION_INSTRUCTION, PREV_SUMMARY_TEMPLATE, PREV_TEXT_TEMPLATE
 from ..logger import whi, red
 from ..typechecker import optional_typecheck
-from ..misc import thinking_answer_parser
+from ..misc import thinking_answer_parser, hasher, summary_chunks_cache
+
+# a chunk summary is only reused if this many previous chunks are unchanged
+# too, as they are the context used to summarize it
+summary_cache_context_window = 1
+
+
+@optional_typecheck
+def summarize_chunk(
+    text: str,
+    metadata: str,
+    language: str,
+    llm: Any,
+    previous_summary: str,
+    n_recursion: int = 0,
+) -> Tuple[str, List[str], int, int]:
+    """summarize a single chunk, returns the cleaned up summary, its lines
+    and the number of prompt and completion tokens used"""
+    messages = BASE_SUMMARY_PROMPT.format_messages(
+        text=text,
+        metadata=metadata,
+        language=language,
+        previous_summary=previous_summary,
+        recursion_instruction="" if not n_recursion else RECURSION_INSTRUCTION
+    )
+    if " object at " in llm._get_llm_string():
+        red(
+            "Found llm._get_llm_string() value that potentially "
+            f"invalidates the cache: '{llm._get_llm_string()}'\n"
+            f"Related github issue: 'https://github.com/langchain-ai/langchain/issues/23257'")
+    output = llm._generate_with_cache(messages)
+    if output.generations[0].generation_info is None:
+        assert "fake-list-chat-model" in llm._get_llm_string()
+        finish = "stop"
+    else:
+        finish = output.generations[0].generation_info["finish_reason"]
+        assert finish == "stop", f"Unexpected finish_reason: '{finish}'"
+        assert len(output.generations) == 1
+    out = output.generations[0].text
+    if output.llm_output:  # only present if not caching
+        new_p = output.llm_output["token_usage"]["prompt_tokens"]
+        new_c = output.llm_output["token_usage"]["completion_tokens"]
+    else:
+        new_p = 0
+        new_c = 0
+
+    parsed = thinking_answer_parser(out)
+
+    output_lines = parsed["answer"].rstrip().splitlines(keepends=True)
+
+    for il, ll in enumerate(output_lines):
+        # remove if contains no alphanumeric character
+        if not any(char.isalpha() for char in ll.strip()):
+            output_lines[il] = None
+            continue
+
+        ll = ll.rstrip()
+
+        # replace tabs by 4 spaces
+        ll = ll.replace("\t", "    ")
+        ll = ll.replace("	", "    ")
+
+        stripped = ll.lstrip()
+
+        # if a line starts with * instead of -, fix it
+        if stripped.startswith("* "):
+            ll = ll.replace("*", "-", 1)
+
+        stripped = ll.lstrip()
+        # beginning with long dash
+        if stripped.startswith("—"):
+            ll = ll.replace("—", "-")
+
+        # begin by '-' but not by '- '
+        stripped = ll.lstrip()
+        if stripped.startswith("-") and not stripped.startswith("- "):
+            ll = ll.replace("-", "- ", 1)
+
+        # if a line does not start with - fix it
+        stripped = ll.lstrip()
+        if not stripped.startswith("- "):
+            ll = ll.replace(stripped[0], "- " + stripped[0], 1)
+
+        ll = ll.replace("****", "")
+
+        # if contains uneven number of bold markers
+        if ll.count("**") % 2 == 1:
+            ll += "**"  # end the bold
+        # and italic
+        if ll.count("*") % 2 == 1:
+            ll += "*"  # end the italic
+
+        output_lines[il] = ll
+
+    output_lines = [ll for ll in output_lines if ll]
+    output_text = "\n".join(output_lines)
+
+    return output_text, output_lines, new_p, new_c
+
+
+@summary_chunks_cache.cache(ignore=["text", "metadata", "llm", "previous_summary"])
+def cached_summarize_chunk(
+    content_hash: str,
+    context_hashes: List[str],
+    settings: str,
+    text: str,
+    metadata: str,
+    language: str,
+    llm: Any,
+    previous_summary: str,
+    n_recursion: int = 0,
+) -> Tuple[str, List[str], int, int]:
+    """same as summarize_chunk but cached by the hash of the chunk, of
+    the chunks before it and by the summary settings, so that only
+    the modified chunks of a document have to be summarized again"""
+    return summarize_chunk(
+        text=text,
+        metadata=metadata,
+        language=language,
+        llm=llm,
+        previous_summary=previous_summary,
+        n_recursion=n_recursion,
+    )
+
+
+@optional_typecheck
+def text_tail(text: str, n_lines: int = 5, max_chars: int = 1000) -> str:
+    "last non empty lines of a text, used as context for the next chunk"
+    lines = [ll for ll in text.rstrip().splitlines() if ll.strip()]
+    return "\n".join(lines[-n_lines:])[-max_chars:]
+
 
 @optional_typecheck
 def do_summarize(
@@ -23,8 +154,16 @@ def do_summarize(
     llm_price: List[float],
     verbose: bool,
     n_recursion: int = 0,
+    n_workers: int = 0,
+    chunk_cache: bool = False,
 ) -> Tuple[str, int, Union[float, int], int, int]:
-    "summarize each chunk of a long document"
+    """summarize each chunk of a long document. If n_workers is not 0, the
+    chunks are summarized concurrently by that many workers, each chunk
+    being given the end of the text of the previous chunk instead of the
+    end of its summary. If chunk_cache is True, the summary of each chunk
+    is cached so that only the modified chunks (and the
+    summary_cache_context_window chunks after them) are summarized again
+    when the document changes."""
     summaries = []
     previous_summary = ""
 
@@ -34,105 +173,87 @@ def do_summarize(
     total_cost = 0
 
     assert "[PROGRESS]" in metadata
-    for ird, rd in tqdm(enumerate(docs), desc="Summarising splits", total=len(docs)):
-        fixed_index = f"{ird + 1}/{len(docs)}"
-
-        messages = BASE_SUMMARY_PROMPT.format_messages(
-            text=rd.page_content,
-            metadata=metadata.replace("[PROGRESS]", fixed_index),
-            language=language,
-            previous_summary=previous_summary,
-            recursion_instruction="" if not n_recursion else RECURSION_INSTRUCTION
-        )
-        if " object at " in llm._get_llm_string():
-            red(
-                "Found llm._get_llm_string() value that potentially "
-                f"invalidates the cache: '{llm._get_llm_string()}'\n"
-                f"Related github issue: 'https://github.com/langchain-ai/langchain/issues/23257'")
-        output = llm._generate_with_cache(messages)
-        if output.generations[0].generation_info is None:
-            assert "fake-list-chat-model" in llm._get_llm_string()
-            finish = "stop"
-        else:
-            finish = output.generations[0].generation_info["finish_reason"]
-            assert finish == "stop", f"Unexpected finish_reason: '{finish}'"
-            assert len(output.generations) == 1
-        out = output.generations[0].text
-        if output.llm_output:  # only present if not caching
-            new_p = output.llm_output["token_usage"]["prompt_tokens"]
-            new_c = output.llm_output["token_usage"]["completion_tokens"]
-        else:
-            new_p = 0
-            new_c = 0
-        total_tokens[0] += new_p
-        total_tokens[1] += new_c
-        total_cost += (new_p * llm_price[0] + new_c + llm_price[1]) / 1e6
-
-        # the callback need to be updated manually when _generate is called
-        llm.callbacks[0].prompt_tokens += new_p
-        llm.callbacks[0].completion_tokens += new_c
-        llm.callbacks[0].total_tokens += new_p + new_c
-
-        parsed = thinking_answer_parser(out)
-
-        output_lines = parsed["answer"].rstrip().splitlines(keepends=True)
-
-        for il, ll in enumerate(output_lines):
-            # remove if contains no alphanumeric character
-            if not any(char.isalpha() for char in ll.strip()):
-                output_lines[il] = None
-                continue
 
-            ll = ll.rstrip()
+    hashes = [d.metadata.get("content_hash") or hasher(d.page_content) for d in docs]
+    # the context given with each chunk differs between the sequential
+    # (previous summary) and the parallel (previous text) modes
+    mode = "parallel" if n_workers else "sequential"
+    settings = f"{llm._get_llm_string()}|{metadata}|{language}|{mode}"
+    n_reused = 0
 
-            # replace tabs by 4 spaces
-            ll = ll.replace("\t", "    ")
-            ll = ll.replace("	", "    ")
-
-            stripped = ll.lstrip()
-
-            # if a line starts with * instead of -, fix it
-            if stripped.startswith("* "):
-                ll = ll.replace("*", "-", 1)
-
-            stripped = ll.lstrip()
-            # beginning with long dash
-            if stripped.startswith("—"):
-                ll = ll.replace("—", "-")
-
-            # begin by '-' but not by '- '
-            stripped = ll.lstrip()
-            if stripped.startswith("-") and not stripped.startswith("- "):
-                ll = ll.replace("-", "- ", 1)
-
-            # if a line does not start with - fix it
-            stripped = ll.lstrip()
-            if not stripped.startswith("- "):
-                ll = ll.replace(stripped[0], "- " + stripped[0], 1)
-
-            ll = ll.replace("****", "")
+    def summarize(ird: int, **kwargs) -> Tuple[str, List[str], int, int]:
+        nonlocal n_reused
+        if not chunk_cache:
+            return summarize_chunk(**kwargs)
+        key = dict(
+            content_hash=hashes[ird],
+            context_hashes=hashes[max(0, ird - summary_cache_context_window):ird],
+            settings=settings,
+        )
+        if cached_summarize_chunk.check_call_in_cache(**key, **kwargs):
+            n_reused += 1
+            # the tokens were already paid for
+            return cached_summarize_chunk(**key, **kwargs)[:2] + (0, 0)
+        return cached_summarize_chunk(**key, **kwargs)
 
-            # if contains uneven number of bold markers
-            if ll.count("**") % 2 == 1:
-                ll += "**"  # end the bold
-            # and italic
-            if ll.count("*") % 2 == 1:
-                ll += "*"  # end the italic
+    if not n_workers:
+        results = []
+        for ird, rd in tqdm(enumerate(docs), desc="Summarising splits", total=len(docs)):
+            fixed_index = f"{ird + 1}/{len(docs)}"
+            result = summarize(
+                ird,
+                text=rd.page_content,
+                metadata=metadata.replace("[PROGRESS]", fixed_index),
+                language=language,
+                llm=llm,
+                previous_summary=previous_summary,
+                n_recursion=n_recursion,
+            )
+            results.append(result)
+            if verbose:
+                whi(result[0])
+            previous_summary = PREV_SUMMARY_TEMPLATE.replace(
+                "{previous_summary}",
+                "...\n" + "\n".join(result[1][-5:]),
+            )
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            futures = [
+                pool.submit(
+                    summarize,
+                    ird,
+                    text=rd.page_content,
+                    metadata=metadata.replace("[PROGRESS]", f"{ird + 1}/{len(docs)}"),
+                    language=language,
+                    llm=llm,
+                    previous_summary="" if ird == 0 else PREV_TEXT_TEMPLATE.replace(
+                        "{previous_text}",
+                        "...\n" + text_tail(docs[ird - 1].page_content),
+                    ),
+                    n_recursion=n_recursion,
+                )
+                for ird, rd in enumerate(docs)
+            ]
+            for _ in tqdm(as_completed(futures), desc="Summarising splits", total=len(docs)):
+                pass
+            results = [f.result() for f in futures]
 
-            output_lines[il] = ll
+    for output_text, output_lines, new_p, new_c in results:
+        total_tokens[0] += new_p
+        total_tokens[1] += new_c
+        total_cost += new_p * llm_price[0] + new_c * llm_price[1]
 
-        output_text = "\n".join([s for s in output_lines if s])
+        # the callback need to be updated manually when _generate is called
+        llm.callbacks[0].add_tokens(new_p, new_c)
 
-        if verbose:
+        if verbose and n_workers:
             whi(output_text)
 
-        previous_summary = PREV_SUMMARY_TEMPLATE.replace(
-            "{previous_summary}",
-            "...\n" + "\n".join(output_lines[-5:]),
-        )
-
         summaries.append(output_text)
 
+    if n_reused:
+        whi(f"Reused the cached summary of {n_reused}/{len(docs)} chunks")
+
     # combine summaries as one string separated by markdown separator
     n = len(summaries)
     if n > 1:
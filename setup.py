@@ -76,7 +76,7 @@ setup(
         'beautifulsoup4>=4.10.0',
         'fire>=0.6.0',
         'ftfy>=6.1.1',
-        'joblib>=1.2.0',
+        'joblib>=1.3.0',
         'langchain>=0.2.1,<0.2.5',
         'langchain-community>=0.2.1',
         'langchain-openai>=0.1.8',
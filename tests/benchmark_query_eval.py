@@ -0,0 +1,103 @@
+"""
+Compare the single document and the batch modes of the eval stage of the
+query task (--query_eval_batch_tkn_size).
+
+Both modes go through iter_evaluations with the real eval prompts and
+parsers. The eval llm is DeterministicEvalLLM: each chunk gets its own
+verdict depending on whether it mentions the keyword, so a parsing or
+mapping error changes the verdicts. Some chunks are left out of the batch
+answers to exercise the individual fallback. Each call sleeps a fixed
+latency plus a per prompt token latency to simulate a remote model, the
+reported times are measured.
+
+Usage:
+    python tests/benchmark_query_eval.py --n_chunks=200 --batch_tkn_size=4000
+"""
+
+import time
+
+import fire
+
+from WDoc.utils.misc import get_tkn_length
+from WDoc.utils.tasks.query import iter_evaluations
+
+from fake_llm import DeterministicEvalLLM
+
+QUESTION = "Which elements are used in rechargeable batteries?"
+TOPICS = [
+    "lithium ions move between the electrodes of rechargeable batteries",
+    "copper is drawn into wires because it conducts electricity",
+    "helium cools the superconducting magnets of scanners",
+    "iron is alloyed with carbon to make steel",
+    "nickel and cadmium electrodes were common in rechargeable batteries",
+    "gold does not corrode and is used in jewelry",
+]
+
+
+def make_chunks(n_chunks: int, chunk_sentences: int, garble_every: int) -> list:
+    "each chunk repeats one topic with its index, so that no two chunks are identical"
+    chunks = []
+    for i in range(n_chunks):
+        topic = TOPICS[(i * 7) % len(TOPICS)]
+        chunk = " ".join(f"Note {i}.{j}: {topic}." for j in range(chunk_sentences))
+        if garble_every and i % garble_every == garble_every - 1:
+            chunk += " GARBLE"
+        chunks.append(chunk)
+    return chunks
+
+
+def run(chunks: list, batch_tkn_size: int, max_workers: int, call_latency: float, tkn_latency: float) -> dict:
+    llm = DeterministicEvalLLM(
+        keyword="rechargeable batteries",
+        garble_keyword="GARBLE",
+        reverse=True,
+        call_latency=call_latency,
+        tkn_latency=tkn_latency,
+    )
+    start = time.time()
+    evals = dict(iter_evaluations(
+        inputs=[{"doc": c, "q": QUESTION} for c in chunks],
+        evaluate_doc=llm.evaluate_doc,
+        evaluate_batch=llm.evaluate_batch,
+        batch_tkn_size=batch_tkn_size,
+        max_workers=max_workers,
+    ))
+    return {
+        "elapsed": time.time() - start,
+        "verdicts": [evals[i] for i in range(len(chunks))],
+        "single_calls": llm.single_calls,
+        "batch_calls": llm.batch_calls,
+        "truth": [[llm.verdict(c)] for c in chunks],
+    }
+
+
+def main(
+    n_chunks: int = 200,
+    chunk_sentences: int = 20,
+    batch_tkn_size: int = 4000,
+    max_workers: int = 10,
+    garble_every: int = 25,
+    call_latency: float = 0.3,
+    tkn_latency: float = 0.0001,
+) -> None:
+    chunks = make_chunks(n_chunks, chunk_sentences, garble_every)
+    n_tkn = sum(get_tkn_length(c) for c in chunks)
+    print(
+        f"{n_chunks} chunks of about {n_tkn // n_chunks} tokens, {max_workers} workers, "
+        f"simulated latency {call_latency}s per call + {tkn_latency * 1000:g}ms per prompt token"
+    )
+    results = {}
+    for mode, size in [("single", 0), ("batch", batch_tkn_size)]:
+        res = run(chunks, size, max_workers, call_latency, tkn_latency)
+        results[mode] = res
+        n_relevant = sum(v == ["1"] for v in res["verdicts"])
+        print(
+            f"{mode:>6}: {res['elapsed']:.2f}s, {res['batch_calls']} batch calls, "
+            f"{res['single_calls']} single calls, {n_relevant}/{n_chunks} relevant, "
+            f"verdicts {'match' if res['verdicts'] == res['truth'] else 'DIFFER FROM'} the expected ones"
+        )
+    assert results["single"]["verdicts"] == results["batch"]["verdicts"] == results["single"]["truth"]
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
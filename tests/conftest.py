@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# makes the helpers of the tests directory importable
+sys.path.insert(0, str(Path(__file__).parent))
@@ -0,0 +1,87 @@
+"""
+Deterministic stand-in for the query eval llm, answering the real eval
+prompts of WDoc: a document is relevant if it contains a keyword.
+"""
+
+import re
+import threading
+import time
+from typing import List, Optional
+
+from WDoc.utils.misc import get_tkn_length
+from WDoc.utils.prompts import prompts
+from WDoc.utils.tasks.query import (
+    format_doc_batch,
+    parse_eval_output,
+    parse_eval_batch_outputs,
+)
+
+batch_doc_regex = re.compile(r"DOCUMENT #(\d+):\n```\n(.*?)\n```\n", flags=re.DOTALL)
+single_doc_regex = re.compile(r"TEXT DOCUMENT:\n```\n(.*?)\n```", flags=re.DOTALL)
+
+
+class DeterministicEvalLLM:
+    """answers '1' for the documents containing keyword and '0' for the
+    others. In a batch answer, the documents containing garble_keyword are
+    left out, like a model skipping lines, and the lines are in reverse
+    order if reverse is True. Each call sleeps call_latency seconds plus
+    tkn_latency seconds per prompt token to simulate a remote model."""
+
+    def __init__(
+        self,
+        keyword: str,
+        garble_keyword: Optional[str] = None,
+        reverse: bool = False,
+        call_latency: float = 0.0,
+        tkn_latency: float = 0.0,
+    ) -> None:
+        self.keyword = keyword
+        self.garble_keyword = garble_keyword
+        self.reverse = reverse
+        self.call_latency = call_latency
+        self.tkn_latency = tkn_latency
+        self.lock = threading.Lock()
+        self.single_calls = 0
+        self.batch_calls = 0
+
+    def verdict(self, doc: str) -> str:
+        return "1" if self.keyword in doc else "0"
+
+    def __call__(self, messages: List) -> str:
+        prompt = messages[-1].content
+        if self.call_latency or self.tkn_latency:
+            time.sleep(
+                self.call_latency
+                + self.tkn_latency * sum(get_tkn_length(m.content) for m in messages)
+            )
+        docs = batch_doc_regex.findall(prompt)
+        if docs:
+            with self.lock:
+                self.batch_calls += 1
+            lines = [
+                f"{i}: {self.verdict(doc)}"
+                for i, doc in docs
+                if not (self.garble_keyword and self.garble_keyword in doc)
+            ]
+            if self.reverse:
+                lines = lines[::-1]
+            return "<thinking>\nchecking each document\n</thinking>\n<answer>\n" + "\n".join(lines) + "\n</answer>"
+        with self.lock:
+            self.single_calls += 1
+        doc = single_doc_regex.search(prompt).group(1)
+        return f"<thinking>\nchecking the document\n</thinking>\n<answer>{self.verdict(doc)}</answer>"
+
+    def evaluate_doc(self, inputs: dict) -> List[str]:
+        "same role as evaluate_doc_chain of WDoc.query_task"
+        return [parse_eval_output(self(prompts.evaluate.format_messages(**inputs)))]
+
+    def evaluate_batch(self, inputs: dict) -> List[Optional[List[str]]]:
+        "same role as evaluate_doc_batch_chain of WDoc.query_task"
+        output = self(
+            prompts.evaluate_batch.format_messages(
+                q=inputs["q"],
+                n_docs=len(inputs["docs"]),
+                docs=format_doc_batch(inputs["docs"]),
+            )
+        )
+        return parse_eval_batch_outputs([output], len(inputs["docs"]))
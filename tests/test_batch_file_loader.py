@@ -0,0 +1,114 @@
+import time
+from pathlib import Path
+
+import pytest
+from langchain.docstore.document import Document
+
+from WDoc.utils import batch_file_loader
+from WDoc.utils.batch_file_loader import (
+    match_glob_parts,
+    walk_files,
+    compile_path_regex,
+    write_journal_entry,
+    read_journal_entry,
+)
+
+FILES = [
+    "a.txt",
+    "b.md",
+    ".hidden.txt",
+    "docs/c.txt",
+    "docs/d.pdf",
+    "docs/sub/e.txt",
+    "docs/sub/deeper/f.txt",
+    "docs/sub/deeper/g.md",
+    "other/docs/h.txt",
+    "other/x/sub/i.txt",
+    "tmp/j.txt",
+]
+
+
+@pytest.fixture
+def tree(tmp_path: Path) -> Path:
+    for f in FILES:
+        path = tmp_path / f
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f)
+    return tmp_path
+
+
+def test_match_glob_parts():
+    assert match_glob_parts(["a.txt"], ["**", "*.txt"])
+    assert match_glob_parts(["x", "y", "a.txt"], ["**", "*.txt"])
+    assert not match_glob_parts(["x", "a.md"], ["**", "*.txt"])
+    assert match_glob_parts(["docs", "a.txt"], ["**", "docs", "*.txt"])
+    assert match_glob_parts(["x", "docs", "a.txt"], ["**", "docs", "*.txt"])
+    assert not match_glob_parts(["docs", "x", "a.txt"], ["**", "docs", "*.txt"])
+    assert match_glob_parts(["docs", "x", "y", "a.txt"], ["**", "docs", "**", "*.txt"])
+    assert match_glob_parts(["docs", "a.txt"], ["**", "docs", "**", "*.txt"])
+    assert not match_glob_parts([], ["**", "*.txt"])
+
+
+@pytest.mark.parametrize(
+    "pattern",
+    ["*", "*.txt", "*.md", "docs/*.txt", "sub/*", "docs/**/*.txt", "**/sub/**/*.txt", "x/*/*.txt", "?.txt", "nothing*"],
+)
+def test_walk_files_matches_rglob(tree, pattern):
+    expected = sorted(str(p) for p in tree.rglob(pattern) if p.is_file())
+    found = sorted(entry.path for entry in walk_files(str(tree), pattern, prune=[]))
+    assert found == expected
+
+
+def test_walk_files_prune(tree):
+    prune = [compile_path_regex("/tmp/$"), compile_path_regex("/deeper/")]
+    found = sorted(
+        str(Path(entry.path).relative_to(tree))
+        for entry in walk_files(str(tree), "*.txt", prune=prune)
+    )
+    assert found == sorted(
+        f for f in FILES
+        if f.endswith(".txt") and not f.startswith("tmp/") and "/deeper/" not in f
+    )
+
+
+def test_journal_roundtrip(tmp_path):
+    docs = [
+        Document(page_content="first page", metadata={"path": "a.pdf", "page": 1, "content_hash": "abc"}),
+        Document(page_content="été 数据 🙂\n" * 1000, metadata={"path": "a.pdf", "tags": ["x", "y"]}),
+    ]
+    path = tmp_path / "0.journal"
+    write_journal_entry(path, docs)
+    assert read_journal_entry(path) == docs
+    # the temporary file was renamed
+    assert [p.name for p in tmp_path.iterdir()] == ["0.journal"]
+
+    # overwriting replaces the entry
+    write_journal_entry(path, docs[:1])
+    assert read_journal_entry(path) == docs[:1]
+    write_journal_entry(path, [])
+    assert read_journal_entry(path) == []
+
+
+def fake_loader(filetype: str, delay: float, loading_failure: str = "warn") -> list:
+    time.sleep(delay)
+    return [Document(page_content=f"loaded after {delay}s", metadata={})]
+
+
+def test_thread_imap_timeout(monkeypatch):
+    monkeypatch.setattr(batch_file_loader, "load_one_doc_wrapped", fake_loader)
+    tasks = [{"filetype": "txt", "delay": d} for d in [0.05, 3, 0.1, 0.05, 0.2]]
+    start = time.time()
+    out = dict(batch_file_loader.thread_imap(tasks, n_jobs=2, timeout=1))
+    # the stuck document does not hold the others
+    assert time.time() - start < 2.5
+    assert sorted(out) == list(range(len(tasks)))
+    assert "more than 1s" in out[1]
+    for i in [0, 2, 3, 4]:
+        assert out[i][0].page_content == f"loaded after {tasks[i]['delay']}s"
+
+
+def test_thread_imap_timeout_crash(monkeypatch):
+    monkeypatch.setattr(batch_file_loader, "load_one_doc_wrapped", fake_loader)
+    tasks = [{"filetype": "txt", "delay": 3, "loading_failure": "crash"}]
+    with pytest.raises(Exception, match="more than 1s"):
+        list(batch_file_loader.thread_imap(tasks, n_jobs=2, timeout=1))
@@ -0,0 +1,37 @@
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import InMemoryByteStore
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from WDoc.utils.compression import compress_text, split_sentences
+
+TEXT = " ".join(
+    f"Sentence number {i} talks about {'batteries and lithium' if i % 3 else 'the weather today'}."
+    for i in range(30)
+)
+
+
+def test_split_sentences_keeps_the_text():
+    sentences = split_sentences(TEXT)
+    assert len(sentences) == 30
+    assert "".join(sentences) == TEXT
+
+
+def test_compression_ratio():
+    compressed = compress_text(TEXT, ratio=0.5, method="textrank")
+    kept = split_sentences(compressed)
+    assert 0 < len(kept) < 30
+    # the kept sentences are in their original order
+    assert [s.strip() for s in kept] == [s.strip() for s in split_sentences(TEXT) if s.strip() in compressed]
+    assert compress_text(TEXT, ratio=1, method="textrank") == TEXT
+
+
+def test_embeddings_compression_does_not_fill_the_cache():
+    store = InMemoryByteStore()
+    embeddings = CacheBackedEmbeddings.from_bytes_store(
+        DeterministicFakeEmbedding(size=16),
+        store,
+        namespace="test",
+    )
+    compressed = compress_text(TEXT, ratio=0.5, method="embeddings", embedding_engine=embeddings)
+    assert 0 < len(compressed) < len(TEXT)
+    assert list(store.yield_keys()) == []
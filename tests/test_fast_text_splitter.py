@@ -0,0 +1,66 @@
+import random
+
+import pytest
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from WDoc.utils.customs.fast_text_splitter import FastRecursiveTextSplitter, encoded_length
+from WDoc.utils.misc import recur_separator
+
+ENCODING = "cl100k_base"
+
+
+def make_text(seed: int, n_paragraphs: int) -> str:
+    "random text with every kind of separator, unicode and long words"
+    rng = random.Random(seed)
+    words = ["lorem", "ipsum", "dolor", "été", "naïve", "数据", "🙂", "x" * 80, "a.b.c", "well..."]
+    paragraphs = []
+    for _ in range(n_paragraphs):
+        sentences = [
+            " ".join(rng.choice(words) for _ in range(rng.randint(1, 40))) + rng.choice([".", "...", "", "\n"])
+            for _ in range(rng.randint(1, 8))
+        ]
+        paragraphs.append(" ".join(sentences))
+    return "".join(p + rng.choice(["\n\n", "\n\n\n", "\n\n\n\n", "\n", " "]) for p in paragraphs)
+
+
+@pytest.mark.parametrize("seed", range(6))
+@pytest.mark.parametrize("chunk_size,chunk_overlap", [(50, 10), (200, 50), (1000, 300)])
+def test_same_chunks_as_langchain(seed, chunk_size, chunk_overlap):
+    text = make_text(seed, n_paragraphs=60)
+    fast = FastRecursiveTextSplitter(
+        separators=recur_separator,
+        encoding_name=ENCODING,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+    )
+    reference = RecursiveCharacterTextSplitter(
+        separators=recur_separator,
+        length_function=lambda t: encoded_length(t, ENCODING),
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+    )
+    assert fast.split_text(text) == reference.split_text(text)
+
+
+def test_chunk_size_in_tokens():
+    text = make_text(0, n_paragraphs=100)
+    splitter = FastRecursiveTextSplitter(
+        separators=recur_separator,
+        encoding_name=ENCODING,
+        chunk_size=120,
+        chunk_overlap=20,
+    )
+    chunks = splitter.split_text(text)
+    assert len(chunks) > 1
+    assert all(encoded_length(c, ENCODING) <= 120 for c in chunks)
+
+
+def test_short_and_empty_text():
+    splitter = FastRecursiveTextSplitter(
+        separators=recur_separator,
+        encoding_name=ENCODING,
+        chunk_size=100,
+        chunk_overlap=10,
+    )
+    assert splitter.split_text("") == []
+    assert splitter.split_text("  short text.  ") == ["short text."]
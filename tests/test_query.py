@@ -0,0 +1,260 @@
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import pytest
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import InMemoryByteStore
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+from WDoc.utils.errors import InvalidDocEvaluationByLLMEval
+from WDoc.utils.tasks.query import (
+    parse_eval_output,
+    parse_eval_batch_output,
+    parse_eval_batch_outputs,
+    parse_answer_batch_output,
+    batch_docs_by_tkn,
+    pack_by_tkn,
+    choose_combine_fan_in,
+    iter_evaluations,
+    CombineTree,
+    semantic_sorting,
+)
+
+from fake_llm import DeterministicEvalLLM
+
+QUESTION = "What is the melting point of gallium?"
+
+
+def make_inputs(n: int, relevant_every: int = 3, garbled: tuple = ()) -> list:
+    "each document has its own content, the relevant ones mention gallium"
+    inputs = []
+    for i in range(n):
+        words = ["gallium" if i % relevant_every == 0 else "copper"]
+        if i in garbled:
+            words.append("GARBLE")
+        doc = f"Document about item {i}: " + " ".join(words) + " has properties. " * 5
+        inputs.append({"doc": doc, "q": QUESTION})
+    return inputs
+
+
+def collect(evaluations) -> dict:
+    out = {}
+    for i, ev in evaluations:
+        assert i not in out, f"document {i} evaluated twice"
+        out[i] = ev
+    return out
+
+
+def test_parse_eval_output():
+    assert parse_eval_output("<answer>0</answer>") == "0"
+    assert parse_eval_output("<answer>1</answer>") == "1"
+    assert parse_eval_output("<answer>2</answer>") == "1"
+    for bad in ["", "<answer>yes</answer>", "<answer>1 or 0</answer>", "<answer>-1</answer>"]:
+        with pytest.raises(InvalidDocEvaluationByLLMEval):
+            parse_eval_output(bad)
+
+
+def test_parse_eval_batch_output_maps_lines_to_documents():
+    output = "<thinking>hmm</thinking>\n<answer>\n3: 0\nDocument #1: 1\n2: 2\n</answer>"
+    assert parse_eval_batch_output(output, n_docs=3) == ["1", "1", "0"]
+
+
+def test_parse_eval_batch_output_missing_ambiguous_and_out_of_range():
+    output = "<answer>\n1: 1\n3: 1\n3: 0\n4: 1\n7: 0\n</answer>"
+    # 2 is missing, 3 is ambiguous, 7 is out of range
+    assert parse_eval_batch_output(output, n_docs=4) == ["1", None, None, "1"]
+    # the same verdict repeated is not ambiguous
+    assert parse_eval_batch_output("<answer>\n1: 0\n1: 0\n</answer>", n_docs=1) == ["0"]
+
+
+def test_parse_eval_batch_output_unparsable():
+    assert parse_eval_batch_output("", n_docs=2) == [None, None]
+    assert parse_eval_batch_output("<answer>\nall relevant\n</answer>", n_docs=2) == [None, None]
+
+
+def test_parse_eval_batch_outputs_needs_every_generation():
+    outputs = [
+        "<answer>\n1: 1\n2: 0\n3: 1\n</answer>",
+        "<answer>\n1: 0\n3: 1\n</answer>",
+    ]
+    assert parse_eval_batch_outputs(outputs, n_docs=3) == [["1", "0"], None, ["1", "1"]]
+
+
+def test_parse_answer_batch_output():
+    output = (
+        "<answer_2>second</answer_2>\n<answer_1>first\nline</answer_1>\n"
+        "<answer_3>a</answer_3><answer_3>b</answer_3>\n"
+        "<answer_4> </answer_4>\n<answer_9>out of range</answer_9>"
+    )
+    assert parse_answer_batch_output(output, n_docs=5) == [
+        "<answer>first\nline</answer>",
+        "<answer>second</answer>",
+        None,  # ambiguous
+        None,  # empty
+        None,  # missing
+    ]
+
+
+def test_batch_docs_by_tkn_keeps_order_and_budget():
+    texts = [f"text number {i} " * (5 if i % 4 else 60) for i in range(20)]
+    batches = batch_docs_by_tkn(texts, batch_tkn_size=150)
+    assert [i for b in batches for i in b] == list(range(20))
+    for b in batches:
+        assert b == list(range(b[0], b[-1] + 1))
+
+
+def test_pack_by_tkn():
+    assert pack_by_tkn([100, 100, 100, 900, 100, 50], tkn_budget=500, fan_in=3) == [[0, 1, 2], [3, 4], [5]]
+    # at least 2 items per batch even above the budget
+    assert pack_by_tkn([900, 900, 900], tkn_budget=500, fan_in=3) == [[0, 1], [2]]
+    assert pack_by_tkn([10] * 7, tkn_budget=10_000, fan_in=2) == [[0, 1], [2, 3], [4, 5], [6]]
+    with pytest.raises(AssertionError):
+        pack_by_tkn([10, 10], tkn_budget=100, fan_in=1)
+
+
+def test_choose_combine_fan_in():
+    assert choose_combine_fan_in([100, 100], tkn_budget=16000) == 10
+    for length in [300, 3000, 8000]:
+        lengths = [length] * 20
+        fan_in = choose_combine_fan_in(lengths, tkn_budget=16000)
+        assert 2 <= fan_in <= 10
+        for b in pack_by_tkn(lengths, tkn_budget=16000, fan_in=fan_in):
+            assert len(b) <= 2 or sum(lengths[i] for i in b) <= 16000
+    # short answers are all combined at once
+    assert choose_combine_fan_in([300] * 10, tkn_budget=16000) == 10
+    assert choose_combine_fan_in([300] * 20, tkn_budget=16000, max_fan_in=4) <= 4
+
+
+@pytest.mark.parametrize("reverse", [False, True])
+@pytest.mark.parametrize("batch_tkn_size", [0, 60, 200, 100_000])
+def test_iter_evaluations_verdict_of_each_document(batch_tkn_size, reverse):
+    inputs = make_inputs(25)
+    llm = DeterministicEvalLLM(keyword="gallium", reverse=reverse)
+    evals = collect(iter_evaluations(
+        inputs=inputs,
+        evaluate_doc=llm.evaluate_doc,
+        evaluate_batch=llm.evaluate_batch,
+        batch_tkn_size=batch_tkn_size,
+        max_workers=4,
+    ))
+    assert evals == {i: [llm.verdict(inp["doc"])] for i, inp in enumerate(inputs)}
+    assert sum(ev == ["1"] for ev in evals.values()) == 9
+    n_batches = len(batch_docs_by_tkn([inp["doc"] for inp in inputs], batch_tkn_size)) if batch_tkn_size else 0
+    assert llm.batch_calls == n_batches
+    assert llm.single_calls == (0 if batch_tkn_size else len(inputs))
+
+
+def test_iter_evaluations_same_verdicts_in_both_modes():
+    inputs = make_inputs(40, relevant_every=4)
+    results = {}
+    for size in [0, 300]:
+        llm = DeterministicEvalLLM(keyword="gallium", reverse=True)
+        results[size] = (
+            collect(iter_evaluations(inputs, llm.evaluate_doc, llm.evaluate_batch, size, 8)),
+            llm.single_calls + llm.batch_calls,
+        )
+    assert results[0][0] == results[300][0]
+    assert results[300][1] < results[0][1] == 40
+
+
+def test_iter_evaluations_unparsable_documents_are_evaluated_again():
+    garbled = (2, 3, 17)
+    inputs = make_inputs(20, garbled=garbled)
+    llm = DeterministicEvalLLM(keyword="gallium", garble_keyword="GARBLE")
+    evals = collect(iter_evaluations(inputs, llm.evaluate_doc, llm.evaluate_batch, 150, 4))
+    assert evals == {i: [llm.verdict(inp["doc"])] for i, inp in enumerate(inputs)}
+    assert llm.single_calls == len(garbled)
+    assert llm.batch_calls == len(batch_docs_by_tkn([inp["doc"] for inp in inputs], 150))
+
+
+def test_iter_evaluations_empty():
+    llm = DeterministicEvalLLM(keyword="gallium")
+    assert list(iter_evaluations([], llm.evaluate_doc, llm.evaluate_batch, 100, 2)) == []
+
+
+def fake_combine(answers: list, delays: dict = None) -> str:
+    "keeps the combined answers, a random delay makes the calls finish out of order"
+    if delays is not None:
+        time.sleep(delays.setdefault(tuple(answers), random.random() / 200))
+    return "(" + " + ".join(answers) + ")"
+
+
+def leaves_of(answer: str) -> list:
+    return re.findall(r"a\d+", answer)
+
+
+def run_tree(n_answers: int, fan_in: int, tkn_budget: int = 100_000, shuffle: bool = False, seed: int = 0) -> tuple:
+    rng = random.Random(seed)
+    answers = [f"a{i} " + "word " * rng.randint(1, 50) for i in range(n_answers)]
+    delays = {}
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        tree = CombineTree(
+            combine=lambda a: fake_combine(a, delays),
+            submit=pool.submit,
+            tkn_budget=tkn_budget,
+            fan_in=fan_in,
+        )
+        order = list(range(n_answers))
+        if shuffle:
+            rng.shuffle(order)
+        list(pool.map(lambda i: tree.put(0, i, answers[i]), order))
+        while True:
+            with tree.lock:
+                futures = list(tree.futures)
+            if all(f.done() for f in futures):
+                break
+            wait(futures)
+    final = tree.finish(lambda batches: [fake_combine(b) for b in batches])
+    return final, tree
+
+
+@pytest.mark.parametrize("n_answers", [1, 2, 3, 9, 10, 11, 37, 100])
+@pytest.mark.parametrize("fan_in", [2, 3, 10])
+def test_combine_tree_uses_each_answer_once(n_answers, fan_in):
+    final, tree = run_tree(n_answers, fan_in)
+    assert leaves_of(final) == [f"a{i}" for i in range(n_answers)]
+    assert tree.combined_answers[-1] == [final]
+    # every batch respects the fan-in, and each round reduces the answers
+    for sizes in tree.combine_rounds:
+        assert all(1 <= s <= fan_in for s in sizes)
+    assert sum(s - 1 for sizes in tree.combine_rounds for s in sizes) == n_answers - 1
+    assert [len(r) for r in tree.combine_rounds] == [len(c) for c in tree.combined_answers]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_combine_tree_does_not_depend_on_completion_order(seed):
+    reference, ref_tree = run_tree(60, fan_in=4, tkn_budget=150, seed=seed)
+    for _ in range(3):
+        final, tree = run_tree(60, fan_in=4, tkn_budget=150, shuffle=True, seed=seed)
+        assert final == reference
+        assert tree.combine_rounds == ref_tree.combine_rounds
+        assert tree.combined_answers == ref_tree.combined_answers
+
+
+def test_combine_tree_streams_full_batches():
+    final, tree = run_tree(25, fan_in=5)
+    # the 5 full batches of answers and the batch of their combinations
+    assert tree.streamed == [5] * 6
+    assert tree.combine_rounds == [[5] * 5, [5]]
+
+
+def test_combine_tree_without_answers():
+    tree = CombineTree(combine=fake_combine, submit=None, tkn_budget=1000, fan_in=3)
+    assert tree.finish(lambda batches: [fake_combine(b) for b in batches]) == "()"
+    assert tree.combine_rounds == [[0]]
+
+
+@pytest.mark.parametrize("n_texts", [3, 30])
+def test_semantic_sorting_does_not_fill_the_cache(n_texts):
+    store = InMemoryByteStore()
+    embeddings = CacheBackedEmbeddings.from_bytes_store(
+        DeterministicFakeEmbedding(size=16),
+        store,
+        namespace="test",
+    )
+    texts = [f"intermediate answer {i}" for i in range(n_texts)]
+    out = semantic_sorting(texts + texts[:2], embeddings)
+    assert sorted(out) == sorted(texts)
+    assert list(store.yield_keys()) == []